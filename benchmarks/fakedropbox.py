@@ -0,0 +1,641 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" In-process stand-in of dropbox.Dropbox backed by a local directory.
+
+    It implements the files_* routes used by dbsync, with pagination,
+    cursors, longpoll, upload sessions and batch jobs, and it can add a
+    latency to each request and throttle over a number of requests per second.
+    The file contents are stored in blobs named by id, the metadata in memory.
+"""
+
+import itertools
+import logging
+import os
+import shutil
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+from threading import Condition
+
+# Dropbox library
+import dropbox
+from dropbox import files
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dbsync.hashing import content_hash  # noqa: E402
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Entries for each page of a listing
+PAGE_SIZE = 2000
+# Size of the chunks of a download
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def key(path):
+    """ Lower case key of a Dropbox path, the root is ""
+    """
+    return path.rstrip('/').lower()
+
+
+def notFound():
+    return files.LookupError.not_found
+
+
+class Conflict(Exception):
+    """ A write on a path already used.
+    """
+
+    def __init__(self, folder=False):
+        super().__init__("conflict")
+        self.folder = folder
+
+    def writeError(self):
+        kind = files.WriteConflictError.folder if self.folder else files.WriteConflictError.file
+        return files.WriteError.conflict(kind)
+
+
+class FakeResponse:
+    """ Streamed content of a download, like requests.Response
+    """
+
+    def __init__(self, backend, blob, start=0):
+        self.backend = backend
+        self.blob = blob
+        self.start = start
+        self.closed = False
+
+    def iter_content(self, chunk_size=CHUNK_SIZE):
+        with open(self.blob, 'rb') as f:
+            f.seek(self.start)
+            while not self.closed:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                self.backend.count('bytes_down', len(data))
+                yield data
+
+    @property
+    def content(self):
+        return b"".join(self.iter_content())
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClone:
+    """ Client returned from FakeDropbox.clone, the downloads send its Range header.
+    """
+
+    def __init__(self, backend, headers):
+        self.backend = backend
+        self.headers = headers
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def files_download(self, path, rev=None):
+        return self.backend.files_download(path, rev=rev, headers=self.headers)
+
+
+class FakeDropbox:
+    """ Fake Dropbox client.
+
+        latency: seconds added to each request
+        rate: maximum requests for second, the others fail with RateLimitError
+        link: bytes for second uploaded from each request, 0 unlimited
+        page_size: entries for each page of list_folder and list_folder_continue
+    """
+
+    def __init__(self, root, latency=0.0, rate=0, page_size=PAGE_SIZE, link=0):
+        self.root = root
+        self.blobs = os.path.join(root, "blobs")
+        self.sessions_dir = os.path.join(root, "sessions")
+        os.makedirs(self.blobs, exist_ok=True)
+        os.makedirs(self.sessions_dir, exist_ok=True)
+        self.latency = float(latency)
+        self.rate = int(rate)
+        self.link = int(link)
+        self.page_size = int(page_size)
+        self._cond = Condition()
+        self._entries = {}
+        self._log = []
+        self._listings = {}
+        self._sessions = {}
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._revs = itertools.count(0x100000000)
+        self._second = 0
+        self._requests = 0
+        self._closed = False
+        self.calls = Counter()
+        self.counters = Counter()
+
+    # ---- Instrumentation
+
+    def count(self, name, value=1):
+        with self._cond:
+            self.counters[name] += value
+        if self.link and name == 'bytes_up':
+            # Time to send the payload on the link
+            time.sleep(value / self.link)
+
+    def stats(self):
+        with self._cond:
+            return {'calls': sum(self.calls.values()), 'routes': dict(self.calls),
+                    'bytes_up': self.counters['bytes_up'], 'bytes_down': self.counters['bytes_down'],
+                    'throttled': self.counters['throttled']}
+
+    def reset(self):
+        """ Reset the counters of calls and bytes.
+        """
+        with self._cond:
+            self.calls.clear()
+            self.counters.clear()
+
+    def close(self):
+        """ Wake up all pending longpolls.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def request(self, name, limited=True):
+        """ Count a request, throttle it and wait the latency.
+        """
+        with self._cond:
+            self.calls[name] += 1
+            if self.rate and limited:
+                now = time.time()
+                if int(now) != self._second:
+                    self._second, self._requests = int(now), 0
+                self._requests += 1
+                if self._requests > self.rate:
+                    self.counters['throttled'] += 1
+                    backoff = 1.0 - (now - int(now))
+                    error = dropbox.auth.RateLimitError(reason=dropbox.auth.RateLimitReason.too_many_requests,
+                                                        retry_after=1)
+                    raise dropbox.exceptions.RateLimitError(self.requestId(), error, backoff=backoff)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def requestId(self):
+        return f"fake-{next(self._ids)}"
+
+    def apiError(self, error):
+        return dropbox.exceptions.ApiError(self.requestId(), error, None, None)
+
+    # ---- Metadata
+
+    def _rev(self):
+        return f"{next(self._revs):x}"
+
+    def _id(self):
+        return f"id:fake{next(self._ids)}"
+
+    def _log_entry(self, md):
+        self._log.append(md)
+        self._cond.notify_all()
+
+    def _parent(self, path):
+        return path.rsplit('/', 1)[0]
+
+    def _folder(self, path):
+        """ Create a folder and all its parents, must be called with the lock.
+        """
+        if not path:
+            return None
+        md = self._entries.get(key(path))
+        if isinstance(md, files.FolderMetadata):
+            return md
+        if md is not None:
+            raise Conflict(folder=False)
+        self._folder(self._parent(path))
+        md = files.FolderMetadata(name=path.rsplit('/', 1)[1], id=self._id(), path_lower=key(path), path_display=path)
+        self._entries[key(path)] = md
+        self._log_entry(md)
+        return md
+
+    def _commit(self, path, blob, mode=None, autorename=False, client_modified=None):
+        """ Store a blob in path, must be called with the lock.
+            Return the FileMetadata or raise Conflict.
+        """
+        mode = mode or files.WriteMode.add
+        size = os.path.getsize(blob)
+        digest = content_hash(blob)
+        old = self._entries.get(key(path))
+        if isinstance(old, files.FolderMetadata):
+            raise Conflict(folder=True)
+        if old is not None:
+            if old.content_hash == digest:
+                # Same content, no new revision
+                os.remove(blob)
+                return old
+            if mode.is_add() or (mode.is_update() and mode.get_update() != old.rev):
+                if not autorename:
+                    raise Conflict()
+                path = self._rename(path)
+                old = None
+        self._folder(self._parent(path))
+        now = datetime.utcnow().replace(microsecond=0)
+        client_modified = (client_modified or now).replace(microsecond=0)
+        md = files.FileMetadata(name=path.rsplit('/', 1)[1], id=old.id if old is not None else self._id(),
+                                client_modified=client_modified, server_modified=now, rev=self._rev(),
+                                size=size, path_lower=key(path), path_display=path, content_hash=digest)
+        os.replace(blob, os.path.join(self.blobs, md.id))
+        self._entries[key(path)] = md
+        self._log_entry(md)
+        return md
+
+    def _rename(self, path):
+        folder, name = path.rsplit('/', 1)
+        base, dot, ext = name.partition('.')
+        for idx in itertools.count(1):
+            candidate = f"{folder}/{base} ({idx}){dot}{ext}"
+            if key(candidate) not in self._entries:
+                return candidate
+
+    def _remove(self, path):
+        """ Remove a path and its content, must be called with the lock.
+            Return the removed metadata or None.
+        """
+        md = self._entries.pop(key(path), None)
+        if md is None:
+            return None
+        prefix = key(path) + '/'
+        for child in [k for k in self._entries if k.startswith(prefix)]:
+            self._entries.pop(child)
+        self._log_entry(files.DeletedMetadata(name=md.name, path_lower=md.path_lower, path_display=md.path_display))
+        return md
+
+    def _relocate(self, from_path, to_path, autorename=False):
+        """ Move a path and its content, must be called with the lock.
+        """
+        md = self._entries.get(key(from_path))
+        if md is None:
+            return None
+        if key(to_path) in self._entries:
+            if not autorename:
+                raise Conflict(isinstance(self._entries[key(to_path)], files.FolderMetadata))
+            to_path = self._rename(to_path)
+        self._folder(self._parent(to_path))
+        prefix = key(from_path)
+        moved = sorted((k, v) for k, v in self._entries.items() if k == prefix or k.startswith(prefix + '/'))
+        self._remove(from_path)
+        result = None
+        for old_key, old in moved:
+            path = to_path + old.path_display[len(from_path):]
+            if isinstance(old, files.FolderMetadata):
+                new = files.FolderMetadata(name=path.rsplit('/', 1)[1], id=old.id, path_lower=key(path), path_display=path)
+            else:
+                new = files.FileMetadata(name=path.rsplit('/', 1)[1], id=old.id, client_modified=old.client_modified,
+                                         server_modified=old.server_modified, rev=self._rev(), size=old.size,
+                                         path_lower=key(path), path_display=path, content_hash=old.content_hash)
+            self._entries[key(path)] = new
+            self._log_entry(new)
+            result = result or new
+        return result
+
+    # ---- Server side changes, not counted as requests
+
+    def put(self, path, data, client_modified=None):
+        """ Write a file like another client.
+        """
+        blob = os.path.join(self.sessions_dir, f"put-{next(self._ids)}")
+        with open(blob, 'wb') as f:
+            f.write(data)
+        with self._cond:
+            return self._commit(path, blob, files.WriteMode.overwrite, client_modified=client_modified)
+
+    def remove(self, path):
+        """ Delete a file or folder like another client.
+        """
+        with self._cond:
+            return self._remove(path)
+
+    def read(self, path):
+        """ Content of a file.
+        """
+        with self._cond:
+            md = self._entries[key(path)]
+        with open(os.path.join(self.blobs, md.id), 'rb') as f:
+            return f.read()
+
+    def listing(self):
+        """ All paths stored, e.g. {"/a/b.txt": FileMetadata}
+        """
+        with self._cond:
+            return {md.path_display: md for md in self._entries.values()}
+
+    # ---- Listing and cursors
+
+    def _match(self, md, prefix, recursive):
+        path = md.path_lower
+        if not path.startswith(prefix + '/'):
+            return False
+        return recursive or '/' not in path[len(prefix) + 1:]
+
+    def _delta(self, seq, prefix, recursive):
+        return f"delta:{seq}:{int(recursive)}:{prefix}"
+
+    def files_list_folder(self, path, recursive=False, limit=None, **kwargs):
+        self.request('files_list_folder')
+        prefix = key(path)
+        with self._cond:
+            if prefix and not isinstance(self._entries.get(prefix), files.FolderMetadata):
+                raise self.apiError(files.ListFolderError.path(notFound()))
+            entries = [md for k, md in sorted(self._entries.items()) if self._match(md, prefix, recursive)]
+            listing = next(self._ids)
+            self._listings[listing] = (entries, self._delta(len(self._log), prefix, recursive))
+        return self._page(listing, 0, limit or self.page_size)
+
+    def _page(self, listing, offset, limit):
+        entries, delta = self._listings[listing]
+        page = entries[offset:offset + limit]
+        if offset + limit < len(entries):
+            return files.ListFolderResult(entries=page, cursor=f"list:{listing}:{offset + limit}:{limit}", has_more=True)
+        with self._cond:
+            self._listings.pop(listing, None)
+        return files.ListFolderResult(entries=page, cursor=delta, has_more=False)
+
+    def files_list_folder_continue(self, cursor):
+        self.request('files_list_folder_continue')
+        kind, _, value = cursor.partition(':')
+        if kind == "list":
+            listing, offset, limit = (int(item) for item in value.split(':'))
+            if listing not in self._listings:
+                raise self.apiError(files.ListFolderContinueError.reset)
+            return self._page(listing, offset, limit)
+        if kind != "delta":
+            raise self.apiError(files.ListFolderContinueError.reset)
+        seq, recursive, prefix = value.split(':', 2)
+        seq, recursive = int(seq), bool(int(recursive))
+        with self._cond:
+            if seq > len(self._log):
+                raise self.apiError(files.ListFolderContinueError.reset)
+            page = []
+            while seq < len(self._log) and len(page) < self.page_size:
+                md = self._log[seq]
+                seq += 1
+                if self._match(md, prefix, recursive):
+                    page.append(md)
+            return files.ListFolderResult(entries=page, cursor=self._delta(seq, prefix, recursive),
+                                          has_more=seq < len(self._log))
+
+    def files_list_folder_get_latest_cursor(self, path, recursive=False, **kwargs):
+        self.request('files_list_folder_get_latest_cursor')
+        with self._cond:
+            return files.ListFolderGetLatestCursorResult(cursor=self._delta(len(self._log), key(path), recursive))
+
+    def files_list_folder_longpoll(self, cursor, timeout=30):
+        # The longpoll is not counted in the rate limits
+        self.request('files_list_folder_longpoll', limited=False)
+        kind, _, value = cursor.partition(':')
+        if kind != "delta":
+            raise self.apiError(files.ListFolderLongpollError.reset)
+        seq, recursive, prefix = value.split(':', 2)
+        seq, recursive = int(seq), bool(int(recursive))
+        deadline = time.time() + timeout
+        with self._cond:
+            while not self._closed:
+                if any(self._match(md, prefix, recursive) for md in self._log[seq:]):
+                    return files.ListFolderLongpollResult(changes=True)
+                seq = len(self._log)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+        return files.ListFolderLongpollResult(changes=False)
+
+    # ---- Files
+
+    def files_get_metadata(self, path, **kwargs):
+        self.request('files_get_metadata')
+        with self._cond:
+            md = self._entries.get(key(path))
+        if md is None:
+            raise self.apiError(files.GetMetadataError.path(notFound()))
+        return md
+
+    def clone(self, headers=None):
+        """ Copy of the client sending the HTTP headers, only Range is used.
+        """
+        return FakeClone(self, headers or {})
+
+    def files_download(self, path, rev=None, headers=None):
+        self.request('files_download')
+        with self._cond:
+            md = self._entries.get(key(path))
+        if md is None:
+            raise self.apiError(files.DownloadError.path(notFound()))
+        if not isinstance(md, files.FileMetadata):
+            raise self.apiError(files.DownloadError.path(files.LookupError.not_file))
+        start = 0
+        ranges = (headers or {}).get('Range', '')
+        if ranges.startswith('bytes=') and ranges.endswith('-'):
+            start = int(ranges[len('bytes='):-1])
+        return md, FakeResponse(self, os.path.join(self.blobs, md.id), start)
+
+    def _blob(self, data):
+        blob = os.path.join(self.sessions_dir, f"blob-{next(self._ids)}")
+        with open(blob, 'wb') as f:
+            f.write(data)
+        self.count('bytes_up', len(data))
+        return blob
+
+    def files_upload(self, f, path, mode=files.WriteMode.add, autorename=False, client_modified=None, mute=False, **kwargs):
+        self.request('files_upload')
+        blob = self._blob(f)
+        with self._cond:
+            try:
+                return self._commit(path, blob, mode, autorename, client_modified)
+            except Conflict as err:
+                os.remove(blob)
+                raise self.apiError(files.UploadError.path(files.UploadWriteFailed(reason=err.writeError(),
+                                                                                   upload_session_id="")))
+
+    def files_create_folder(self, path, autorename=False):
+        self.request('files_create_folder')
+        with self._cond:
+            if key(path) in self._entries:
+                raise self.apiError(files.CreateFolderError.path(files.WriteError.conflict(files.WriteConflictError.folder)))
+            try:
+                return self._folder(path)
+            except Conflict as err:
+                raise self.apiError(files.CreateFolderError.path(err.writeError()))
+
+    def files_delete(self, path, parent_rev=None):
+        self.request('files_delete')
+        with self._cond:
+            md = self._remove(path)
+        if md is None:
+            raise self.apiError(files.DeleteError.path_lookup(notFound()))
+        return md
+
+    def files_move(self, from_path, to_path, allow_shared_folder=False, autorename=False, allow_ownership_transfer=False):
+        self.request('files_move')
+        with self._cond:
+            try:
+                md = self._relocate(from_path, to_path, autorename)
+            except Conflict as err:
+                raise self.apiError(files.RelocationError.to(err.writeError()))
+        if md is None:
+            raise self.apiError(files.RelocationError.from_lookup(notFound()))
+        return md
+
+    # ---- Upload sessions
+
+    def files_upload_session_start(self, f, close=False, session_type=None, content_hash=None):
+        self.request('files_upload_session_start')
+        session_id = f"session-{next(self._ids)}"
+        blob = os.path.join(self.sessions_dir, session_id)
+        with open(blob, 'wb') as out:
+            out.write(f)
+        self.count('bytes_up', len(f))
+        concurrent = session_type is not None and session_type.is_concurrent()
+        with self._cond:
+            self._sessions[session_id] = {'blob': blob, 'size': len(f), 'closed': close, 'concurrent': concurrent}
+        return files.UploadSessionStartResult(session_id=session_id)
+
+    def _append(self, session, f, offset):
+        if not session['concurrent'] and offset != session['size']:
+            raise self.apiError(files.UploadSessionAppendError.incorrect_offset(
+                files.UploadSessionOffsetError(correct_offset=session['size'])))
+        if f:
+            fd = os.open(session['blob'], os.O_WRONLY)
+            try:
+                os.pwrite(fd, f, offset)
+            finally:
+                os.close(fd)
+            self.count('bytes_up', len(f))
+        with self._cond:
+            session['size'] = max(session['size'], offset + len(f))
+
+    def _session(self, cursor):
+        with self._cond:
+            session = self._sessions.get(cursor.session_id)
+        if session is None:
+            raise self.apiError(files.UploadSessionAppendError.not_found)
+        return session
+
+    def files_upload_session_append_v2(self, f, cursor, close=False, content_hash=None):
+        self.request('files_upload_session_append_v2')
+        session = self._session(cursor)
+        if session['closed']:
+            raise self.apiError(files.UploadSessionAppendError.closed)
+        self._append(session, bytes(f), cursor.offset)
+        session['closed'] = close
+
+    def _finish(self, f, cursor, commit):
+        """ Commit an upload session.
+            Return the FileMetadata or raise Conflict.
+        """
+        session = self._session(cursor)
+        self._append(session, f, cursor.offset)
+        with self._cond:
+            self._sessions.pop(cursor.session_id, None)
+            return self._commit(commit.path, session['blob'], commit.mode, commit.autorename, commit.client_modified)
+
+    def files_upload_session_finish(self, f, cursor, commit, content_hash=None):
+        self.request('files_upload_session_finish')
+        try:
+            return self._finish(f, cursor, commit)
+        except Conflict as err:
+            raise self.apiError(files.UploadSessionFinishError.path(err.writeError()))
+
+    # ---- Batch jobs
+
+    def _job(self, result):
+        job = f"job-{next(self._ids)}"
+        with self._cond:
+            self._jobs[job] = result
+        return job
+
+    def files_upload_session_finish_batch(self, entries):
+        self.request('files_upload_session_finish_batch')
+        results = []
+        for entry in entries:
+            try:
+                results.append(files.UploadSessionFinishBatchResultEntry.success(self._finish(b"", entry.cursor, entry.commit)))
+            except Conflict as err:
+                results.append(files.UploadSessionFinishBatchResultEntry.failure(
+                    files.UploadSessionFinishError.path(err.writeError())))
+            except dropbox.exceptions.ApiError:
+                results.append(files.UploadSessionFinishBatchResultEntry.failure(
+                    files.UploadSessionFinishError.lookup_failed(files.UploadSessionLookupError.not_found)))
+        job = self._job(files.UploadSessionFinishBatchResult(entries=results))
+        return files.UploadSessionFinishBatchLaunch.async_job_id(job)
+
+    def files_upload_session_finish_batch_check(self, async_job_id):
+        self.request('files_upload_session_finish_batch_check')
+        with self._cond:
+            return files.UploadSessionFinishBatchJobStatus.complete(self._jobs.pop(async_job_id))
+
+    def files_delete_batch(self, entries):
+        self.request('files_delete_batch')
+        results = []
+        with self._cond:
+            for entry in entries:
+                md = self._remove(entry.path)
+                if md is None:
+                    results.append(files.DeleteBatchResultEntry.failure(files.DeleteError.path_lookup(notFound())))
+                else:
+                    results.append(files.DeleteBatchResultEntry.success(files.DeleteBatchResultData(metadata=md)))
+        job = self._job(files.DeleteBatchResult(entries=results))
+        return files.DeleteBatchLaunch.async_job_id(job)
+
+    def files_delete_batch_check(self, async_job_id):
+        self.request('files_delete_batch_check')
+        with self._cond:
+            return files.DeleteBatchJobStatus.complete(self._jobs.pop(async_job_id))
+
+    def files_move_batch_v2(self, entries, autorename=False, allow_ownership_transfer=False):
+        self.request('files_move_batch_v2')
+        results = []
+        with self._cond:
+            for entry in entries:
+                try:
+                    md = self._relocate(entry.from_path, entry.to_path, autorename)
+                except Conflict as err:
+                    error = files.RelocationError.to(err.writeError())
+                    results.append(files.RelocationBatchResultEntry.failure(files.RelocationBatchErrorEntry.relocation_error(error)))
+                    continue
+                if md is None:
+                    error = files.RelocationError.from_lookup(notFound())
+                    results.append(files.RelocationBatchResultEntry.failure(files.RelocationBatchErrorEntry.relocation_error(error)))
+                else:
+                    results.append(files.RelocationBatchResultEntry.success(md))
+        job = self._job(files.RelocationBatchV2Result(entries=results))
+        return files.RelocationBatchV2Launch.async_job_id(job)
+
+    def files_move_batch_check_v2(self, async_job_id):
+        self.request('files_move_batch_check_v2')
+        with self._cond:
+            return files.RelocationBatchV2JobStatus.complete(self._jobs.pop(async_job_id))
+
+    def cleanup(self):
+        """ Remove all stored blobs.
+        """
+        shutil.rmtree(self.root, ignore_errors=True)
+# EOF
@@ -0,0 +1,97 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" Micro-benchmark of the .dropboxignore matcher.
+
+    Compare the previous single fnmatch alternation, matched on every basename,
+    with the compiled IgnoreMatcher that prunes the ignored subtrees and
+    matches only the names of the entries of the folders accepted.
+
+    python benchmarks/ignore_bench.py [--dirs 1000] [--files 100]
+"""
+
+import argparse
+import fnmatch
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dbsync.ignore import IgnoreMatcher  # noqa: E402
+
+PATTERNS = ["*.swp", "*.tmp", "*.log", "*.o", "*.pyc", "__pycache__", "node_modules", ".git", "build", "dist",
+            "*.bak", "*~", ".DS_Store", "Thumbs.db", "*.part", "cache", "*.class", "target", "*.iso", "*.lock"]
+
+
+def tree(dirs, files):
+    """ Synthetic tree as a list of (folder, [subfolders], [files]) like os.walk
+    """
+    names = ["src", "docs", "node_modules", "build", "assets", "__pycache__", "data", "cache"]
+    rv = []
+    for idx in range(dirs):
+        folder = f"d{idx % 50}/{names[idx % len(names)]}{idx}"
+        rv.append((folder, [], [f"file{n}{ext}" for n in range(files) for ext in ((".txt", ".log", ".pyc", ".jpg")[n % 4],)]))
+    return rv
+
+
+def old_walk(walk, excludes):
+    kept = 0
+    for folder, _, files in walk:
+        if any(re.match(excludes, part) for part in folder.split('/')):
+            continue
+        kept += sum(1 for name in files if not re.match(excludes, name))
+    return kept
+
+
+def new_walk(walk, matcher):
+    kept = 0
+    for folder, _, files in walk:
+        if matcher.match(folder, is_dir=True):
+            # The whole subtree is skipped
+            continue
+        kept += sum(1 for name in files if not matcher.matchName(folder, name))
+    return kept
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark .dropboxignore matching')
+    parser.add_argument('--dirs', type=int, default=1000)
+    parser.add_argument('--files', type=int, default=100)
+    args = parser.parse_args()
+    walk = tree(args.dirs, args.files)
+    total = sum(len(files) for _, _, files in walk)
+    excludes = r'|'.join([fnmatch.translate(x) for x in PATTERNS])
+    t0 = time.perf_counter()
+    kept_old = old_walk(walk, excludes)
+    t1 = time.perf_counter()
+    matcher = IgnoreMatcher(PATTERNS)
+    kept_new = new_walk(walk, matcher)
+    t2 = time.perf_counter()
+    print(f"{total} files, {len(PATTERNS)} patterns")
+    print(f"fnmatch regex:  {(t1 - t0):.3f}s ({kept_old} kept)")
+    print(f"IgnoreMatcher:  {(t2 - t1):.3f}s ({kept_new} kept)")
+
+
+if __name__ == '__main__':
+    main()
+# EOF
@@ -0,0 +1,210 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" Offline benchmark of the synchronization against the fake Dropbox backend.
+
+    Generate a tree with many small files, a few big files and a deep nesting
+    and report for each phase the time, the API calls, the bytes moved
+    and the peak RSS of the process (the fake backend runs in the same process).
+
+    python benchmarks/sync_bench.py [--small 10000] [--big 3] [--bigSize 2048] [--depth 32]
+                                    [--latency 0.0] [--rate 0] [--link 0] [--workers 4] [--chunkSize 0]
+"""
+
+import argparse
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dbsync.updown import UpDown  # noqa: E402
+from fakedropbox import FakeDropbox  # noqa: E402
+
+# Files for each folder of the generated tree
+FILES_PER_FOLDER = 100
+BLOCK = 4 * 1024 * 1024
+
+
+def randomBytes(rnd, size):
+    """ Reproducible random bytes, Random.randbytes is available only from Python 3.9
+    """
+    return rnd.getrandbits(8 * size).to_bytes(size, "little") if size else b""
+
+
+def generate(folder, small, small_size, big, big_size, depth):
+    """ Generate the local tree, return the number of files and bytes.
+    """
+    rnd = random.Random(0)
+    count, size = 0, 0
+    for idx in range(small):
+        subfolder = os.path.join(folder, f"small{idx // FILES_PER_FOLDER:04d}")
+        os.makedirs(subfolder, exist_ok=True)
+        data = randomBytes(rnd, small_size)
+        with open(os.path.join(subfolder, f"file{idx:06d}.bin"), 'wb') as f:
+            f.write(data)
+        count, size = count + 1, size + len(data)
+    block = randomBytes(rnd, BLOCK)
+    os.makedirs(os.path.join(folder, "big"), exist_ok=True)
+    for idx in range(big):
+        with open(os.path.join(folder, "big", f"big{idx}.bin"), 'wb') as f:
+            written = 0
+            while written < big_size:
+                data = block[:big_size - written]
+                f.write(data)
+                written += len(data)
+        count, size = count + 1, size + big_size
+    nested = folder
+    for level in range(depth):
+        nested = os.path.join(nested, f"level{level}")
+        os.makedirs(nested, exist_ok=True)
+        with open(os.path.join(nested, "leaf.txt"), 'w') as f:
+            f.write(f"level {level}\n")
+        count, size = count + 1, size + len(f"level {level}\n")
+    return count, size
+
+
+def peakRSS():
+    """ Peak resident set size in MB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux in KB, macOS in bytes
+    return rss / 1024 if sys.platform != "darwin" else rss / 1024 / 1024
+
+
+class Bench:
+
+    def __init__(self, args):
+        self.args = args
+        self.work = tempfile.mkdtemp(prefix="dbsync-bench-")
+        self.fake = FakeDropbox(os.path.join(self.work, "remote"), latency=args.latency, rate=args.rate,
+                                link=args.link * 1024 * 1024)
+        self.results = []
+
+    def updown(self, folder, state=""):
+        os.makedirs(folder, exist_ok=True)
+        return UpDown("", "", "", "", folder, state=state, client=self.fake, workers=self.args.workers,
+                      batch_size=self.args.batchSize, chunk_size=self.args.chunkSize * 1024 * 1024, quiet=0)
+
+    def phase(self, name, func):
+        self.fake.reset()
+        t0 = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t0
+        stats = self.fake.stats()
+        self.results.append((name, elapsed, stats, peakRSS()))
+        routes = ", ".join(f"{route[len('files_'):]}={count}" for route, count in sorted(stats['routes'].items()))
+        print(f"{name:<18} {elapsed:8.2f}s {stats['calls']:7d} calls {stats['bytes_up'] / 1e6:10.1f}MB up "
+              f"{stats['bytes_down'] / 1e6:10.1f}MB down {peakRSS():8.1f}MB RSS  [{routes}]")
+
+    def run(self):
+        args = self.args
+        local = os.path.join(self.work, "local")
+        os.makedirs(local)
+        t0 = time.perf_counter()
+        count, size = generate(local, args.small, args.smallSize, args.big, args.bigSize * 1024 * 1024, args.depth)
+        print(f"Generated {count} files, {size / 1e6:.1f}MB in {time.perf_counter() - t0:.1f}s")
+        state = os.path.join(self.work, "state.db")
+        # Cold start, everything is uploaded
+        updown = self.updown(local, state)
+        updown.startBatchers()
+        self.phase("cold upload", updown.reconcile)
+        tuner = updown.tuner.stats()
+        print(f"{'upload chunk':<18} {tuner['chunk_size'] / 1024 ** 2:8.0f}MB, single request up to "
+              f"{tuner['threshold'] / 1024 ** 2:.0f}MB [{'auto' if tuner['auto'] else 'fixed'}, "
+              f"{tuner['throughput'] / 1e6:.1f}MB/s, {tuner['latency'] * 1000:.0f}ms latency]")
+        # Nothing changed, a full rescan
+        self.phase("steady reconcile", updown.reconcile)
+        # Remote changes applied from the cursor
+        names = sorted(name for name in self.fake.listing() if name.endswith(".bin") and "/small" in name)
+        changed = names[:max(1, len(names) // 100)]
+
+        def remoteChanges():
+            for name in changed:
+                self.fake.put(name, os.urandom(args.smallSize))
+            updown.syncChanges()
+        self.phase("remote changes", remoteChanges)
+        # Local changes found from the stored state
+        updown.saveCursor()
+
+        def localChanges():
+            for name in changed:
+                with open(local + name, 'ab') as f:
+                    f.write(b"local change")
+            updown.syncLocalChanges()
+        self.phase("local changes", localChanges)
+        updown.stop()
+        # Restart with the stored state
+        warm = self.updown(local, state)
+        warm.startBatchers()
+
+        def warmStart():
+            warm.cursor = warm.state.getCursor()
+            warm.syncChanges()
+            warm.syncLocalChanges()
+        self.phase("warm restart", warmStart)
+        warm.stop()
+        # Cold start on an empty folder, everything is downloaded
+        download = self.updown(os.path.join(self.work, "download"))
+        download.startBatchers()
+        self.phase("cold download", download.reconcile)
+        download.stop()
+        self.fake.close()
+
+    def cleanup(self):
+        shutil.rmtree(self.work, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dbsync against a fake Dropbox backend')
+    parser.add_argument('--small', type=int, default=10000, help='Number of small files')
+    parser.add_argument('--smallSize', type=int, default=4096, help='Size in bytes of the small files')
+    parser.add_argument('--big', type=int, default=3, help='Number of big files')
+    parser.add_argument('--bigSize', type=int, default=2048, help='Size in MB of the big files')
+    parser.add_argument('--depth', type=int, default=32, help='Levels of nested folders')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each request')
+    parser.add_argument('--rate', type=int, default=0, help='Maximum requests for second, 0 unlimited')
+    parser.add_argument('--link', type=float, default=0, help='MB for second uploaded from each request, 0 unlimited')
+    parser.add_argument('--chunkSize', type=int, default=0, help='Upload chunk size in MB, 0 tuned from the throughput')
+    parser.add_argument('--workers', type=int, default=4, help='Transfers executed in parallel')
+    parser.add_argument('--batchSize', type=int, default=1000, help='Entries committed in a batch')
+    parser.add_argument('--keep', action='store_true', help='Do not remove the working folder')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Show the dbsync logs')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='%(name)s - %(levelname)s - %(message)s')
+    bench = Bench(args)
+    print(f"Working folder {bench.work}")
+    try:
+        bench.run()
+    finally:
+        if not args.keep:
+            bench.cleanup()
+
+
+if __name__ == '__main__':
+    main()
+# EOF
@@ -22,11 +22,17 @@
 
 import logging
 import argparse
+import json
 import sys
 import os
 import time
 # Package imports
 from dbsync import UpDown
+from dbsync.bandwidth import Bandwidth
+from dbsync.selective import SelectivePolicy
+from dbsync.session import SyncSession
+from dbsync.updown import connect
+from dbsync.metrics import MetricsServer
 
 # Create logger for jplotlib
 logger = logging.getLogger(__name__)
@@ -43,6 +49,51 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
+def loadConfig(path):
+    """ Load the folders to sync from a JSON file:
+
+        {"folders": [{"rootdir": "/dropbox/team", "folder": "Team", "overwrite": "dropbox",
+                      "dropboxignore": ".dropboxignore", "state": "/dropbox/.team.db", "interval": 10,
+                      "selective": {"include": ["/Projects"], "maxSize": "100M"}}]}
+
+        Only rootdir is required, overwrite is "dropbox", "host" or "".
+        selective are the selective sync rules or the path of a JSON file with them.
+    """
+    try:
+        with open(os.path.expanduser(path), 'r') as f:
+            config = json.load(f)
+    except (OSError, ValueError) as err:
+        print(f"{bcolors.FAIL}Config file {path} not valid: {err}{bcolors.ENDC}")
+        sys.exit(1)
+    mappings = config.get('folders', []) if isinstance(config, dict) else config
+    if not mappings:
+        print(f"{bcolors.FAIL}No folders in config file {path}{bcolors.ENDC}")
+        sys.exit(1)
+    for mapping in mappings:
+        if 'rootdir' not in mapping:
+            print(f"{bcolors.FAIL}rootdir missing in {mapping}{bcolors.ENDC}")
+            sys.exit(1)
+        if mapping.get('overwrite', "") not in ("dropbox", "host", ""):
+            print(f"{bcolors.FAIL}overwrite must be dropbox, host or empty in {mapping}{bcolors.ENDC}")
+            sys.exit(1)
+        mapping['selective'] = loadSelective(mapping.get('selective'))
+    return mappings
+
+
+def loadSelective(rules):
+    """ Build the selective sync policy from a dict of rules or from the path of a JSON file.
+    """
+    if not rules:
+        return None
+    try:
+        if isinstance(rules, dict):
+            return SelectivePolicy.fromDict(rules)
+        return SelectivePolicy.load(rules)
+    except ValueError as err:
+        print(f"{bcolors.FAIL}Selective sync rules not valid: {err}{bcolors.ENDC}")
+        sys.exit(1)
+
+
 def main():
     """Main program.
 
@@ -70,6 +121,60 @@ def main():
     parser.add_argument('--interval', '-i',
                         default=int(os.environ['DROPBOX_INTERVAL']) if "DROPBOX_INTERVAL" in os.environ else 10,
                         help='Interval to sync from dropbox')
+    parser.add_argument('--state',
+                        default=os.environ['DROPBOX_STATE'] if "DROPBOX_STATE" in os.environ else "",
+                        help='File to store the sync state, used to speed up the restart')
+    parser.add_argument('--chunkSize',
+                        default=int(os.environ['DROPBOX_CHUNK_SIZE']) if "DROPBOX_CHUNK_SIZE" in os.environ else 0,
+                        type=int,
+                        help='Upload chunk size in MB (multiple of 4), 0 to tune it from the throughput measured')
+    parser.add_argument('--uploadWorkers',
+                        default=int(os.environ['DROPBOX_UPLOAD_WORKERS']) if "DROPBOX_UPLOAD_WORKERS" in os.environ else 4,
+                        type=int,
+                        help='Chunks uploaded in parallel for big files')
+    parser.add_argument('--batchSize',
+                        default=int(os.environ['DROPBOX_BATCH_SIZE']) if "DROPBOX_BATCH_SIZE" in os.environ else 1000,
+                        type=int,
+                        help='Small files, deletes and moves committed together, 1 to disable')
+    parser.add_argument('--batchDeadline',
+                        default=float(os.environ['DROPBOX_BATCH_DEADLINE']) if "DROPBOX_BATCH_DEADLINE" in os.environ else 2.0,
+                        type=float,
+                        help='Seconds before to commit a not full batch')
+    parser.add_argument('--workers',
+                        default=int(os.environ['DROPBOX_WORKERS']) if "DROPBOX_WORKERS" in os.environ else 4,
+                        type=int,
+                        help='Transfers executed in parallel')
+    parser.add_argument('--quiet',
+                        default=float(os.environ['DROPBOX_QUIET']) if "DROPBOX_QUIET" in os.environ else 1.0,
+                        type=float,
+                        help='Seconds a local file must be stable before to be uploaded')
+    parser.add_argument('--scanWorkers',
+                        default=int(os.environ['DROPBOX_SCAN_WORKERS']) if "DROPBOX_SCAN_WORKERS" in os.environ else 1,
+                        type=int,
+                        help='Top level folders scanned in parallel, useful on network mounts')
+    parser.add_argument('--maxRequests',
+                        default=int(os.environ['DROPBOX_MAX_REQUESTS']) if "DROPBOX_MAX_REQUESTS" in os.environ else 16,
+                        type=int,
+                        help='Maximum number of requests in flight, reduced when Dropbox throttles')
+    parser.add_argument('--metrics',
+                        default=os.environ['DROPBOX_METRICS'] if "DROPBOX_METRICS" in os.environ else "",
+                        help='Expose the Prometheus metrics on [host:]port, disabled if empty')
+    parser.add_argument('--config', '-c',
+                        default=os.environ['DROPBOX_CONFIG'] if "DROPBOX_CONFIG" in os.environ else "",
+                        help='JSON file with many folders to sync in a single process')
+    parser.add_argument('--uploadLimit',
+                        default=os.environ['DROPBOX_UPLOAD_LIMIT'] if "DROPBOX_UPLOAD_LIMIT" in os.environ else "",
+                        help='Upload rate limit, e.g. 1M or with a schedule 09:00-18:00=1M,0')
+    parser.add_argument('--downloadLimit',
+                        default=os.environ['DROPBOX_DOWNLOAD_LIMIT'] if "DROPBOX_DOWNLOAD_LIMIT" in os.environ else "",
+                        help='Download rate limit, e.g. 4M or with a schedule 09:00-18:00=4M,0')
+    parser.add_argument('--maxWatches',
+                        default=int(os.environ['DROPBOX_MAX_WATCHES']) if "DROPBOX_MAX_WATCHES" in os.environ else 0,
+                        type=int,
+                        help='Inotify watches to use, 0 to read the limit of the system')
+    parser.add_argument('--selective',
+                        default=os.environ['DROPBOX_SELECTIVE'] if "DROPBOX_SELECTIVE" in os.environ else "",
+                        help='JSON file with the selective sync rules')
     parser.add_argument('--fromDropbox', action='store_true',
                         help='Direction to synchronize Dropbox')
     parser.add_argument('--fromLocal', action='store_true',
@@ -86,15 +191,6 @@ def main():
         print(f"{bcolors.FAIL}app key and app secret must be set{bcolors.ENDC}")
         sys.exit(2)
 
-    # Check folders
-    folder = args.folder
-    rootdir = os.path.expanduser(args.rootdir)
-    if not os.path.exists(rootdir):
-        print(f"{bcolors.FAIL}{rootdir} does not exist on your filesystem{bcolors.ENDC}")
-        sys.exit(1)
-    elif not os.path.isdir(rootdir):
-        print(f"{bcolors.FAIL}{rootdir} is not a folder on your filesystem{bcolors.ENDC}")
-        sys.exit(1)
     # Configure type of overwrite
     if args.fromDropbox:
         overwrite = "dropbox"
@@ -102,14 +198,56 @@ def main():
         overwrite = "host"
     else:
         overwrite = ""
+    # Folders to sync, from the config file or from the arguments
+    if args.config:
+        mappings = loadConfig(args.config)
+    else:
+        mappings = [{'rootdir': args.rootdir, 'folder': args.folder, 'overwrite': overwrite, 'state': args.state,
+                     'selective': loadSelective(args.selective)}]
+    # Check folders
+    for mapping in mappings:
+        rootdir = os.path.expanduser(mapping['rootdir'])
+        if not os.path.exists(rootdir):
+            print(f"{bcolors.FAIL}{rootdir} does not exist on your filesystem{bcolors.ENDC}")
+            sys.exit(1)
+        elif not os.path.isdir(rootdir):
+            print(f"{bcolors.FAIL}{rootdir} is not a folder on your filesystem{bcolors.ENDC}")
+            sys.exit(1)
+        mapping['rootdir'] = rootdir
+
+    # Rate limits shared from all transfers
+    try:
+        bandwidth = Bandwidth(args.uploadLimit, args.downloadLimit)
+    except ValueError as err:
+        print(f"{bcolors.FAIL}Bandwidth limit not valid: {err}{bcolors.ENDC}")
+        sys.exit(1)
 
+    # A single client, observer and scheduler for all folders
+    client = connect(args.appKey, args.appSecret, args.refreshToken, args.maxRequests)
+    session = SyncSession(client, batch_size=args.batchSize, batch_deadline=args.batchDeadline, workers=args.workers,
+                          max_requests=args.maxRequests, bandwidth=bandwidth, max_watches=args.maxWatches,
+                          chunk_size=args.chunkSize * 1024 * 1024, upload_workers=args.uploadWorkers)
     # Start updown sync with refresh token, designed for long living
-    updown = UpDown(args.appKey, args.appSecret, args.refreshToken, folder, rootdir, interval=args.interval,
-                    overwrite=overwrite)
+    syncs = []
+    for mapping in mappings:
+        syncs.append(UpDown(args.appKey, args.appSecret, args.refreshToken, mapping.get('folder', ""), mapping['rootdir'],
+                            dropboxignore=mapping.get('dropboxignore', ".dropboxignore"),
+                            interval=mapping.get('interval', args.interval),
+                            overwrite=mapping.get('overwrite', ""), state=mapping.get('state', ""),
+                            upload_workers=args.uploadWorkers,
+                            quiet=args.quiet, scan_workers=args.scanWorkers, selective=mapping.get('selective'),
+                            session=session))
 
+    # Metrics endpoint, started before the first sync
+    server = None
+    if args.metrics:
+        host, _, port = args.metrics.rpartition(":")
+        server = MetricsServer(session.metrics, host=host, port=int(port))
+        server.start()
     # Run observer
-    logger.info("Server started")
-    updown.start()
+    logger.info(f"Server started with {len(syncs)} folders")
+    for updown in syncs:
+        updown.start()
     # Run loop
     try:
         while True:
@@ -117,7 +255,11 @@ def main():
     except KeyboardInterrupt:
         logger.debug("Keyboard interrupt")
     # Stop server
-    updown.stop()
+    for updown in syncs:
+        updown.stop()
+    session.stop()
+    if server is not None:
+        server.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,202 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import logging
+import re
+import time
+from collections import deque
+from datetime import datetime
+from threading import Event, Lock
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Units of a rate, in bytes per second
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+# Seconds of transfer allowed at full rate after an idle period
+BURST = 1.0
+# Window in seconds of the throughput measure
+WINDOW = 10.0
+# Minimum interval in seconds between two throughput logs
+REPORT_INTERVAL = 30.0
+# Seconds between two checks of the schedule
+SCHEDULE_CHECK = 30.0
+# Rule of a schedule, e.g. "09:00-18:00=1M"
+RULE = re.compile(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.*)$")
+
+
+def parseRate(text):
+    """ Parse a rate in bytes per second, e.g. "512K", "2M" or "1.5MB".
+        Return 0 for an unlimited rate.
+    """
+    value = text.strip().upper()
+    if value.endswith("B"):
+        value = value[:-1]
+    unit = value[-1:] if value[-1:] in UNITS else ''
+    try:
+        rate = float(value[:len(value) - len(unit)] or 0) * UNITS[unit]
+    except ValueError:
+        raise ValueError(f"rate not valid: {text}")
+    if rate < 0:
+        raise ValueError(f"rate not valid: {text}")
+    return int(rate)
+
+
+def parseLimit(spec):
+    """ Parse a bandwidth limit with an optional time of day schedule.
+
+        The spec is a comma separated list of "HH:MM-HH:MM=rate" rules
+        and a rate used outside the rules, e.g. "09:00-18:00=1M,0"
+        limits to 1MB/s during business hours and unlimited otherwise.
+        A rule can cross the midnight, e.g. "22:00-06:00=0".
+        Return the list of (start, end, rate) in minutes of the day and the default rate.
+    """
+    rules = []
+    default = 0
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        match = RULE.match(item)
+        if match is None:
+            default = parseRate(item)
+            continue
+        start_h, start_m, end_h, end_m, rate = match.groups()
+        start, end = int(start_h) * 60 + int(start_m), int(end_h) * 60 + int(end_m)
+        if start >= 24 * 60 or end > 24 * 60 or int(start_m) >= 60 or int(end_m) >= 60:
+            raise ValueError(f"time not valid: {item}")
+        rules.append((start, end, parseRate(rate)))
+    return rules, default
+
+
+def formatRate(rate):
+    return f"{rate / UNITS['M']:.2f}MB/s" if rate else "unlimited"
+
+
+class TokenBucket:
+    """ Token bucket shaping the bytes of a transfer direction.
+
+        The rate follows the schedule, a transfer bigger than the bucket
+        is allowed and the next ones wait until the debt is paid back.
+        The bytes consumed are measured in a sliding window.
+    """
+
+    def __init__(self, name, spec=""):
+        self.name = name
+        self.rules, self.default = parseLimit(spec)
+        self._lock = Lock()
+        self._closed = Event()
+        self._rate = self.scheduled()
+        self._checked = time.monotonic()
+        self._tokens = self._rate * BURST
+        self._last = time.monotonic()
+        self._window = deque()
+        self._reported = time.monotonic()
+        self.total = 0
+        self.waited = 0.0
+
+    def scheduled(self, now=None):
+        """ Rate of the schedule at the given datetime.
+        """
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.rules:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate
+        return self.default
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def consume(self, size):
+        """ Take size bytes from the bucket, waiting if the rate is exceeded.
+            Return the seconds waited.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked >= SCHEDULE_CHECK:
+                self._checked = now
+                rate = self.scheduled()
+                if rate != self._rate:
+                    logger.info(f"{self.name.capitalize()} limit {formatRate(rate)}")
+                    self._rate = rate
+                    self._tokens = min(self._tokens, rate * BURST)
+            self.total += size
+            self._window.append((now, size))
+            self._prune(now)
+            report = now - self._reported >= REPORT_INTERVAL
+            if report:
+                self._reported = now
+            wait = 0.0
+            if self._rate:
+                self._tokens = min(self._rate * BURST, self._tokens + (now - self._last) * self._rate)
+                self._tokens -= size
+                if self._tokens < 0:
+                    wait = -self._tokens / self._rate
+                    self.waited += wait
+            self._last = now
+        if report:
+            logger.info(f"{self.name.capitalize()} throughput {formatRate(self.throughput())} "
+                        f"limit {formatRate(self._rate)}")
+        if wait:
+            self._closed.wait(wait)
+        return wait
+
+    def throughput(self):
+        """ Bytes per second transferred in the last WINDOW seconds.
+        """
+        with self._lock:
+            self._prune(time.monotonic())
+            return sum(size for _, size in self._window) / WINDOW
+
+    def _prune(self, now):
+        while self._window and now - self._window[0][0] > WINDOW:
+            self._window.popleft()
+
+    def stats(self):
+        return {'rate': self._rate, 'throughput': self.throughput(), 'total': self.total, 'waited': self.waited}
+
+    def close(self):
+        """ Release the transfers waiting the bucket.
+        """
+        self._closed.set()
+
+
+class Bandwidth:
+    """ Upload and download shapers shared from all transfers of the process.
+    """
+
+    def __init__(self, upload="", download=""):
+        self.upload = TokenBucket('upload', upload)
+        self.download = TokenBucket('download', download)
+        for bucket in (self.upload, self.download):
+            if bucket.rules or bucket.default:
+                logger.info(f"{bucket.name.capitalize()} limit {formatRate(bucket.rate)}")
+
+    def stats(self):
+        return {'upload': self.upload.stats(), 'download': self.download.stats()}
+
+    def close(self):
+        self.upload.close()
+        self.download.close()
+# EOF
@@ -0,0 +1,316 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import time
+from concurrent.futures import Future
+from threading import Thread, Condition, Lock
+
+# Dropbox library
+import dropbox
+import requests
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Maximum number of entries in a batch
+BATCH_SIZE = 1000
+# Maximum time in seconds an operation waits to be committed
+BATCH_DEADLINE = 2.0
+# Maximum interval in seconds between two checks of the batch job
+POLL_MAX_INTERVAL = 2.0
+# Failure of an entry that can be committed again
+TOO_MANY_WRITES = 'too_many_write_operations'
+
+
+class BatchError(Exception):
+    """ An entry of a batch was not committed.
+    """
+
+    def __init__(self, path, error):
+        super().__init__(f"{path}: {error}")
+        self.path = path
+        self.error = error
+
+
+def chain(source, target):
+    """ Copy the result of a Future in another Future.
+    """
+    def done(future):
+        err = future.exception()
+        if err is not None:
+            target.set_exception(err)
+        else:
+            target.set_result(future.result())
+    source.add_done_callback(done)
+
+
+def isAncestor(parent, path):
+    """ Check if path is parent or inside parent, case insensitive.
+    """
+    parent, path = parent.lower(), path.lower()
+    return path == parent or path.startswith(parent + "/")
+
+
+class Batcher(Thread):
+    """ Collect operations and commit them together.
+
+        The commit is done when batch_size operations are pending or
+        after deadline seconds. For each operation a Future is returned
+        with the result or a BatchError. If latency is set the duration
+        of each commit is observed in the histogram with the operation label.
+    """
+
+    # Label of the commits in the latency histogram
+    operation = 'batch'
+
+    def __init__(self, dbx, batch_size=BATCH_SIZE, deadline=BATCH_DEADLINE, latency=None):
+        Thread.__init__(self, daemon=True)
+        self.dbx = dbx
+        self.batch_size = max(1, min(int(batch_size), BATCH_SIZE))
+        self.deadline = float(deadline)
+        self.latency = latency
+        self._pending = []
+        self._first = None
+        self._cond = Condition()
+        # Batches must be committed serially
+        self._commit_lock = Lock()
+        self._stopped = False
+
+    def _add(self, arg, future):
+        """ Queue an operation, must be called with the condition locked.
+        """
+        if not self._pending:
+            self._first = time.time()
+        self._pending.append((arg, future))
+        # Wake up the committer to start the deadline or commit a full batch
+        if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+            self._cond.notify()
+
+    def _take(self):
+        batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+        self._first = time.time() if self._pending else None
+        return batch
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if len(self._pending) >= self.batch_size:
+                        break
+                    if self._pending and time.time() - self._first >= self.deadline:
+                        break
+                    self._cond.wait(self._first + self.deadline - time.time() if self._pending else None)
+                if self._stopped and not self._pending:
+                    return
+                batch = self._take()
+            self.commit(batch)
+
+    def flush(self):
+        """ Commit all pending operations now.
+        """
+        while True:
+            with self._cond:
+                batch = self._take()
+            if not batch:
+                return
+            self.commit(batch)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self.is_alive():
+            self.join()
+        # Commit left operations if the thread is not running
+        self.flush()
+
+    def commit(self, batch):
+        """ Commit a list of (arg, Future) and wait the end of the job.
+        """
+        if not batch:
+            return
+        try:
+            with self._commit_lock:
+                t0 = time.time()
+                try:
+                    result = self.launch([arg for arg, _ in batch])
+                finally:
+                    if self.latency is not None:
+                        self.latency.observe(time.time() - t0, self.operation)
+                logger.debug(f"{self.__class__.__name__} committed {len(batch)} entries in {(time.time() - t0):.3f}s")
+        except (dropbox.exceptions.ApiError, dropbox.exceptions.HttpError, requests.exceptions.RequestException) as err:
+            logger.error(f"Batch commit of {len(batch)} entries failed: {err}")
+            for _, future in batch:
+                future.set_exception(err)
+            return
+        if result is None:
+            for arg, future in batch:
+                future.set_exception(BatchError(self.path(arg), "batch not completed"))
+            return
+        throttled = []
+        for (arg, future), entry in zip(batch, result.entries):
+            if entry.is_success():
+                future.set_result(entry.get_success())
+            elif TOO_MANY_WRITES in str(entry.get_failure()):
+                throttled.append((arg, future))
+            else:
+                future.set_exception(BatchError(self.path(arg), entry.get_failure()))
+        if throttled:
+            # Not committed for the write limits, queued for the next batch
+            logger.warning(f"{len(throttled)} entries throttled, queued again")
+            with self._cond:
+                for arg, future in throttled:
+                    self._add(arg, future)
+
+    def launch(self, entries):
+        """ Launch the batch job and return its complete result or None.
+        """
+        raise NotImplementedError
+
+    def path(self, arg):
+        raise NotImplementedError
+
+    def wait(self, check, async_job_id):
+        """ Poll the batch job until it is complete.
+            Return the complete result or None if failed.
+        """
+        interval = 0.1
+        while True:
+            status = check(async_job_id)
+            if status.is_complete():
+                return status.get_complete()
+            if not status.is_in_progress():
+                logger.error(f"Batch job {async_job_id} failed: {status}")
+                return None
+            time.sleep(interval)
+            interval = min(interval * 2, POLL_MAX_INTERVAL)
+
+    def result(self, launch, check):
+        if launch.is_async_job_id():
+            return self.wait(check, launch.get_async_job_id())
+        if launch.is_complete():
+            return launch.get_complete()
+        logger.error(f"Batch job failed: {launch}")
+        return None
+
+
+class UploadBatcher(Batcher):
+    """ Collect the uploads of small files and commit them together
+        with files_upload_session_finish_batch.
+
+        Each file is uploaded in its own closed upload session,
+        the Future returns the committed FileMetadata.
+    """
+
+    operation = 'upload_batch'
+
+    def submit(self, data, commit):
+        """ Upload data and queue the commit.
+            Return a Future with the committed FileMetadata.
+        """
+        future = Future()
+        session = self.dbx.files_upload_session_start(data, close=True)
+        cursor = dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=len(data))
+        with self._cond:
+            self._add(dropbox.files.UploadSessionFinishArg(cursor=cursor, commit=commit), future)
+        return future
+
+    def launch(self, entries):
+        launch = self.dbx.files_upload_session_finish_batch(entries)
+        return self.result(launch, self.dbx.files_upload_session_finish_batch_check)
+
+    def path(self, arg):
+        return arg.commit.path
+
+
+class DeleteBatcher(Batcher):
+    """ Collect the deletes and commit them together with files_delete_batch.
+
+        A delete inside a folder already queued is dropped,
+        the Future returns the DeleteBatchResultData.
+    """
+
+    operation = 'delete_batch'
+
+    def submit(self, path):
+        future = Future()
+        with self._cond:
+            for arg, queued in self._pending:
+                if isAncestor(arg.path, path):
+                    # Already deleted with the parent folder
+                    return queued
+            children = [(arg, queued) for arg, queued in self._pending if isAncestor(path, arg.path)]
+            if children:
+                self._pending = [item for item in self._pending if item not in children]
+                for _, queued in children:
+                    chain(future, queued)
+            self._add(dropbox.files.DeleteArg(path), future)
+        return future
+
+    def launch(self, entries):
+        launch = self.dbx.files_delete_batch(entries)
+        return self.result(launch, self.dbx.files_delete_batch_check)
+
+    def path(self, arg):
+        return arg.path
+
+
+class MoveBatcher(Batcher):
+    """ Collect the moves and commit them together with files_move_batch_v2.
+
+        A move inside a folder already moved is dropped,
+        the Future returns the RelocationBatchResultEntry success metadata.
+    """
+
+    operation = 'move_batch'
+
+    def submit(self, from_path, to_path):
+        future = Future()
+        with self._cond:
+            for arg, queued in self._pending:
+                if self.covers(arg.from_path, arg.to_path, from_path, to_path):
+                    # Already moved with the parent folder
+                    return queued
+            children = [(arg, queued) for arg, queued in self._pending
+                        if self.covers(from_path, to_path, arg.from_path, arg.to_path)]
+            if children:
+                self._pending = [item for item in self._pending if item not in children]
+                for _, queued in children:
+                    chain(future, queued)
+            self._add(dropbox.files.RelocationPath(from_path, to_path), future)
+        return future
+
+    @staticmethod
+    def covers(parent_from, parent_to, from_path, to_path):
+        """ Check if the move of a parent folder moves also from_path in to_path.
+        """
+        if not isAncestor(parent_from, from_path) or not isAncestor(parent_to, to_path):
+            return False
+        return from_path[len(parent_from):].lower() == to_path[len(parent_to):].lower()
+
+    def launch(self, entries):
+        launch = self.dbx.files_move_batch_v2(entries)
+        return self.result(launch, self.dbx.files_move_batch_check_v2)
+
+    def path(self, arg):
+        return arg.from_path
+# EOF
@@ -0,0 +1,250 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import random
+import time
+from threading import Condition
+
+# Dropbox library
+import dropbox
+import requests
+import urllib3
+
+from .batch import TOO_MANY_WRITES
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Maximum number of requests in flight
+CONCURRENCY = 16
+# Maximum number of retries for a request
+RETRIES = 6
+# Base and maximum backoff in seconds
+BACKOFF = 0.5
+BACKOFF_MAX = 60.0
+# Backoff if the server does not set retry_after
+RATE_LIMIT_BACKOFF = 5.0
+# Routes that can be repeated without change the result
+IDEMPOTENT = {
+    'files_list_folder',
+    'files_list_folder_continue',
+    'files_list_folder_get_latest_cursor',
+    'files_list_folder_longpoll',
+    'files_get_metadata',
+    'files_download',
+    'files_upload_session_start',
+    'files_upload_session_append_v2',
+    'files_upload_session_finish_batch_check',
+    'files_delete_batch_check',
+    'files_move_batch_check_v2',
+}
+# Writes repeated after a timeout, the error of a write already applied is a success
+REPEATABLE = {'files_create_folder', 'files_delete'}
+# Routes not counted in the concurrency, they wait on the server for a long time
+UNLIMITED = {'files_list_folder_longpoll'}
+
+
+def isThrottled(err):
+    """ Check if an error is a request of the server to slow down.
+    """
+    if isinstance(err, dropbox.exceptions.RateLimitError):
+        return True
+    if isinstance(err, dropbox.exceptions.ApiError):
+        return TOO_MANY_WRITES in str(err.error)
+    return False
+
+
+def isTransient(err):
+    """ Check if a failed request can succeed if repeated.
+    """
+    return isinstance(err, (dropbox.exceptions.InternalServerError,
+                            requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout))
+
+
+def isNotSent(err):
+    """ Check if a request failed before it was sent, the connection was not opened.
+    """
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(err, requests.exceptions.ConnectionError) or not err.args:
+        return False
+    # requests wraps the urllib3 MaxRetryError of the connection
+    reason = getattr(err.args[0], 'reason', err.args[0])
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def isIdempotent(name, args, kwargs):
+    """ Check if a request can be repeated without change the result.
+        An upload is repeated only if it overwrites the file.
+    """
+    if name == 'files_upload':
+        mode = kwargs.get('mode', args[2] if len(args) > 2 else None)
+        return mode is not None and mode.is_overwrite()
+    return name in IDEMPOTENT
+
+
+def isApplied(name, err):
+    """ Check if the error of a repeated write shows that the first one was applied:
+        the folder already exists or the file is already deleted.
+    """
+    if not isinstance(err, dropbox.exceptions.ApiError):
+        return False
+    if name == 'files_create_folder':
+        return err.error.is_path() and err.error.get_path().is_conflict() and err.error.get_path().get_conflict().is_folder()
+    if name == 'files_delete':
+        return err.error.is_path_lookup() and err.error.get_path_lookup().is_not_found()
+    return False
+
+
+class RateLimitedClient:
+    """ Wrap a Dropbox client and retry the throttled and failed requests.
+
+        A throttled request is always retried after the retry_after of the
+        server, the transient errors are retried with a jittered exponential
+        backoff only for the idempotent routes, the writes in REPEATABLE and
+        the requests not sent. The number of requests in flight
+        is adapted AIMD-style: increased by one for each window of successful
+        requests and halved on throttling.
+    """
+
+    def __init__(self, dbx, concurrency=CONCURRENCY, retries=RETRIES):
+        self.dbx = dbx
+        self.concurrency = max(1, int(concurrency))
+        self.retries = max(0, int(retries))
+        self.limit = float(self.concurrency)
+        self.inflight = 0
+        # No request is sent before this time
+        self._resume = 0.0
+        self._decreased = 0.0
+        self._cond = Condition()
+        # Counters
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.retried = 0
+        self.failed = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.dbx, name)
+        if not callable(attr) or not name.startswith(('files_', 'users_')):
+            return attr
+
+        def call(*args, **kwargs):
+            return self.request(name, attr, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+    def withHeaders(self, name, headers):
+        """ Route of a copy of the client sending extra HTTP headers, e.g. Range,
+            limited and retried like the other requests.
+        """
+        func = getattr(self.dbx.clone(headers=headers), name)
+
+        def call(*args, **kwargs):
+            return self.request(name, func, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+    def stats(self):
+        with self._cond:
+            return {'limit': int(self.limit), 'inflight': self.inflight, 'requests': self.requests, 'errors': self.errors,
+                    'throttled': self.throttled, 'retried': self.retried, 'failed': self.failed}
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                delay = self._resume - time.time()
+                if delay <= 0 and self.inflight < int(self.limit):
+                    break
+                self._cond.wait(delay if delay > 0 else None)
+            self.inflight += 1
+
+    def release(self, throttled=False, backoff=0.0):
+        with self._cond:
+            self.inflight -= 1
+            now = time.time()
+            if throttled:
+                self._resume = max(self._resume, now + backoff)
+                # Halve once for all the requests throttled in the same window
+                if now > self._decreased:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._decreased = now + backoff
+                    logger.warning(f"Throttled, max {int(self.limit)} requests in flight for {backoff:.1f}s")
+            else:
+                self.limit = min(float(self.concurrency), self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def backoff(self, attempt):
+        """ Full jitter exponential backoff.
+        """
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF * 2 ** attempt))
+
+    def request(self, name, func, *args, **kwargs):
+        """ Call a route of the Dropbox client, retried on throttling and transient errors.
+            Return None for a write in REPEATABLE already applied by a request timed out.
+        """
+        limited = name not in UNLIMITED
+        idempotent = isIdempotent(name, args, kwargs)
+        attempt = 0
+        # A request failed after it was sent may be applied
+        sent = False
+        while True:
+            if limited:
+                self.acquire()
+            throttled, backoff = False, 0.0
+            try:
+                with self._cond:
+                    self.requests += 1
+                return func(*args, **kwargs)
+            except (dropbox.exceptions.ApiError, dropbox.exceptions.HttpError,
+                    requests.exceptions.RequestException) as err:
+                attempt += 1
+                with self._cond:
+                    self.errors += 1
+                if sent and isApplied(name, err):
+                    logger.info(f"{name} already applied: {err}")
+                    return None
+                if isThrottled(err):
+                    throttled = True
+                    retry_after = getattr(err, 'backoff', None)
+                    backoff = (retry_after if retry_after is not None else RATE_LIMIT_BACKOFF) + random.uniform(0, 1)
+                    with self._cond:
+                        self.throttled += 1
+                elif isTransient(err) and (idempotent or name in REPEATABLE or isNotSent(err)):
+                    sent = sent or not isNotSent(err)
+                    backoff = self.backoff(attempt)
+                else:
+                    raise
+                if attempt > self.retries and not throttled:
+                    with self._cond:
+                        self.failed += 1
+                    logger.error(f"{name} failed after {attempt} attempts: {err}")
+                    raise
+                with self._cond:
+                    self.retried += 1
+                logger.info(f"{name} retry {attempt} in {backoff:.1f}s: {err}")
+            finally:
+                if limited:
+                    self.release(throttled, backoff)
+            time.sleep(backoff)
+# EOF
@@ -0,0 +1,61 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+
+# Separator of the path components in a key, lower than any character of a name
+SEPARATOR = "\0"
+
+
+def sortKey(path):
+    """ Key of a path relative to the synchronized folder, e.g. "/Sub/Name.txt" -> "sub\0name.txt"
+
+        Dropbox is case insensitive and the components are separated with the
+        lowest character, the keys are sorted like a depth-first walk with
+        the entries of each folder sorted by name.
+    """
+    return path.replace(os.sep, "/").strip("/").lower().replace("/", SEPARATOR)
+
+
+def mergeJoin(local, remote):
+    """ Join two streams of (key, item) sorted by key in a single pass.
+
+        Generate (key, local item, remote item) with None for the side
+        without the key. Only the head of each stream is kept in memory.
+    """
+    end = object()
+    local, remote = iter(local), iter(remote)
+    local_key, local_item = next(local, (end, None))
+    remote_key, remote_item = next(remote, (end, None))
+    while local_key is not end or remote_key is not end:
+        if remote_key is end or (local_key is not end and local_key < remote_key):
+            yield local_key, local_item, None
+            local_key, local_item = next(local, (end, None))
+        elif local_key is end or remote_key < local_key:
+            yield remote_key, None, remote_item
+            remote_key, remote_item = next(remote, (end, None))
+        else:
+            yield local_key, local_item, remote_item
+            local_key, local_item = next(local, (end, None))
+            remote_key, remote_item = next(remote, (end, None))
+# EOF
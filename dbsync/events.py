@@ -0,0 +1,255 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import os
+import time
+from threading import Thread, Event, Lock
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Seconds a path must be stable before to be synchronized
+QUIET = 1.0
+# Event types
+CREATED = "created"
+MODIFIED = "modified"
+DELETED = "deleted"
+MOVED = "moved"
+
+
+def fileStat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class Pending:
+    """ Final action for a path, merged from all received events.
+    """
+
+    __slots__ = ('action', 'path', 'src', 'is_directory', 'modified', 'updated', 'stat', 'identity', 'identified')
+
+    def __init__(self, action, path, is_directory=False, src=None, modified=False):
+        self.action = action
+        self.path = path
+        self.src = src
+        self.is_directory = is_directory
+        # Moved path modified after the move
+        self.modified = modified
+        self.updated = time.time()
+        self.stat = None if is_directory else fileStat(path)
+        # Identity of a deleted file, resolved once
+        self.identity = None
+        self.identified = False
+
+    def __repr__(self):
+        src = f"{self.src} -> " if self.src else ""
+        return f"Pending({self.action} {src}{self.path})"
+
+
+class EventCoalescer(Thread):
+    """ Collapse the bursts of watchdog events on the same path.
+
+        Each path is dispatched only when no event is received for quiet seconds
+        and its size and mtime are stable, sequences like create, modify and move
+        are merged in a single final action.
+        With a matcher the deleted files wait window seconds more, a file created
+        in another path and matched with a deleted one is dispatched as a move.
+        The identity of each deleted file is resolved once from identify, only
+        for the files without a known size or with the size of a created file.
+        The deletes inside a folder deleted are dropped with the folder delete.
+    """
+
+    def __init__(self, callback, quiet=QUIET, matcher=None, identify=None, window=0.0):
+        Thread.__init__(self, daemon=True)
+        self.callback = callback
+        self.quiet = float(quiet)
+        self.matcher = matcher
+        self.identify = identify
+        self.window = float(window) if matcher is not None else 0.0
+        self._pending = {}
+        self._lock = Lock()
+        self._stopped = Event()
+        # Statistics
+        self.received = 0
+        self.dispatched = 0
+        self.renamed = 0
+
+    def push(self, action, path, is_directory=False, src=None):
+        """ Add a watchdog event. For MOVED the path is the destination.
+        """
+        with self._lock:
+            self.received += 1
+            if action == MOVED:
+                pending = self._merge_moved(path, src, is_directory)
+            else:
+                pending = self._merge(self._pending.pop(path, None), action, path, is_directory)
+            if pending is not None:
+                self._pending[pending.path] = pending
+        if self.quiet <= 0:
+            self.flush()
+
+    def _merge(self, old, action, path, is_directory):
+        if old is None:
+            return Pending(action, path, is_directory)
+        if action == DELETED:
+            if old.action == CREATED:
+                # Never synchronized
+                return None
+            if old.action == MOVED:
+                return Pending(DELETED, old.src, is_directory)
+            pending = Pending(DELETED, path, is_directory)
+            # Last size known of the file
+            pending.stat = old.stat
+            return pending
+        if old.action == DELETED:
+            # Replaced with a new file
+            return Pending(MODIFIED, path, is_directory)
+        if old.action == MOVED:
+            return Pending(MOVED, path, is_directory, src=old.src, modified=True)
+        # Created or modified stay the same
+        return Pending(old.action, path, is_directory)
+
+    def _merge_moved(self, path, src, is_directory):
+        old = self._pending.pop(src, None)
+        # The destination is overwritten by the move
+        self._pending.pop(path, None)
+        if old is None:
+            return Pending(MOVED, path, is_directory, src=src)
+        if old.action == CREATED:
+            # Never synchronized, upload only the destination
+            return Pending(CREATED, path, is_directory)
+        if old.action == MOVED:
+            return Pending(MOVED, path, is_directory, src=old.src, modified=old.modified)
+        if old.action == MODIFIED:
+            return Pending(MOVED, path, is_directory, src=src, modified=True)
+        # Deleted and moved on the same source, keep both
+        self._pending[src] = old
+        return Pending(MOVED, path, is_directory, src=src)
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def ready(self, now=None):
+        """ Pop all pending actions stable for the quiet window.
+        """
+        now = time.time() if now is None else now
+        ready = []
+        with self._lock:
+            for path, pending in list(self._pending.items()):
+                if now - pending.updated < self.quiet:
+                    continue
+                if pending.action == DELETED and not pending.is_directory and now - pending.updated < self.quiet + self.window:
+                    # Wait a create of the same file in another path
+                    continue
+                if pending.action != DELETED and not pending.is_directory:
+                    stat = fileStat(path)
+                    if stat != pending.stat:
+                        # Still writing
+                        pending.stat = stat
+                        pending.updated = now
+                        continue
+                ready.append(self._pending.pop(path))
+            folders = tuple(pending.path + os.sep for pending in ready if pending.action == DELETED and pending.is_directory)
+            if folders:
+                # Deleted with the folder
+                for path in [path for path, pending in self._pending.items()
+                             if pending.action == DELETED and path.startswith(folders)]:
+                    del self._pending[path]
+                ready = [pending for pending in ready if pending.action != DELETED or not pending.path.startswith(folders)]
+        return ready
+
+    def pair(self, ready):
+        """ Replace the files created and the files deleted matched
+            from the matcher with a single move.
+        """
+        created = [pending for pending in ready if pending.action == CREATED and not pending.is_directory and pending.stat is not None]
+        if self.matcher is None or self.identify is None or not created:
+            return ready
+        with self._lock:
+            deleted = [pending for pending in self._pending.values() if pending.action == DELETED and not pending.is_directory]
+        deleted += [pending for pending in ready if pending.action == DELETED and not pending.is_directory]
+        sizes = set(pending.stat[0] for pending in created)
+        identities = []
+        # The identify and the matcher can query Dropbox or hash the files, called without the lock
+        for pending in deleted:
+            if pending.stat is not None and pending.stat[0] not in sizes:
+                continue
+            if not pending.identified:
+                pending.identity = self.identify(pending.path)
+                pending.identified = True
+            if pending.identity is not None and pending.identity[0] in sizes:
+                identities.append((pending.path,) + tuple(pending.identity))
+        if not identities:
+            return ready
+        renames = dict((dest, src) for src, dest in self.matcher(identities, [pending.path for pending in created]))
+        if not renames:
+            return ready
+        sources = set(renames.values())
+        with self._lock:
+            for src in sources:
+                if src in self._pending and self._pending[src].action == DELETED:
+                    del self._pending[src]
+        paired = []
+        for pending in ready:
+            if pending.action == DELETED and pending.path in sources:
+                continue
+            if pending.action == CREATED and pending.path in renames:
+                self.renamed += 1
+                logger.debug(f"Rename detected {renames[pending.path]} -> {pending.path}")
+                pending = Pending(MOVED, pending.path, src=renames[pending.path])
+            paired.append(pending)
+        return paired
+
+    def dispatch(self, ready):
+        for pending in self.pair(ready):
+            self.dispatched += 1
+            try:
+                self.callback(pending)
+            except Exception as err:
+                logger.error(f"Dispatch {pending} failed: {err}")
+
+    def flush(self):
+        """ Dispatch now all pending actions.
+        """
+        with self._lock:
+            ready = list(self._pending.values())
+            self._pending.clear()
+        self.dispatch(ready)
+
+    def run(self):
+        while not self._stopped.wait(max(self.quiet / 4, 0.05)):
+            ready = self.ready()
+            if ready:
+                self.dispatch(ready)
+                logger.debug(f"Events {self.received} received, {self.dispatched} dispatched")
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+# EOF
@@ -0,0 +1,157 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Dropbox content hash block size
+# https://www.dropbox.com/developers/reference/content-hash
+BLOCK_SIZE = 4 * 1024 * 1024
+# Files bigger than this size are hashed with a process pool
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+
+
+def hash_blocks(path, start, stop, size):
+    """ Return the SHA-256 digests of the blocks from start to stop of a file of size bytes.
+        Raise OSError if the file is truncated while it is read.
+    """
+    digests = []
+    # A single buffer reused for all blocks
+    buffer = bytearray(BLOCK_SIZE)
+    with open(path, 'rb') as f, memoryview(buffer) as view:
+        f.seek(start * BLOCK_SIZE)
+        for block in range(start, stop):
+            expected = min(BLOCK_SIZE, size - block * BLOCK_SIZE)
+            read = f.readinto(view[:expected])
+            if read != expected:
+                raise OSError(f"{path} truncated while hashed")
+            digests.append(hashlib.sha256(view[:read]).digest())
+    return digests
+
+
+def content_hash(path, pool=None, workers=1):
+    """ Compute the Dropbox content_hash of a local file.
+
+        The file is read in blocks of 4MB, each block is hashed
+        with SHA-256 and the final hash is the SHA-256 of all block digests.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return hashlib.sha256(b"").hexdigest()
+    blocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    if pool is not None and workers > 1 and size >= PARALLEL_THRESHOLD:
+        # Split the blocks in ranges for each worker
+        step = (blocks + workers - 1) // workers
+        ranges = [(start, min(start + step, blocks)) for start in range(0, blocks, step)]
+        futures = [pool.submit(hash_blocks, path, start, stop, size) for start, stop in ranges]
+        digests = [digest for future in futures for digest in future.result()]
+    else:
+        digests = hash_blocks(path, 0, blocks, size)
+    return hashlib.sha256(b"".join(digests)).hexdigest()
+
+
+class ContentHasher:
+    """ Content hash engine with a cache keyed on (inode, size, mtime_ns).
+
+        An unchanged file is never hashed twice. The hash of a file just
+        synced with Dropbox is kept also as its known remote content.
+    """
+
+    def __init__(self, workers=None, cache_size=100000):
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._synced = OrderedDict()
+        self._lock = Lock()
+        self._pool = None
+        self.hits = 0
+        self.misses = 0
+
+    def _getPool(self):
+        with self._lock:
+            if self._pool is None and self.workers > 1:
+                # The workers only read and hash files, mp_context needs Python 3.7
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def cached(self, stat):
+        """ Return the cached hash for a (size, mtime_ns, inode) stat or None.
+        """
+        size, mtime_ns, inode = stat
+        key = (inode, size, mtime_ns)
+        with self._lock:
+            value = self._cache.get(key)
+            if value is not None:
+                self._cache.move_to_end(key)
+        return value
+
+    def store(self, stat, value):
+        with self._lock:
+            self._put(self._cache, stat, value)
+
+    def _put(self, cache, stat, value):
+        size, mtime_ns, inode = stat
+        cache[(inode, size, mtime_ns)] = value
+        cache.move_to_end((inode, size, mtime_ns))
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def markSynced(self, stat, value):
+        """ Store the content hash of a file just downloaded or uploaded.
+        """
+        with self._lock:
+            self._put(self._cache, stat, value)
+            self._put(self._synced, stat, value)
+
+    def synced(self, stat):
+        """ Return the remote content hash of an unchanged synced file or None.
+        """
+        size, mtime_ns, inode = stat
+        with self._lock:
+            return self._synced.get((inode, size, mtime_ns))
+
+    def hash(self, path, stat):
+        """ Return the content_hash of a file with the given (size, mtime_ns, inode) stat.
+        """
+        value = self.cached(stat)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        pool = self._getPool() if stat[0] >= PARALLEL_THRESHOLD else None
+        value = content_hash(path, pool=pool, workers=self.workers)
+        self.store(stat, value)
+        logger.debug(f"Hash {path}: {value}")
+        return value
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+# EOF
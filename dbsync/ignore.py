@@ -0,0 +1,219 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import os
+import re
+from functools import lru_cache
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Folders with the ignore result cached
+CACHE_SIZE = 65536
+# Paths with a separator different from '/' are converted before the match
+ALT_SEP = os.path.sep if os.path.sep != '/' else None
+# Characters of a glob that are not a literal
+WILDCARDS = set('*?[\\')
+
+
+def translate(pattern, name=False):
+    """ Translate a gitignore glob in a regex body for a relative path.
+
+        '*' and '?' never match '/', '**' matches any number of folders.
+        A regex for a name without '/' uses the faster '.*' and '.'.
+    """
+    star, single = ('.*', '.') if name else ('[^/]*', '[^/]')
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i + 3] == '**/':
+                res.append('(?:.*/)?')
+                i += 3
+                continue
+            if pattern[i:i + 2] == '**':
+                res.append('.*')
+                i += 2
+                continue
+            res.append(star)
+        elif c == '?':
+            res.append(single)
+        elif c == '[':
+            j = pattern.find(']', i + 2 if pattern[i + 1:i + 2] in ('!', '^', ']') else i + 1)
+            if j < 0:
+                res.append('\\[')
+            else:
+                body = pattern[i + 1:j].replace('\\', '\\\\')
+                if body[0] in ('!', '^'):
+                    body = '^' + body[1:]
+                res.append(f'[{body}]')
+                i = j
+        elif c == '\\' and i + 1 < n:
+            res.append(re.escape(pattern[i + 1]))
+            i += 1
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return ''.join(res)
+
+
+class Rule:
+
+    __slots__ = ('pattern', 'glob', 'regex', 'negate', 'dir_only', 'anchored')
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.negate = pattern.startswith('!')
+        if self.negate:
+            pattern = pattern[1:]
+        elif pattern.startswith('\\!') or pattern.startswith('\\#'):
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        # A slash at the beginning or in the middle anchor the pattern to the root,
+        # otherwise the pattern is matched only on the last part of the path
+        self.anchored = '/' in pattern
+        self.glob = pattern.lstrip('/')
+        self.regex = '(?s:' + translate(pattern.lstrip('/'), name=not self.anchored) + r')\Z'
+
+
+class IgnoreMatcher:
+    """ Compiled matcher of a .dropboxignore file with gitignore-like semantics.
+
+        Supports anchored paths, directory-only rules ending with '/' and
+        negations with '!'. A path is ignored also if one of its folders is
+        ignored, the result for the folders used recently is cached in a
+        bounded LRU so a whole subtree is excluded with a single lookup.
+        The entries of a folder already accepted, e.g. while walking the tree,
+        are checked with matchName without looking at the folders again.
+    """
+
+    def __init__(self, patterns=()):
+        self.rules = []
+        for line in patterns:
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            self.rules.append(Rule(line))
+        self.patterns = [rule.pattern for rule in self.rules]
+        self._negate = any(rule.negate for rule in self.rules)
+        if self._negate:
+            # The last matching rule wins
+            self._compiled = [(re.compile(rule.regex), rule.anchored, rule.negate, rule.dir_only) for rule in reversed(self.rules)]
+        else:
+            # Without negations the names are matched with a set of names, the suffixes
+            # of the patterns like '*.ext' and a single regex for the other patterns,
+            # the paths with one regex, for files and for folders
+            self._files = self._compile(rule for rule in self.rules if not rule.dir_only)
+            self._dirs = self._compile(self.rules)
+        self._excludesTree = lru_cache(maxsize=CACHE_SIZE)(self._matchTree)
+
+    @staticmethod
+    def _compile(rules):
+        literals, suffixes, names, paths = set(), [], [], []
+        for rule in rules:
+            if rule.anchored:
+                paths.append(rule.regex)
+            elif not WILDCARDS.intersection(rule.glob):
+                literals.add(rule.glob)
+            elif rule.glob.startswith('*') and not WILDCARDS.intersection(rule.glob[1:]):
+                suffixes.append(rule.glob[1:])
+            else:
+                names.append(rule.regex)
+        return (literals, tuple(suffixes), re.compile('|'.join(names)) if names else None,
+                re.compile('|'.join(paths)) if paths else None)
+
+    @staticmethod
+    def _matchName(compiled, name):
+        literals, suffixes, names, _ = compiled
+        return name in literals or name.endswith(suffixes) or (names is not None and names.match(name) is not None)
+
+    @classmethod
+    def load(cls, path):
+        """ Load a .dropboxignore file, an empty matcher if it does not exist.
+        """
+        patterns = []
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                patterns = f.read().splitlines()
+        return cls(patterns)
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def _matchSelf(self, path, name, is_dir):
+        if self._negate:
+            for regex, anchored, negate, dir_only in self._compiled:
+                if dir_only and not is_dir:
+                    continue
+                if regex.match(path if anchored else name):
+                    return not negate
+            return False
+        compiled = self._dirs if is_dir else self._files
+        return self._matchName(compiled, name) or (compiled[3] is not None and compiled[3].match(path) is not None)
+
+    def _matchTree(self, path):
+        parent, _, name = path.rpartition('/')
+        return (bool(parent) and self._excludesTree(parent)) or self._matchSelf(path, name, True)
+
+    def excludesTree(self, path):
+        """ Check if a folder and all its content are ignored.
+        """
+        path = path.strip('/')
+        if not self.rules or not path:
+            return False
+        return self._excludesTree(path)
+
+    def matchName(self, parent, name, is_dir=False):
+        """ Check if an entry of a folder not ignored is ignored.
+            Only the rules on the name are matched, the path is built only for
+            the rules anchored to the root or with negations.
+        """
+        if not self.rules:
+            return False
+        if not self._negate:
+            compiled = self._dirs if is_dir else self._files
+            if compiled[3] is None:
+                return self._matchName(compiled, name)
+        if ALT_SEP:
+            parent = parent.replace(ALT_SEP, '/')
+        parent = parent.strip('/')
+        return self._matchSelf(f"{parent}/{name}" if parent else name, name, is_dir)
+
+    def match(self, path, is_dir=False):
+        """ Check if a path relative to the synchronized folder is ignored.
+        """
+        if not self.rules:
+            return False
+        if ALT_SEP:
+            path = path.replace(ALT_SEP, '/')
+        path = path.strip('/')
+        if not path:
+            return False
+        if is_dir:
+            return self._excludesTree(path)
+        parent, _, name = path.rpartition('/')
+        if parent and self._excludesTree(parent):
+            return True
+        return self._matchSelf(path, name, False)
+# EOF
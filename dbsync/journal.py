@@ -0,0 +1,275 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import sqlite3
+import time
+from collections import namedtuple
+from threading import Lock
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Local changes stored in the journal
+OP_UPLOAD = 'upload'
+OP_DELETE = 'delete'
+OP_MOVE = 'move'
+# Seconds a folder delete applied drops the deletes of its content received later
+RECENT_DELETES = 60.0
+# Single operation waiting to be applied in Dropbox
+Operation = namedtuple('Operation', ['seq', 'action', 'path', 'src', 'is_dir', 'overwrite', 'queued', 'attempts'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    key TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    path TEXT NOT NULL,
+    src TEXT,
+    is_dir INTEGER,
+    overwrite INTEGER,
+    queued REAL,
+    attempts INTEGER
+);
+CREATE INDEX IF NOT EXISTS journal_seq ON journal (seq);
+"""
+
+
+class Journal:
+    """ Durable log of the local changes not yet applied in Dropbox.
+
+        Each change is stored before to be attempted and removed only when
+        Dropbox has applied it, the changes on the same path are coalesced in
+        a single operation and replayed in order of arrival.
+        Paths are relative to the synchronized folder, e.g. "/sub/name.txt".
+        Without a path the journal is a temporary file removed on close.
+        A delete inside a folder deleted, pending or applied in the last
+        RECENT_DELETES seconds, is dropped.
+    """
+
+    def __init__(self, path=""):
+        self.path = path
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if path:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        row = self._db.execute("SELECT MAX(seq) FROM journal").fetchone()
+        self._seq = row[0] or 0
+        self._added = []
+        # Folders deleted in Dropbox recently, key -> time
+        self._deleted = {}
+        if len(self):
+            logger.info(f"{len(self)} local changes not applied in Dropbox loaded from the journal")
+
+    @staticmethod
+    def key(path):
+        return path.lower()
+
+    def __len__(self):
+        with self._lock:
+            if self._db is None:
+                return 0
+            return self._db.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+
+    def add(self, action, path, src=None, is_dir=False, overwrite=False):
+        """ Store a local change, merged with the operations pending on the same paths.
+            For OP_MOVE path is the destination.
+            Return the list of the operations stored.
+        """
+        with self._lock:
+            if self._db is None:
+                return []
+            self._added = []
+            if action == OP_DELETE and self._deletedParent(path):
+                return []
+            if action != OP_DELETE:
+                # Created again after the delete of a folder
+                self._revive(path)
+            old = self._get(path)
+            if action == OP_MOVE:
+                self._move(src, path, is_dir)
+            elif action == OP_DELETE:
+                if old is not None and old.action == OP_MOVE:
+                    # The move is not applied, the source is still in Dropbox
+                    self._forget(old.src, old.is_dir)
+                if is_dir:
+                    self._drop(path, children=True)
+                self._put(OP_DELETE, path, is_dir=is_dir)
+            else:
+                if old is not None and old.action == OP_MOVE:
+                    # Moved and changed, upload the new content
+                    self._forget(old.src, old.is_dir)
+                    overwrite = True
+                elif old is not None:
+                    overwrite = overwrite or old.overwrite or old.action == OP_DELETE
+                self._put(OP_UPLOAD, path, is_dir=is_dir, overwrite=overwrite)
+            self._db.commit()
+            return [op for op in self._added if self._get(op.path) == op]
+
+    def _deletedParent(self, path):
+        """ Check if a parent folder of path is deleted, pending or applied recently.
+        """
+        now = time.time()
+        self._deleted = {key: deleted for key, deleted in self._deleted.items() if now - deleted < RECENT_DELETES}
+        parent = path.rpartition("/")[0]
+        while parent:
+            if self.key(parent) in self._deleted:
+                return True
+            op = self._get(parent)
+            if op is not None and op.action == OP_DELETE:
+                return True
+            parent = parent.rpartition("/")[0]
+        return False
+
+    def _revive(self, path):
+        key = self.key(path)
+        for deleted in [deleted for deleted in self._deleted if key == deleted or key.startswith(deleted + "/")]:
+            del self._deleted[deleted]
+
+    def _get(self, path):
+        row = self._db.execute("SELECT seq, action, path, src, is_dir, overwrite, queued, attempts FROM journal WHERE key = ?",
+                               (self.key(path),)).fetchone()
+        return Operation(*row) if row else None
+
+    def _put(self, action, path, src=None, is_dir=False, overwrite=False):
+        self._seq += 1
+        op = Operation(self._seq, action, path, src, bool(is_dir), bool(overwrite), time.time(), 0)
+        self._db.execute("INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (self.key(path),) + tuple(op))
+        self._added.append(op)
+
+    def _drop(self, path, children=False):
+        key = self.key(path)
+        if children:
+            # Operations inside a deleted folder, the moves from the folder are kept
+            self._db.execute("DELETE FROM journal WHERE substr(key, 1, ?) = ? AND action != ?",
+                             (len(key) + 1, key + "/", OP_MOVE))
+        else:
+            self._db.execute("DELETE FROM journal WHERE key = ?", (key,))
+
+    def _forget(self, path, is_dir):
+        """ Delete a path from Dropbox, if a new change on the path is not pending.
+        """
+        if self._get(path) is None:
+            self._put(OP_DELETE, path, is_dir=is_dir)
+
+    def _covered(self, src, dest):
+        """ Check if a move is already done from the pending move of a parent folder.
+        """
+        parent = dest.rpartition("/")[0]
+        while parent:
+            op = self._get(parent)
+            if op is not None and op.action == OP_MOVE:
+                return self.key(src) == self.key(op.src + dest[len(parent):])
+            parent = parent.rpartition("/")[0]
+        return False
+
+    def _move(self, src, dest, is_dir):
+        if self._covered(src, dest):
+            return
+        old = self._get(src)
+        if old is None:
+            self._put(OP_MOVE, dest, src=src, is_dir=is_dir)
+        elif old.action == OP_MOVE:
+            # Chain of moves, only the last one is applied
+            self._drop(src)
+            self._put(OP_MOVE, dest, src=old.src, is_dir=is_dir)
+        else:
+            # The source is not in Dropbox with its last content, the upload
+            # of the destination and the delete replace the upload of the source
+            self._drop(src)
+            self._put(OP_DELETE, src, is_dir=is_dir)
+            self._put(OP_UPLOAD, dest, is_dir=is_dir, overwrite=True)
+        if is_dir:
+            self._rebase(src, dest)
+
+    def _rebase(self, src, dest):
+        """ Move the operations inside a moved folder after the move of the folder.
+        """
+        key = self.key(src)
+        rows = self._db.execute("SELECT seq, action, path, src, is_dir, overwrite, queued, attempts FROM journal "
+                                "WHERE substr(key, 1, ?) = ? ORDER BY seq", (len(key) + 1, key + "/")).fetchall()
+        for op in (Operation(*row) for row in rows):
+            self._drop(op.path)
+            path = dest + op.path[len(src):]
+            op_src = dest + op.src[len(src):] if op.src and self.key(op.src).startswith(key + "/") else op.src
+            self._put(op.action, path, src=op_src, is_dir=op.is_dir, overwrite=op.overwrite)
+
+    def pending(self, limit=None):
+        """ Return the list of the pending operations, oldest first.
+        """
+        with self._lock:
+            if self._db is None:
+                return []
+            rows = self._db.execute("SELECT seq, action, path, src, is_dir, overwrite, queued, attempts FROM journal "
+                                    "ORDER BY seq LIMIT ?", (limit if limit is not None else -1,)).fetchall()
+        return [Operation(*row) for row in rows]
+
+    def held(self):
+        """ Return the keys of the paths with a pending change and of their parents,
+            and the keys of the paths changed with all their content: the paths
+            deleted and the sources and destinations of the moves.
+        """
+        held, trees = set(), set()
+        with self._lock:
+            if self._db is None:
+                return held, trees
+            rows = self._db.execute("SELECT action, path, src FROM journal").fetchall()
+        for action, path, src in rows:
+            paths = [path, src] if action == OP_MOVE else [path]
+            if action != OP_UPLOAD:
+                trees.update(self.key(path) for path in paths)
+            for path in paths:
+                key = self.key(path)
+                while key and key not in held:
+                    held.add(key)
+                    key = key.rpartition("/")[0]
+        return held, trees
+
+    def done(self, op):
+        """ Remove an operation applied, if not replaced from a new change.
+        """
+        with self._lock:
+            if self._db is None:
+                return
+            self._db.execute("DELETE FROM journal WHERE key = ? AND seq = ?", (self.key(op.path), op.seq))
+            self._db.commit()
+            if op.action == OP_DELETE and op.is_dir:
+                self._deleted[self.key(op.path)] = time.time()
+
+    def retry(self, op):
+        """ Count a failed attempt of an operation kept in the journal.
+        """
+        with self._lock:
+            if self._db is None:
+                return
+            self._db.execute("UPDATE journal SET attempts = attempts + 1 WHERE key = ? AND seq = ?",
+                             (self.key(op.path), op.seq))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+# EOF
@@ -0,0 +1,198 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import bisect
+import logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread, Lock
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Upper bounds in seconds of the latency buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# Default port of the metrics endpoint
+PORT = 9100
+
+
+def labels(name, value, **extra):
+    items = ([(name, value)] if name else []) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{val}"' for key, val in items) + "}"
+
+
+class Counter:
+    """ Monotonic counter, one series for each label value.
+    """
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._series = {}
+        self._lock = Lock()
+
+    def inc(self, value=1, label=""):
+        with self._lock:
+            self._series[label] = self._series.get(label, 0) + value
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label, value in sorted(self._series.items()):
+                lines.append(f"{self.name}{labels(self.label, label)} {value}")
+        return lines
+
+
+class Histogram:
+    """ Cumulative histogram of the observed values, one series for each label value.
+    """
+
+    def __init__(self, name, help, label=None, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, value, label=""):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][idx] += 1
+            series[1] += value
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((label, list(counts), total) for label, (counts, total) in self._series.items())
+        for label, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{labels(self.label, label, le=le)} {cumulative}")
+            lines.append(f"{self.name}_sum{labels(self.label, label)} {total}")
+            lines.append(f"{self.name}_count{labels(self.label, label)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """ Value read only when the metrics are exposed.
+        The function returns a number or a dictionary {label: value}.
+    """
+
+    def __init__(self, name, help, func, label=None, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label = label
+        self.kind = kind
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self.func()
+        except Exception as err:
+            logger.debug(f"Metric {self.name} not available: {err}")
+            return lines
+        if not isinstance(values, dict):
+            values = {"": values}
+        for label, value in sorted(values.items()):
+            lines.append(f"{self.name}{labels(self.label, label)} {value}")
+        return lines
+
+
+class Metrics:
+    """ Registry of the metrics exposed in the Prometheus text format.
+
+        Counters and histograms are updated on the hot path with a single lock,
+        the gauges read the state of the sync only on scrape.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label=None):
+        return self.register(Counter(name, help, label))
+
+    def histogram(self, name, help, label=None, buckets=BUCKETS):
+        return self.register(Histogram(name, help, label, buckets))
+
+    def gauge(self, name, help, func, label=None, kind="gauge"):
+        return self.register(Gauge(name, help, func, label, kind))
+
+    def expose(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server with a thread for each request (ThreadingHTTPServer is Python 3.7+)
+    """
+    daemon_threads = True
+
+
+class MetricsServer(Thread):
+    """ HTTP endpoint that exposes the metrics on /metrics
+    """
+
+    def __init__(self, metrics, host="", port=PORT):
+        Thread.__init__(self, daemon=True)
+        registry = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.expose().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"Metrics request {self.address_string()} {format % args}")
+
+        self.server = ThreadedHTTPServer((host, int(port)), Handler)
+
+    def run(self):
+        logger.info(f"Metrics endpoint on port {self.server.server_address[1]}")
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+# EOF
@@ -0,0 +1,185 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import calendar
+import logging
+import sqlite3
+import time
+from datetime import datetime
+
+# Dropbox library
+import dropbox
+# Package imports
+from .diff import sortKey
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE entries (
+    key BLOB PRIMARY KEY,
+    path TEXT NOT NULL,
+    is_dir INTEGER,
+    size INTEGER,
+    modified INTEGER,
+    rev TEXT,
+    content_hash TEXT,
+    selected INTEGER
+) WITHOUT ROWID;
+"""
+
+
+class RemoteEntry:
+    """ Compact record of a remote file or folder.
+
+        Only the fields used to compare a file with the local copy are kept,
+        client_modified is rebuilt from the seconds since the epoch.
+        A file not selected from the selective sync is not downloaded.
+    """
+
+    __slots__ = ('path', 'is_dir', 'size', 'modified', 'rev', 'content_hash', 'selected')
+
+    def __init__(self, path, is_dir, size=0, modified=0, rev=None, content_hash=None, selected=True):
+        self.path = path
+        self.is_dir = bool(is_dir)
+        self.size = size
+        self.modified = modified
+        self.rev = rev
+        self.content_hash = content_hash
+        self.selected = bool(selected)
+
+    @classmethod
+    def fromMetadata(cls, path, md, selected=True):
+        if isinstance(md, dropbox.files.FolderMetadata):
+            return cls(path, True)
+        modified = calendar.timegm(md.client_modified.timetuple()) if md.client_modified else 0
+        return cls(path, False, md.size, modified, md.rev, md.content_hash, selected)
+
+    @property
+    def name(self):
+        return self.path.rsplit("/", 1)[-1]
+
+    @property
+    def client_modified(self):
+        return datetime(*time.gmtime(self.modified)[:6])
+
+    def __repr__(self):
+        return f"RemoteEntry({self.path} {'dir' if self.is_dir else self.rev})"
+
+
+class RemoteTree:
+    """ Snapshot of the remote folder streamed sorted by path.
+
+        Built with a single recursive and fully paginated listing, the
+        entries are spooled as compact rows in a temporary SQLite database
+        and the memory does not grow with the number of files.
+        With a selective sync policy the paths excluded are not stored, and
+        the files too big or too old are stored as not selected.
+    """
+
+    def __init__(self, root="", policy=None):
+        self.root = root.rstrip('/')
+        self.policy = policy
+        self.cursor = None
+        # Private temporary database, moved on disk when it grows
+        self._db = sqlite3.connect("")
+        self._db.execute("PRAGMA journal_mode=OFF")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.executescript(SCHEMA)
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def relative(self, md):
+        """ Path of a metadata relative to the root, or None if outside.
+        """
+        root = self.root.lower()
+        if not md.path_lower.startswith(root + "/"):
+            return None
+        return md.path_display[len(root):]
+
+    def add(self, entries):
+        """ Store a page of metadata, deleted entries are removed with their content.
+        """
+        rows = []
+        for md in entries:
+            path = self.relative(md)
+            if path is None:
+                continue
+            if isinstance(md, dropbox.files.DeletedMetadata):
+                self.remove(path)
+                continue
+            is_dir = isinstance(md, dropbox.files.FolderMetadata)
+            if self.policy and self.policy.isExcluded(path, is_dir=is_dir):
+                continue
+            entry = RemoteEntry.fromMetadata(path, md, selected=is_dir or not self.policy or self.policy.accepts(md))
+            rows.append((sortKey(path).encode(), path, entry.is_dir, entry.size, entry.modified, entry.rev,
+                         entry.content_hash, entry.selected))
+        self._db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def remove(self, path):
+        key = sortKey(path).encode()
+        # The content of a folder is between "key\0" and "key\1"
+        self._db.execute("DELETE FROM entries WHERE key = ? OR (key > ? AND key < ?)", (key, key + b"\0", key + b"\1"))
+
+    def get(self, path):
+        """ Record of a path or None.
+        """
+        row = self._db.execute("SELECT path, is_dir, size, modified, rev, content_hash, selected FROM entries WHERE key = ?",
+                               (sortKey(path).encode(),)).fetchone()
+        return RemoteEntry(*row) if row else None
+
+    def stream(self):
+        """ Generate (key, RemoteEntry) of all entries sorted by key.
+        """
+        rows = self._db.execute("SELECT key, path, is_dir, size, modified, rev, content_hash, selected FROM entries ORDER BY key")
+        for row in rows:
+            yield row[0].decode(), RemoteEntry(*row[1:])
+
+    def close(self):
+        self._db.close()
+
+    @classmethod
+    def load(cls, dbx, root, policy=None):
+        """ List recursively the root folder following all pages.
+            Raise ApiError or HttpError if the listing fails.
+        """
+        tree = cls(root, policy)
+        try:
+            res = dbx.files_list_folder(root, recursive=True)
+            pages = 1
+            while True:
+                tree.add(res.entries)
+                if not res.has_more:
+                    break
+                res = dbx.files_list_folder_continue(res.cursor)
+                pages += 1
+        except Exception:
+            tree.close()
+            raise
+        tree.cursor = res.cursor
+        logger.debug(f"Remote tree with {len(tree)} entries in {pages} pages")
+        return tree
+# EOF
@@ -0,0 +1,71 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import logging
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Seconds a local delete waits a create of the same file before to be synchronized
+MOVE_WINDOW = 2.0
+# Maximum number of new files held in a reconcile to be matched with the files disappeared
+MOVE_CANDIDATES = 10000
+
+
+class RenameMatcher:
+    """ Match the files disappeared from a path with the files appeared in another path.
+
+        A file is renamed if it has the same size, mtime and inode of the
+        disappeared file, or the same size and content hash. The content is
+        hashed only if a disappeared file has the same size.
+    """
+
+    def __init__(self, hasher):
+        self.hasher = hasher
+
+    def match(self, gone, appeared):
+        """ gone is a list of (key, size, mtime_ns, inode, content_hash) of the disappeared files,
+            mtime_ns, inode and content_hash can be None. appeared is a list of (key, path, stat)
+            of the new files, with the (size, mtime_ns, inode) stat.
+            Return the list of (gone key, appeared key) renamed, each file is used once.
+        """
+        sizes = {}
+        for item in gone:
+            sizes.setdefault(item[1], []).append(item)
+        renames = []
+        for key, path, stat in appeared:
+            candidates = sizes.get(stat[0])
+            if not candidates:
+                continue
+            found = next((item for item in candidates if (item[2], item[3]) == tuple(stat[1:])), None)
+            if found is None and any(item[4] for item in candidates):
+                try:
+                    content_hash = self.hasher.hash(path, stat)
+                except OSError as err:
+                    logger.debug(f"Hash {path} failed: {err}")
+                    continue
+                found = next((item for item in candidates if item[4] == content_hash), None)
+            if found is not None:
+                candidates.remove(found)
+                renames.append((found[0], key))
+        return renames
+# EOF
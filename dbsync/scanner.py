@@ -0,0 +1,234 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
+from threading import Event
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Top level folders scanned in parallel, 1 to scan in a single thread
+SCAN_WORKERS = 1
+# Items read ahead for each folder scanned in parallel
+SCAN_QUEUE = 256
+# End of a folder scanned in parallel
+DONE = object()
+
+
+class LocalEntry:
+    """ Stat of a local file or folder, read once during the scan.
+    """
+
+    __slots__ = ('path', 'name', 'size', 'mtime_ns', 'inode', 'is_dir', 'is_link')
+
+    def __init__(self, path, name, size, mtime_ns, inode, is_dir, is_link=False):
+        self.path = path
+        self.name = name
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.inode = inode
+        self.is_dir = is_dir
+        self.is_link = is_link
+
+    @property
+    def stat(self):
+        """ Same tuple (size, mtime_ns, inode) returned from localStat
+        """
+        return self.size, self.mtime_ns, self.inode
+
+    def __repr__(self):
+        return f"LocalEntry({self.path} {'dir' if self.is_dir else self.size})"
+
+
+class LocalScanner:
+    """ Scan the local folder with os.scandir, each entry is stat only once.
+
+        The walk is top-down like os.walk and the excluded folders are not
+        scanned, exclude(subfolder, name, is_dir, accepted=True) is called
+        for the entries of a folder already accepted. With workers > 1 the top level folders are scanned in parallel,
+        useful on network mounts where each stat is slow. Each folder is read
+        ahead in a bounded queue, the memory does not grow with the tree.
+    """
+
+    def __init__(self, folder, exclude=None, workers=SCAN_WORKERS):
+        self.folder = folder
+        self.exclude = exclude
+        self.workers = max(1, int(workers))
+
+    def listdir(self, subfolder=""):
+        """ Scan a single folder.
+            Return two lists of LocalEntry, folders and files, or None if the folder doesn't exist.
+        """
+        dirs, files = [], []
+        try:
+            with os.scandir(os.path.join(self.folder, subfolder)) as it:
+                for entry in it:
+                    if self.exclude is not None and self.exclude(subfolder, entry.name, entry.is_dir(), accepted=True):
+                        continue
+                    try:
+                        if entry.is_dir():
+                            dirs.append(LocalEntry(entry.path, entry.name, 0, 0, entry.inode(), True, entry.is_symlink()))
+                        else:
+                            st = entry.stat()
+                            files.append(LocalEntry(entry.path, entry.name, st.st_size, st.st_mtime_ns, st.st_ino, False))
+                    except OSError as err:
+                        # Removed during the scan
+                        logger.debug(f"Skip {entry.path}: {err}")
+        except OSError as err:
+            logger.debug(f"Scan {subfolder} failed: {err}")
+            return None
+        return dirs, files
+
+    def walk(self, subfolder=""):
+        """ Generate (subfolder, dirs, files) for each folder, top-down.
+
+            Like os.walk the caller can remove folders from dirs
+            to not walk them.
+        """
+        if self.workers == 1:
+            yield from self._walk(subfolder)
+            return
+        listing = self.listdir(subfolder)
+        if listing is None:
+            return
+        dirs, files = listing
+        yield subfolder, dirs, files
+        children = [os.path.join(subfolder, entry.name) for entry in dirs if not entry.is_link]
+        # The subtrees are scanned in parallel and returned in order
+        for tree in self._prefetch(children, self._walk):
+            pruned = []
+            for sub, sub_dirs, sub_files in tree:
+                if any(sub == path or sub.startswith(path + os.path.sep) for path in pruned):
+                    continue
+                names = [entry.name for entry in sub_dirs]
+                yield sub, sub_dirs, sub_files
+                # Folders removed from the caller are skipped
+                kept = set(entry.name for entry in sub_dirs)
+                pruned.extend(os.path.join(sub, name) for name in names if name not in kept)
+
+    def _prefetch(self, children, generate):
+        """ Run generate(child) for each child in parallel, up to workers at a time.
+
+            Generate for each child, in order, an iterator of its items. The items
+            are read ahead in a queue of SCAN_QUEUE items, an iterator must be
+            consumed before the next one.
+        """
+        stopped = Event()
+        queues = [Queue(SCAN_QUEUE) for _ in children]
+
+        def put(queue, item):
+            while not stopped.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def produce(child, queue):
+            if stopped.is_set():
+                return
+            try:
+                for item in generate(child):
+                    if not put(queue, item):
+                        return
+            except Exception as err:
+                put(queue, err)
+            put(queue, DONE)
+
+        def consume(queue):
+            while True:
+                item = queue.get()
+                if item is DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+
+        # The children are started in order, the one consumed is always running or completed
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scan") as pool:
+            try:
+                for child, queue in zip(children, queues):
+                    pool.submit(produce, child, queue)
+                for queue in queues:
+                    yield consume(queue)
+            finally:
+                # Release the producers of a walk not completed
+                stopped.set()
+
+    def stream(self, subfolder=""):
+        """ Generate (subfolder, LocalEntry) of the whole tree, depth-first
+            with the entries of each folder sorted by lower case name.
+
+            Only the folders on the current path are in memory. With workers > 1
+            the subtrees of the top level folders are scanned in parallel and
+            read ahead in bounded queues.
+        """
+        if self.workers == 1:
+            yield from self._stream(subfolder)
+            return
+        entries = self._sorted(subfolder)
+        children = [os.path.join(parent, entry.name) for parent, entry in entries if entry.is_dir and not entry.is_link]
+        subtrees = self._prefetch(children, self._stream)
+        try:
+            for item in entries:
+                yield item
+                parent, entry = item
+                if entry.is_dir and not entry.is_link:
+                    yield from next(subtrees)
+        finally:
+            subtrees.close()
+
+    def _stream(self, subfolder):
+        stack = [iter(self._sorted(subfolder))]
+        while stack:
+            item = next(stack[-1], None)
+            if item is None:
+                stack.pop()
+                continue
+            yield item
+            parent, entry = item
+            # Symbolic links to folders are not followed like os.walk
+            if entry.is_dir and not entry.is_link:
+                stack.append(iter(self._sorted(os.path.join(parent, entry.name))))
+
+    def _sorted(self, subfolder):
+        listing = self.listdir(subfolder)
+        if listing is None:
+            return []
+        dirs, files = listing
+        return [(subfolder, entry) for entry in sorted(dirs + files, key=lambda entry: entry.name.lower())]
+
+    def _walk(self, subfolder):
+        stack = [subfolder]
+        while stack:
+            subfolder = stack.pop()
+            listing = self.listdir(subfolder)
+            if listing is None:
+                continue
+            dirs, files = listing
+            yield subfolder, dirs, files
+            # Symbolic links to folders are not followed like os.walk
+            stack.extend(os.path.join(subfolder, entry.name) for entry in reversed(dirs) if not entry.is_link)
+# EOF
@@ -0,0 +1,190 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import heapq
+import itertools
+import logging
+from concurrent.futures import Future
+from threading import Thread, Condition
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Number of transfers executed in parallel
+WORKERS = 4
+# Priorities, lower values are executed first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+
+class Task:
+
+    __slots__ = ('key', 'func', 'args', 'kwargs', 'priority', 'size', 'seq', 'future')
+
+    def __init__(self, key, func, args, kwargs, priority, size, seq):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.size = size
+        self.seq = seq
+        self.future = Future()
+
+
+def chain(source, target):
+    """ Copy the result of a Future in another Future.
+    """
+    def done(future):
+        err = future.exception()
+        if err is not None:
+            target.set_exception(err)
+        else:
+            target.set_result(future.result())
+    source.add_done_callback(done)
+
+
+class TransferScheduler:
+    """ Pool of workers that execute the transfers by priority.
+
+        Interactive operations are executed before the bulk ones, and in the same
+        priority the small transfers first. A new operation on a path already queued
+        replaces the old one, and two operations on the same path never run together.
+    """
+
+    def __init__(self, workers=WORKERS):
+        self.workers = max(1, int(workers))
+        self._heap = []
+        self._queued = {}
+        self._running = set()
+        self._blocked = {}
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._threads = []
+        self._stopped = False
+        # Statistics
+        self.deduplicated = 0
+        self.completed = 0
+
+    @property
+    def pending(self):
+        """ Number of operations waiting in queue.
+        """
+        with self._cond:
+            return len(self._queued)
+
+    @property
+    def inflight(self):
+        """ Number of operations running.
+        """
+        with self._cond:
+            return len(self._running)
+
+    def stats(self):
+        with self._cond:
+            return {'pending': len(self._queued), 'inflight': len(self._running),
+                    'completed': self.completed, 'deduplicated': self.deduplicated}
+
+    def submit(self, key, func, *args, priority=PRIORITY_BULK, size=0, **kwargs):
+        """ Queue func(*args, **kwargs) for the path key.
+            Return a Future with the result.
+        """
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Scheduler stopped")
+            if not self._threads:
+                self._startWorkers()
+            task = Task(key, func, args, kwargs, priority, size, next(self._seq))
+            old = self._queued.get(key)
+            if old is not None:
+                # The last operation on the same path wins
+                self.deduplicated += 1
+                task.priority = min(task.priority, old.priority)
+                chain(task.future, old.future)
+                self._blocked.pop(key, None)
+            self._queued[key] = task
+            if key in self._running:
+                self._blocked[key] = task
+            else:
+                heapq.heappush(self._heap, (task.priority, task.size, task.seq, task))
+                self._cond.notify()
+        return task.future
+
+    def _startWorkers(self):
+        for idx in range(self.workers):
+            thread = Thread(target=self._worker, name=f"transfer-{idx}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next(self):
+        """ Pop the next task or None if stopped.
+        """
+        with self._cond:
+            while True:
+                while self._heap:
+                    _, _, _, task = heapq.heappop(self._heap)
+                    # Skip replaced or blocked tasks
+                    if self._queued.get(task.key) is not task or task.key in self._blocked:
+                        continue
+                    del self._queued[task.key]
+                    self._running.add(task.key)
+                    return task
+                if self._stopped:
+                    return None
+                self._cond.wait()
+
+    def _worker(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            try:
+                result = task.func(*task.args, **task.kwargs)
+            except Exception as err:
+                logger.error(f"Transfer {task.key} failed: {err}")
+                task.future.set_exception(err)
+            else:
+                task.future.set_result(result)
+            with self._cond:
+                self._running.discard(task.key)
+                self.completed += 1
+                # Release an operation waiting the same path
+                blocked = self._blocked.pop(task.key, None)
+                if blocked is not None:
+                    heapq.heappush(self._heap, (blocked.priority, blocked.size, blocked.seq, blocked))
+                self._cond.notify_all()
+
+    def join(self):
+        """ Wait until all queued operations are done.
+        """
+        with self._cond:
+            while self._queued or self._running:
+                self._cond.wait()
+
+    def stop(self):
+        """ Execute all queued operations and stop the workers.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+# EOF
@@ -0,0 +1,180 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import calendar
+import json
+import logging
+import os
+import time
+
+# Package imports
+from .bandwidth import UNITS
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Units of an age, in seconds
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+
+def parseSize(value):
+    """ Parse a size in bytes, e.g. 1048576, "512K" or "2GB". Return 0 for no limit.
+    """
+    if isinstance(value, (int, float)):
+        size = value
+    else:
+        text = str(value).strip().upper()
+        if text.endswith("B"):
+            text = text[:-1]
+        unit = text[-1:] if text[-1:] in UNITS else ''
+        try:
+            size = float(text[:len(text) - len(unit)] or 0) * UNITS[unit]
+        except ValueError:
+            raise ValueError(f"size not valid: {value}")
+    if size < 0:
+        raise ValueError(f"size not valid: {value}")
+    return int(size)
+
+
+def parseAge(value):
+    """ Parse an age in seconds, e.g. 3600, "12h" or "30d". Return 0 for no limit.
+    """
+    if isinstance(value, (int, float)):
+        age = value
+    else:
+        text = str(value).strip().lower()
+        unit = text[-1:] if text[-1:] in AGE_UNITS else 's'
+        try:
+            age = float(text.rstrip(unit) or 0) * AGE_UNITS[unit]
+        except ValueError:
+            raise ValueError(f"age not valid: {value}")
+    if age < 0:
+        raise ValueError(f"age not valid: {value}")
+    return age
+
+
+def normalizeFolder(path):
+    path = "/" + str(path).replace(os.path.sep, "/").strip("/")
+    return path.lower() if path != "/" else ""
+
+
+class SelectivePolicy:
+    """ Rules to synchronize only a part of the Dropbox folder.
+
+        The folder rules select subtrees: a path inside an included folder is
+        synchronized, a path inside an excluded folder is not, and the most
+        specific rule wins. With include rules, the paths outside of them are
+        not synchronized, only the parent folders of the included ones are kept.
+        The extension rules select the files by extension, in both directions.
+        The size and age rules select only the remote files to download:
+        the files bigger than max_size or with a server_modified older than
+        max_age are not downloaded, and their local copies are left as they are.
+    """
+
+    def __init__(self, include=(), exclude=(), max_size=0, max_age=0, extensions=(), exclude_extensions=()):
+        self.include = sorted(set(normalizeFolder(path) for path in include))
+        self.exclude = sorted(set(normalizeFolder(path) for path in exclude))
+        self.max_size = parseSize(max_size or 0)
+        self.max_age = parseAge(max_age or 0)
+        self.extensions = set(self.extension(ext) for ext in extensions)
+        self.exclude_extensions = set(self.extension(ext) for ext in exclude_extensions)
+        # Most specific folder rules first
+        self._rules = sorted([(path, True) for path in self.include] + [(path, False) for path in self.exclude],
+                             key=lambda rule: len(rule[0]), reverse=True)
+
+    @staticmethod
+    def extension(ext):
+        ext = str(ext).strip().lower()
+        return ext if ext.startswith(".") else "." + ext
+
+    @classmethod
+    def fromDict(cls, rules):
+        """ Build the policy from a dict like:
+
+            {"include": ["/Projects"], "exclude": ["/Projects/archive"], "maxSize": "100M",
+             "maxAge": "30d", "extensions": [".pdf"], "excludeExtensions": [".iso"]}
+
+            Raise ValueError if the rules are not valid.
+        """
+        if not isinstance(rules, dict):
+            raise ValueError("selective sync rules must be an object")
+        unknown = set(rules) - {'include', 'exclude', 'maxSize', 'maxAge', 'extensions', 'excludeExtensions'}
+        if unknown:
+            raise ValueError(f"unknown selective sync rules {sorted(unknown)}")
+        for name in ('include', 'exclude', 'extensions', 'excludeExtensions'):
+            if not isinstance(rules.get(name, []), list):
+                raise ValueError(f"{name} must be a list")
+        return cls(include=rules.get('include', []), exclude=rules.get('exclude', []),
+                   max_size=rules.get('maxSize', 0), max_age=rules.get('maxAge', 0),
+                   extensions=rules.get('extensions', []), exclude_extensions=rules.get('excludeExtensions', []))
+
+    @classmethod
+    def load(cls, path):
+        """ Load the rules from a JSON file.
+            Raise ValueError if the file is not valid.
+        """
+        try:
+            with open(os.path.expanduser(path), 'r') as f:
+                rules = json.load(f)
+        except OSError as err:
+            raise ValueError(str(err))
+        return cls.fromDict(rules)
+
+    def __bool__(self):
+        return bool(self._rules or self.max_size or self.max_age or self.extensions or self.exclude_extensions)
+
+    def __repr__(self):
+        return (f"SelectivePolicy(include={self.include}, exclude={self.exclude}, max_size={self.max_size}, "
+                f"max_age={self.max_age}, extensions={sorted(self.extensions)}, "
+                f"exclude_extensions={sorted(self.exclude_extensions)})")
+
+    def isExcluded(self, path, is_dir=False):
+        """ Check if a path, relative to the synchronized folder, is outside the folder and extension rules.
+        """
+        key = path.lower().rstrip("/")
+        if is_dir and any(folder.startswith(key + "/") for folder in self.include):
+            # Parent of an included folder
+            return False
+        for folder, included in self._rules:
+            if key == folder or key.startswith(folder + "/") or not folder:
+                if not included:
+                    return True
+                break
+        else:
+            if self.include:
+                return True
+        if is_dir:
+            return False
+        ext = os.path.splitext(key)[1]
+        if self.extensions and ext not in self.extensions:
+            return True
+        return ext in self.exclude_extensions
+
+    def accepts(self, md):
+        """ Check if a remote file can be downloaded from its size and server_modified.
+        """
+        if self.max_size and md.size > self.max_size:
+            return False
+        if self.max_age and md.server_modified is not None:
+            if calendar.timegm(md.server_modified.timetuple()) < time.time() - self.max_age:
+                return False
+        return True
+# EOF
@@ -0,0 +1,173 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+from threading import Lock
+
+# How it is work watchdog
+# * https://pythonhosted.org/watchdog/quickstart.html#a-simple-example
+# * https://stackoverflow.com/questions/32923451/how-to-run-an-function-when-anything-changes-in-a-dir-with-python-watchdog
+# * https://stackoverflow.com/questions/46372041/seeing-multiple-events-with-python-watchdog-library-when-folders-are-created
+from watchdog.observers import Observer
+# Package imports
+from .bandwidth import Bandwidth
+from .batch import UploadBatcher, DeleteBatcher, MoveBatcher, BATCH_SIZE, BATCH_DEADLINE
+from .client import RateLimitedClient, CONCURRENCY
+from .hashing import ContentHasher
+from .metrics import Metrics
+from .scheduler import TransferScheduler, WORKERS
+from .tuning import ChunkTuner
+from .watcher import FolderWatch
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+
+
+class SyncSession:
+    """ Resources shared from all synchronized folders of the process.
+
+        A single Dropbox client with its HTTP pool and adaptive concurrency,
+        a watchdog observer, a transfer scheduler, a content hasher, the batch
+        committers, the bandwidth shapers, the upload chunk tuner and the metrics registry.
+    """
+
+    def __init__(self, client, batch_size=BATCH_SIZE, batch_deadline=BATCH_DEADLINE, workers=WORKERS,
+                 max_requests=CONCURRENCY, bandwidth=None, max_watches=0, chunk_size=0, upload_workers=4):
+        self.dbx = client if isinstance(client, RateLimitedClient) else RateLimitedClient(client, concurrency=max_requests)
+        # Pool of workers for all transfers
+        self.scheduler = TransferScheduler(workers)
+        # Local content hash engine
+        self.hasher = ContentHasher()
+        # Upload and download rate limits
+        self.bandwidth = bandwidth if bandwidth is not None else Bandwidth()
+        # Upload chunk size, fixed or tuned from the requests of the connection
+        self.tuner = ChunkTuner(chunk_size, upload_workers)
+        # A single observer for all folders, with the inotify watches available
+        self.observer = Observer()
+        self.max_watches = max_watches
+        self.watches = []
+        # Synchronized folders
+        self.syncs = []
+        self._lock = Lock()
+        self._batchers = False
+        self._observer = False
+        # Metrics collected from the stopwatch and exposed on request
+        self.metrics = Metrics()
+        self.latency = self.metrics.histogram('dbsync_operation_duration_seconds', 'Latency of the Dropbox operations',
+                                              label='operation')
+        self.cycles = self.metrics.histogram('dbsync_sync_duration_seconds', 'Duration of the sync cycles', label='cycle')
+        self.transferred = self.metrics.counter('dbsync_transferred_bytes_total', 'Bytes transferred', label='direction')
+        # Commit small files, deletes and moves in batch
+        self.batcher = UploadBatcher(self.dbx, batch_size, batch_deadline, self.latency) if batch_size > 1 else None
+        self.deleter = DeleteBatcher(self.dbx, batch_size, batch_deadline, self.latency) if batch_size > 1 else None
+        self.mover = MoveBatcher(self.dbx, batch_size, batch_deadline, self.latency) if batch_size > 1 else None
+        self.registerMetrics()
+
+    def registerMetrics(self):
+        """ Register the gauges read from the queues and the client on scrape.
+        """
+        self.metrics.gauge('dbsync_folders', 'Synchronized folders', lambda: len(self.syncs))
+        self.metrics.gauge('dbsync_pending_events', 'Local events waiting to be stable',
+                           lambda: sum(sync.events.pending for sync in self.syncs))
+        self.metrics.gauge('dbsync_journal_changes', 'Local changes stored in the journal and not yet applied in Dropbox',
+                           lambda: sum(len(sync.journal) for sync in self.syncs))
+        self.metrics.gauge('dbsync_transfers', 'Transfers in the scheduler',
+                           lambda: {state: value for state, value in self.scheduler.stats().items()
+                                    if state in ('pending', 'inflight')}, label='state')
+        self.metrics.gauge('dbsync_requests_inflight', 'Requests to Dropbox in flight', lambda: self.dbx.stats()['inflight'])
+        self.metrics.gauge('dbsync_requests_limit', 'Maximum requests in flight allowed', lambda: self.dbx.stats()['limit'])
+        self.metrics.gauge('dbsync_throughput_bytes', 'Bytes per second transferred in the last 10 seconds',
+                           lambda: {direction: stats['throughput'] for direction, stats in self.bandwidth.stats().items()},
+                           label='direction')
+        self.metrics.gauge('dbsync_bandwidth_limit_bytes', 'Bytes per second allowed, 0 if unlimited',
+                           lambda: {direction: stats['rate'] for direction, stats in self.bandwidth.stats().items()},
+                           label='direction')
+        self.metrics.gauge('dbsync_watched_folders', 'Local folders watched with inotify or polled',
+                           lambda: {mode: sum(watch.stats()[mode] for watch in self.watches) for mode in ('inotify', 'poll')},
+                           label='mode')
+        self.metrics.gauge('dbsync_watch_setup_seconds', 'Time to start watching the local folders',
+                           lambda: sum(watch.setup_time for watch in self.watches))
+        self.metrics.gauge('dbsync_watch_memory_bytes', 'Memory used to start watching the local folders',
+                           lambda: sum(watch.memory for watch in self.watches))
+        self.metrics.gauge('dbsync_upload_chunk_bytes', 'Chunk size of the new upload sessions',
+                           lambda: self.tuner.stats()['chunk_size'])
+        self.metrics.gauge('dbsync_upload_threshold_bytes', 'Biggest file uploaded with a single request',
+                           lambda: self.tuner.stats()['threshold'])
+        self.metrics.gauge('dbsync_upload_request_throughput_bytes', 'Bytes per second of an upload request measured from the tuner',
+                           lambda: self.tuner.stats()['throughput'])
+        for name, help in (('requests', 'Requests to Dropbox'), ('errors', 'Failed requests to Dropbox'),
+                           ('retried', 'Requests to Dropbox retried'), ('throttled', 'Requests throttled from Dropbox')):
+            self.metrics.gauge(f"dbsync_api_{name}_total", help, lambda name=name: self.dbx.stats()[name], kind="counter")
+
+    def add(self, sync):
+        with self._lock:
+            self.syncs.append(sync)
+
+    def startBatchers(self):
+        """ Start the threads that commit small files, deletes and moves in batch.
+        """
+        with self._lock:
+            if self._batchers:
+                return
+            self._batchers = True
+        for batcher in (self.batcher, self.deleter, self.mover):
+            if batcher is not None:
+                batcher.start()
+
+    def watch(self, handler, folder, exclude=None):
+        """ Watch a folder with the shared observer, or with a poll if
+            the inotify watches are not enough.
+            Return the FolderWatch to stop.
+        """
+        with self._lock:
+            start = not self._observer
+            self._observer = True
+        if start:
+            # Started before the watches to know if they fail
+            self.observer.start()
+        watch = FolderWatch(self.observer, handler, folder, exclude=exclude, max_watches=self.max_watches)
+        watch.start()
+        with self._lock:
+            self.watches.append(watch)
+        return watch
+
+    def unwatch(self, watch):
+        if watch is None:
+            return
+        watch.stop()
+        with self._lock:
+            if watch in self.watches:
+                self.watches.remove(watch)
+
+    def stop(self):
+        # Release the transfers waiting the rate limits
+        self.bandwidth.close()
+        if self._observer:
+            self.observer.stop()
+            self.observer.join()
+        self.scheduler.stop()
+        for batcher in (self.batcher, self.deleter, self.mover):
+            if batcher is not None:
+                batcher.stop()
+        self.hasher.close()
+        logger.debug("Session stopped")
+# EOF
@@ -0,0 +1,263 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from threading import Lock
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Single record stored in the index
+Entry = namedtuple('Entry', ['path', 'size', 'mtime_ns', 'inode', 'rev', 'content_hash'])
+# Direction of an interrupted transfer
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+# Entries read from the index in a single query of stream()
+STREAM_PAGE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    rev TEXT,
+    content_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_order ON entries(replace(key, '/', char(0)));
+CREATE TABLE IF NOT EXISTS transfers (
+    key TEXT NOT NULL,
+    path TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    session_id TEXT,
+    offset INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER,
+    rev TEXT,
+    chunk_size INTEGER,
+    chunks TEXT,
+    started REAL,
+    PRIMARY KEY (key, direction)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class Transfer(namedtuple('Transfer', ['path', 'direction', 'session_id', 'offset', 'size', 'mtime_ns', 'rev',
+                                       'chunk_size', 'chunks', 'started'])):
+    """ An upload or a download not completed.
+
+        For an upload are stored the session id, the local size and mtime of the file
+        and the chunks appended: all chunks before offset plus the offsets listed in chunks.
+        For a download offset is the number of bytes stored in the partial file
+        and rev the remote revision downloaded.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def upload(cls, path, session_id, stat, chunk_size, appended, started=None):
+        """ Build an upload from the set of the offsets of the chunks appended.
+        """
+        offset = 0
+        while offset in appended:
+            offset += chunk_size
+        chunks = ",".join(str(chunk) for chunk in sorted(appended) if chunk > offset)
+        return cls(path, UPLOAD, session_id, offset, stat[0], stat[1], None, chunk_size, chunks,
+                   started if started is not None else time.time())
+
+    @classmethod
+    def download(cls, path, offset, md, started=None):
+        return cls(path, DOWNLOAD, None, offset, md.size, None, md.rev, None, None,
+                   started if started is not None else time.time())
+
+    def appended(self):
+        """ Set of the offsets of the chunks already appended to the upload session.
+        """
+        offsets = set(range(0, self.offset, self.chunk_size))
+        offsets.update(int(chunk) for chunk in (self.chunks or "").split(",") if chunk)
+        return offsets
+
+
+def localStat(path):
+    """ Return the tuple (size, mtime_ns, inode) of a local file
+        or None if the file does not exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+class SyncState:
+    """ Persistent index of the synchronized files.
+
+        For each path are stored the local size, mtime and inode
+        and the remote rev and content_hash of the last sync.
+        Paths are relative to the synchronized folder, e.g. "/sub/name.txt".
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        logger.debug(f"Sync state loaded from {path}")
+
+    @staticmethod
+    def key(path):
+        return path.lower()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get(self, path):
+        """ Return the stored Entry or None.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT path, size, mtime_ns, inode, rev, content_hash FROM entries WHERE key = ?",
+                                   (self.key(path),)).fetchone()
+        return Entry(*row) if row else None
+
+    def stream(self):
+        """ Generate (sortKey, Entry) of all stored entries sorted like diff.sortKey.
+
+            The entries are read in pages of STREAM_PAGE, the index is not
+            locked while the caller handles them.
+        """
+        last = ""
+        while True:
+            with self._lock:
+                rows = self._db.execute("SELECT replace(key, '/', char(0)), path, size, mtime_ns, inode, rev, content_hash "
+                                        "FROM entries WHERE replace(key, '/', char(0)) > ? "
+                                        "ORDER BY replace(key, '/', char(0)) LIMIT ?", (last, STREAM_PAGE)).fetchall()
+            for row in rows:
+                yield row[0][1:], Entry(*row[1:])
+            if len(rows) < STREAM_PAGE:
+                return
+            last = rows[-1][0]
+
+    def update(self, path, stat, rev=None, content_hash=None):
+        """ Store the local stat and the remote rev of a file.
+        """
+        size, mtime_ns, inode = stat
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (self.key(path), path, size, mtime_ns, inode, rev, content_hash))
+            self._db.commit()
+
+    def remove(self, path):
+        """ Remove a file or a whole folder from the index.
+        """
+        key = self.key(path)
+        with self._lock:
+            self._db.execute("DELETE FROM entries WHERE key = ? OR substr(key, 1, ?) = ?",
+                             (key, len(key) + 1, key + "/"))
+            self._db.commit()
+
+    def rename(self, src, dest):
+        """ Move a file or a whole folder in the index.
+        """
+        src_key = self.key(src)
+        with self._lock:
+            rows = self._db.execute("SELECT key, path FROM entries WHERE key = ? OR substr(key, 1, ?) = ?",
+                                    (src_key, len(src_key) + 1, src_key + "/")).fetchall()
+            for key, path in rows:
+                new_path = dest + path[len(src):]
+                self._db.execute("UPDATE OR REPLACE entries SET key = ?, path = ? WHERE key = ?",
+                                 (self.key(new_path), new_path, key))
+            self._db.commit()
+
+    def isSynced(self, path, stat, rev=None):
+        """ Check if the local stat and the remote rev match the last sync.
+        """
+        entry = self.get(path)
+        if entry is None or stat is None:
+            return False
+        if rev is not None and entry.rev != rev:
+            return False
+        return (entry.size, entry.mtime_ns, entry.inode) == tuple(stat)
+
+    def getTransfer(self, path, direction):
+        """ Return the interrupted Transfer of a path or None.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT path, direction, session_id, offset, size, mtime_ns, rev, chunk_size, chunks, started "
+                                   "FROM transfers WHERE key = ? AND direction = ?", (self.key(path), direction)).fetchone()
+        return Transfer(*row) if row else None
+
+    def setTransfer(self, transfer):
+        """ Store the progress of a transfer.
+        """
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (self.key(transfer.path),) + tuple(transfer))
+            self._db.commit()
+
+    def removeTransfer(self, path, direction):
+        with self._lock:
+            self._db.execute("DELETE FROM transfers WHERE key = ? AND direction = ?", (self.key(path), direction))
+            self._db.commit()
+
+    def expireTransfers(self, max_age):
+        """ Remove the transfers started more than max_age seconds ago.
+            Return the list of the removed transfers.
+        """
+        started = time.time() - max_age
+        with self._lock:
+            rows = self._db.execute("SELECT path, direction, session_id, offset, size, mtime_ns, rev, chunk_size, chunks, started "
+                                    "FROM transfers WHERE started < ?", (started,)).fetchall()
+            self._db.execute("DELETE FROM transfers WHERE started < ?", (started,))
+            self._db.commit()
+        return [Transfer(*row) for row in rows]
+
+    def getCursor(self):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE name = 'cursor'").fetchone()
+        return row[0] if row else None
+
+    def setCursor(self, cursor):
+        with self._lock:
+            if cursor is None:
+                self._db.execute("DELETE FROM meta WHERE name = 'cursor'")
+            else:
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('cursor', ?)", (cursor,))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+# EOF
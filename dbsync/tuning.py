@@ -0,0 +1,165 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+from threading import Lock
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Chunks of concurrent upload sessions must be a multiple of 4MB
+CHUNK_UNIT = 4 * 1024 * 1024
+# Biggest chunk chosen, each upload keeps up to upload_workers chunks in memory
+MAX_CHUNK = 64 * 1024 * 1024
+# Seconds a chunk should take at the throughput measured
+TARGET_DURATION = 2.0
+# Payloads up to this size measure only the latency of a request
+LATENCY_PAYLOAD = 64 * 1024
+# Payloads from this size measure the throughput of a request
+THROUGHPUT_PAYLOAD = 1024 * 1024
+# Weight of a new sample in the moving averages
+SMOOTHING = 0.2
+# Throughput samples between two choices
+ADJUST_SAMPLES = 4
+
+
+def roundChunk(size):
+    """ Round a size to the 4MB multiples allowed for a chunk.
+    """
+    return min(MAX_CHUNK, max(CHUNK_UNIT, int(size) // CHUNK_UNIT * CHUNK_UNIT))
+
+
+def formatSize(size):
+    return f"{size / 1024 ** 2:.0f}MB"
+
+
+class ChunkTuner:
+    """ Choose the upload chunk size and the size of the files uploaded
+        with a single request from the timings of the requests.
+
+        Each request measured with the stopwatch is a sample: the small
+        payloads measure the latency, the big ones the throughput of a
+        connection. A chunk takes about TARGET_DURATION seconds, it grows
+        on a fast link to save round trips and halves when a chunk fails.
+        A file is uploaded with a single request while the round trips
+        saved cost more than the chunks appended in parallel would save.
+        With a fixed chunk_size both values are the chunk size.
+    """
+
+    def __init__(self, chunk_size=0, workers=4):
+        self.fixed = roundChunk(chunk_size) if chunk_size else 0
+        self.workers = max(1, int(workers))
+        self._lock = Lock()
+        self._chunk = self.fixed or CHUNK_UNIT
+        self._threshold = self._chunk
+        self.latency = None
+        self.throughput = None
+        self.samples = 0
+        self.failures = 0
+        self._pending = 0
+
+    @property
+    def auto(self):
+        return not self.fixed
+
+    @property
+    def chunk_size(self):
+        return self._chunk
+
+    @property
+    def threshold(self):
+        return self._threshold
+
+    def chunkFor(self, size):
+        """ Chunk size of a new upload session of size bytes.
+            The chunks of a file bigger than the threshold are split on the workers.
+        """
+        if not self.auto:
+            return self._chunk
+        per_worker = -(-int(size) // self.workers)
+        return min(self._chunk, roundChunk(per_worker + CHUNK_UNIT - 1))
+
+    def observe(self, size, seconds):
+        """ Record a request of size bytes completed in seconds.
+        """
+        if not self.auto:
+            return
+        with self._lock:
+            if size <= LATENCY_PAYLOAD:
+                self.latency = self.average(self.latency, seconds)
+                return
+            if size < THROUGHPUT_PAYLOAD:
+                return
+            # The latency is not part of the transfer
+            transfer = max(seconds - (self.latency or 0.0), seconds / 2, 1e-6)
+            self.throughput = self.average(self.throughput, size / transfer)
+            self.samples += 1
+            self._pending += 1
+            if self._pending >= ADJUST_SAMPLES:
+                self._pending = 0
+                self.adjust()
+
+    def failed(self, size):
+        """ A request of size bytes failed, the next chunks are smaller.
+        """
+        if not self.auto or size < THROUGHPUT_PAYLOAD:
+            return
+        with self._lock:
+            self.failures += 1
+            self._pending = 0
+            chunk = roundChunk(self._chunk // 2)
+            if chunk != self._chunk:
+                logger.info(f"Upload chunk reduced to {formatSize(chunk)} after a failure")
+            self._chunk = chunk
+            self._threshold = min(self._threshold, chunk)
+
+    @staticmethod
+    def average(value, sample):
+        return sample if value is None else value + SMOOTHING * (sample - value)
+
+    def adjust(self):
+        """ Choose chunk size and threshold, must be called with the lock.
+        """
+        # At most double for each choice, a single fast sample does not jump to the maximum
+        chunk = min(roundChunk(self.throughput * TARGET_DURATION), self._chunk * 2)
+        # A session costs two round trips more than a single request,
+        # it is worth only when the chunks in parallel save more time
+        saved = 1.0 - 1.0 / self.workers if self.workers > 1 else 0.0
+        if saved:
+            threshold = 2.0 * (self.latency or 0.0) * self.throughput / saved
+        else:
+            threshold = chunk
+        threshold = int(min(chunk, max(CHUNK_UNIT, threshold)))
+        if (chunk, threshold) != (self._chunk, self._threshold):
+            logger.info(f"Upload chunk {formatSize(chunk)}, single request up to {formatSize(threshold)} "
+                        f"[{self.throughput / 1024 ** 2:.1f}MB/s, {(self.latency or 0.0) * 1000:.0f}ms]")
+        self._chunk, self._threshold = chunk, threshold
+
+    def stats(self):
+        with self._lock:
+            return {'chunk_size': self._chunk, 'threshold': self._threshold, 'throughput': self.throughput or 0.0,
+                    'latency': self.latency or 0.0, 'samples': self.samples, 'failures': self.failures,
+                    'auto': self.auto}
+
+    def __repr__(self):
+        mode = "auto" if self.auto else "fixed"
+        return f"ChunkTuner({mode} chunk={formatSize(self._chunk)} threshold={formatSize(self._threshold)})"
+# EOF
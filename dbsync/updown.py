@@ -27,34 +27,66 @@ import os
 import re
 import shutil
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from datetime import datetime
 # Functions and decorators
 from functools import wraps
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 
 # Now not used
 # import unicodedata
 # import six
 # Dropbox library
 import dropbox
+import requests
 from dropbox import DropboxOAuth2FlowNoRedirect
 # Watchdog file events
 from watchdog.events import PatternMatchingEventHandler
-# How it is work watchdog
-# * https://pythonhosted.org/watchdog/quickstart.html#a-simple-example
-# * https://stackoverflow.com/questions/32923451/how-to-run-an-function-when-anything-changes-in-a-dir-with-python-watchdog
-# * https://stackoverflow.com/questions/46372041/seeing-multiple-events-with-python-watchdog-library-when-folders-are-created
-from watchdog.observers import Observer
+# Package imports
+from .batch import BATCH_SIZE, BATCH_DEADLINE
+from .client import CONCURRENCY, isTransient
+from .diff import SEPARATOR, sortKey, mergeJoin
+from .events import EventCoalescer, QUIET, CREATED, MODIFIED, DELETED, MOVED
+from .ignore import IgnoreMatcher
+from .journal import Journal, OP_UPLOAD, OP_DELETE, OP_MOVE
+from .remote import RemoteEntry, RemoteTree
+from .renames import RenameMatcher, MOVE_WINDOW, MOVE_CANDIDATES
+from .scanner import LocalScanner, SCAN_WORKERS
+from .scheduler import PRIORITY_INTERACTIVE, PRIORITY_BULK, WORKERS
+from .selective import SelectivePolicy
+from .session import SyncSession
+from .hashing import content_hash
+from .state import SyncState, Transfer, UPLOAD, DOWNLOAD, localStat
 
 # Create logger for jplotlib
 logger = logging.getLogger(__name__)
 # Chunk size dimension
 CHUNK_SIZE = 4 * 1024 * 1024
+# Read size of a download with a rate limit
+SHAPED_CHUNK_SIZE = 64 * 1024
+# Parallel chunks in flight for each upload session
+UPLOAD_WORKERS = 4
+# Transfers scheduled from a reconcile and not completed
+PENDING_TRANSFERS = 10000
+# Longpoll timeout in seconds (Dropbox accepts values between 30 and 480)
+LONGPOLL_TIMEOUT = 30
 # Conflict files
 # TODO: Improve with _CONFLICT_DATE_ #(\d+/\d+/\d+)
 CONFLICT = r'_CONFLICT_'
+# Suffix of partial downloads
+TMP_SUFFIX = ".dbsync-tmp"
+# Interrupted transfers are resumed for 6 days, Dropbox keeps an upload session for 7 days
+TRANSFER_EXPIRY = 6 * 24 * 3600
+# Bytes of a download stored between two checkpoints of the offset
+CHECKPOINT_SIZE = 16 * 1024 * 1024
+# Downloads resumed immediately after a dropped connection
+RESUME_RETRIES = 3
+# Upload session errors solved only with a new session
+LOST_SESSION = ('not_found', 'incorrect_offset', 'closed', 'not_closed', 'concurrent_session_invalid_offset')
+# Result of a journaled change not attempted while Dropbox is not reachable
+DEFERRED = 'deferred'
 # Ingnored pattern
-IGNORE_PATTERNS = ["*.swp", "*.goutputstream*"]
+IGNORE_PATTERNS = ["*.swp", "*.goutputstream*", "*" + TMP_SUFFIX]
 
 
 def dropboxignore(func):
@@ -70,6 +102,44 @@ def dropboxignore(func):
     return wrapped
 
 
+def readChunk(path, offset, size):
+    """ Read size bytes of a file from offset.
+        Raise OSError if the file is truncated.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(size)
+    if len(data) != size:
+        raise OSError(f"{path} truncated while uploaded")
+    return data
+
+
+def connect(app_key, app_secret, refresh_token, max_requests=CONCURRENCY):
+    """ Create the Dropbox client with an HTTP pool sized for max_requests.
+        Retries and throttling are handled from RateLimitedClient.
+    """
+    if not refresh_token:
+        logger.info("Refresh token not set. Calling dropbox API to generate it.")
+        refresh_token = get_refresh_token(app_key, app_secret)
+        logger.info("Refresh token retreived : '" + refresh_token + "' (keep it for next run)")
+    return dropbox.Dropbox(app_key=app_key, app_secret=app_secret, oauth2_refresh_token=refresh_token,
+                           session=dropbox.create_session(max_connections=max_requests),
+                           max_retries_on_error=0, max_retries_on_rate_limit=0)
+
+
+def isSessionLost(err):
+    """ Check if an ApiError is raised from an upload session expired or not valid anymore.
+    """
+    error = getattr(err, 'error', None)
+    if isinstance(error, dropbox.files.UploadSessionFinishError):
+        if not error.is_lookup_failed():
+            return False
+        error = error.get_lookup_failed()
+    if not isinstance(error, (dropbox.files.UploadSessionLookupError, dropbox.files.UploadSessionAppendError)):
+        return False
+    return any(getattr(error, f"is_{tag}")() for tag in LOST_SESSION)
+
+
 def get_refresh_token(app_key, app_secret):
     auth_flow = DropboxOAuth2FlowNoRedirect(app_key, app_secret, token_access_type='offline')
     authorize_url = auth_flow.start()
@@ -89,7 +159,10 @@ class UpDown(Thread, PatternMatchingEventHandler):
 
     def __init__(self, app_key, app_secret, refresh_token, dbfolder, folder, dropboxignore=".dropboxignore",
                  interval=0.5,
-                 overwrite=""):
+                 overwrite="", state="", chunk_size=0, upload_workers=UPLOAD_WORKERS,
+                 batch_size=BATCH_SIZE, batch_deadline=BATCH_DEADLINE, workers=WORKERS,
+                 quiet=QUIET, scan_workers=SCAN_WORKERS, max_requests=CONCURRENCY, bandwidth=None, max_watches=0,
+                 selective=None, client=None, session=None):
         Thread.__init__(self)
         PatternMatchingEventHandler.__init__(self, ignore_patterns=IGNORE_PATTERNS)
         self.db_folder = dbfolder
@@ -97,169 +170,777 @@ class UpDown(Thread, PatternMatchingEventHandler):
         self.dropboxignore = dropboxignore
         self.interval = int(interval)
         self.overwrite = overwrite
-
-        if not refresh_token:
-            logger.info("Refresh token not set. Calling dropbox API to generate it.")
-            refresh_token = get_refresh_token(app_key, app_secret)
-            logger.info("Refresh token retreived : '" + refresh_token + "' (keep it for next run)")
-        # Load dropbox library
-        self.dbx = dropbox.Dropbox(app_key=app_key, app_secret=app_secret, oauth2_refresh_token=refresh_token)
+        self.upload_workers = max(1, int(upload_workers))
+        # Cursor used to follow remote changes
+        self.cursor = None
+        # Remote listing shared during a reconcile
+        self.tree = None
+        # Persistent sync state
+        self.state = SyncState(state) if state else None
+        # Local changes not yet applied in Dropbox, stored with the sync state
+        self.journal = Journal(state)
+        self.applying = {}
+        self.applying_lock = Lock()
+        # Set when a change fails because Dropbox is not reachable
+        self.offline = Event()
+        self.startup_time = None
+        # Bytes not downloaded because already synced
+        self.skipped_bytes = 0
+        # Local events waiting to be stable
+        # A delete and a create of the same file are merged in a move
+        self.events = EventCoalescer(self.dispatchPending, quiet=quiet, matcher=self.matchRenames, identify=self.identity,
+                                     window=MOVE_WINDOW)
+        self.watch = None
+        self.stopped = Event()
+        # Local folder scanner
+        self.scanner = LocalScanner(folder, exclude=self.isExcluded, workers=scan_workers)
+        # Client, scheduler, observer and batchers can be shared with other folders,
+        # otherwise a private session is created and stopped with this folder
+        self.own_session = session is None
+        if session is None:
+            if client is None:
+                client = connect(app_key, app_secret, refresh_token, max_requests)
+            session = SyncSession(client, batch_size=batch_size, batch_deadline=batch_deadline, workers=workers,
+                                  max_requests=max_requests, bandwidth=bandwidth, max_watches=max_watches,
+                                  chunk_size=chunk_size, upload_workers=upload_workers)
+        self.session = session
+        self.session.add(self)
+        self.dbx = session.dbx
+        self.scheduler = session.scheduler
+        self.hasher = session.hasher
+        self.batcher = session.batcher
+        self.deleter = session.deleter
+        self.mover = session.mover
+        self.bandwidth = session.bandwidth
+        # Upload chunk size and single request threshold of the connection
+        self.tuner = session.tuner
+        # Metrics collected from the stopwatch and exposed on request
+        self.metrics = session.metrics
+        self.latency = session.latency
+        self.cycles = session.cycles
+        self.transferred = session.transferred
+        self.renames = RenameMatcher(self.hasher)
         # Load DropboxIgnore list
         self.excludes = self.loadDropboxIgnore()
+        # Parts of the Dropbox folder to synchronize
+        self.selective = selective if selective is not None else SelectivePolicy()
+        if self.selective:
+            logger.info(f"Selective sync {self.selective}")
         # Status initialization
         logger.info(f"Dropbox folder name: {dbfolder}")
         logger.debug(f"Local directory: {folder}")
 
     def run(self):
-        while not self.stopped.wait(self.interval):
-            logger.debug("Dropbox remote sync")
-            # Synchronize from Dropbox first
-            self.syncFromDropbox(overwrite=True)
-            # List of all files
-            self.syncFromHost(overwrite=False, remove=True)
-            # Synchronize from Dropbox first
-            self.syncFromDropbox(overwrite=True)
+        while not self.stopped.is_set():
+            if self.cursor is None:
+                # Without a cursor fallback to a full rescan
+                if self.stopped.wait(self.interval):
+                    break
+                logger.debug("Dropbox remote sync")
+                self.reconcile(overwrite_db=True, overwrite_host=False, remove=True)
+                continue
+            # Apply the local changes kept while Dropbox was not reachable
+            if len(self.journal):
+                self.replay()
+            # Wait remote changes, this call does not count as an API call
+            changes, backoff = self.longpoll()
+            if self.stopped.is_set():
+                break
+            if changes:
+                logger.debug("Dropbox remote changes")
+                self.syncChanges()
+            # Wait if requested from Dropbox
+            if backoff and self.stopped.wait(backoff):
+                break
 
     def start(self):
         overwrite_db = (self.overwrite == "dropbox")
         overwrite_host = (self.overwrite == "host")
         logger.info(f"Overwrite from Dropbox {overwrite_db}")
         logger.info(f"Overwrite from Host {overwrite_host}")
-        # Syncronize from Dropbox first
-        self.syncFromDropbox(overwrite=overwrite_db)
-        # After syncronize from PC
-        self.syncFromHost(overwrite=overwrite_host)
-        # Load the observer
-        self.observer = Observer()
-        self.observer.schedule(self, self.folder, recursive=True)
-        # Initialize stop event
-        self.stopped = Event()
+        self.expireTransfers()
+        self.startBatchers()
+        # Local changes of the last run not applied, before to compare the trees
+        self.replay()
+        t0 = time.time()
+        # Warm start from the last stored state
+        warm = self.state is not None and self.state.getCursor() is not None
+        if warm:
+            self.cursor = self.state.getCursor()
+            warm = self.syncChanges(overwrite=overwrite_db)
+        if warm:
+            self.syncLocalChanges(overwrite=overwrite_host)
+        else:
+            self.reconcile(overwrite_db=overwrite_db, overwrite_host=overwrite_host)
+        self.startup_time = time.time() - t0
+        logger.info(f"Startup sync ({'warm' if warm else 'cold'}) in {self.startup_time:.3f}s")
         super().start()
-        # Start observer
-        self.observer.start()
+        self.events.start()
+        # Watch the folder with the observer of the session
+        self.watch = self.session.watch(self, self.folder, exclude=self.isExcluded)
+
+    def startBatchers(self):
+        """ Start the threads that commit small files, deletes and moves in batch.
+        """
+        self.session.startBatchers()
+
+    def reconcile(self, overwrite_db=False, overwrite_host=False, remove=False):
+        """ Full synchronization between Dropbox and the local folder.
+        """
+        with self.stopwatch('reconcile', 'reconcile', self.cycles):
+            # A single listing is shared for the whole reconcile,
+            # its cursor replays every change from now
+            self.cursor = self.loadTree()
+            if self.tree is None:
+                return
+            try:
+                # Single pass on the remote and local trees
+                self.syncTrees(overwrite_db=overwrite_db, overwrite_host=overwrite_host, remove=remove)
+            finally:
+                self.tree.close()
+                self.tree = None
+            self.saveCursor()
 
     def stop(self):
         self.stopped.set()
-        self.observer.stop()
-        self.observer.join()
+        self.session.unwatch(self.watch)
+        self.events.stop()
+        if self.own_session:
+            self.session.stop()
+        else:
+            self.flush()
+        if self.state is not None:
+            self.state.close()
+        self.journal.close()
         logger.debug("Server stopped")
 
     @dropboxignore
     def on_created(self, event):
         subfolder, name = self.getFolderAndFile(event.src_path)
-        if not re.match(self.excludes, name):
+        if not self.isExcluded(subfolder, name, is_dir=event.is_directory):
             logger.debug(f"Created {name} in folder: \"{subfolder}\"")
-            self.upload(event.src_path, subfolder, name)
+            self.events.push(CREATED, event.src_path, is_directory=event.is_directory)
 
     @dropboxignore
     def on_deleted(self, event):
         subfolder, name = self.getFolderAndFile(event.src_path)
-        if re.search(CONFLICT, name):
+        if re.search(CONFLICT, name) or self.isExcluded(subfolder, name, is_dir=event.is_directory):
             return
         logger.debug(f"Deleted {name} in folder: \"{subfolder}\"")
-        self.delete(subfolder, name)
+        self.events.push(DELETED, event.src_path, is_directory=event.is_directory)
 
     @dropboxignore
     def on_modified(self, event):
         if not event.is_directory:
             subfolder, name = self.getFolderAndFile(event.src_path)
-            if not re.match(self.excludes, name):
+            if not self.isExcluded(subfolder, name):
                 logger.debug(f"Modified {name} in folder: \"{subfolder}\"")
-                # Syncronization from Local to Dropbox
-                self.upload(event.src_path, subfolder, name, overwrite=True)
+                self.events.push(MODIFIED, event.src_path)
 
     @dropboxignore
     def on_moved(self, event):
         if re.search(CONFLICT, event.dest_path):
             return
+        subfolder, name = self.getFolderAndFile(event.dest_path)
+        excluded = self.isExcluded(subfolder, name, is_dir=event.is_directory)
         if any([fnmatch.fnmatch(event.src_path, pattern) for pattern in IGNORE_PATTERNS]):
-            subfolder, name = self.getFolderAndFile(event.dest_path)
-            logger.debug(f"Modified {event.dest_path}")
-            # Syncronization from Local to Dropbox
-            self.upload(event.dest_path, subfolder, name, overwrite=True)
+            if not excluded:
+                logger.debug(f"Modified {event.dest_path}")
+                self.events.push(MODIFIED, event.dest_path, is_directory=event.is_directory)
+            return
+        src_subfolder, src_name = self.getFolderAndFile(event.src_path)
+        if self.isExcluded(src_subfolder, src_name, is_dir=event.is_directory):
+            if not excluded:
+                # Moved in the synchronized paths, a new file
+                logger.debug(f"Created {name} in folder: \"{subfolder}\"")
+                self.events.push(CREATED, event.dest_path, is_directory=event.is_directory)
+            return
+        if excluded:
+            # Moved out of the synchronized paths, the remote copy is not changed
+            logger.debug(f"Move from {event.src_path} to {event.dest_path} only on the host")
+            return
+        logger.debug(f"Move from {event.src_path} to {event.dest_path}")
+        self.events.push(MOVED, event.dest_path, is_directory=event.is_directory, src=event.src_path)
+
+    def dispatchPending(self, pending):
+        """ Store in the journal the final action of a burst of local events and apply it.
+            The journal merges the action with the changes not yet applied on the same paths.
+        """
+        path = self.statePath(*self.getFolderAndFile(pending.path))
+        if pending.action in (DELETED, MOVED) and not pending.is_directory:
+            src_subfolder, src_name = self.getFolderAndFile(pending.src if pending.action == MOVED else pending.path)
+            if not self.isSelected(src_subfolder, src_name):
+                logger.debug(f"{src_subfolder}/{src_name} not synchronized from Dropbox, {pending.action} only on the host")
+                return
+        if pending.action == CREATED:
+            ops = self.journal.add(OP_UPLOAD, path, is_dir=pending.is_directory)
+        elif pending.action == MODIFIED:
+            ops = self.journal.add(OP_UPLOAD, path, is_dir=pending.is_directory, overwrite=True)
+        elif pending.action == DELETED:
+            ops = self.journal.add(OP_DELETE, path, is_dir=pending.is_directory)
+        elif pending.action == MOVED and pending.modified and not pending.is_directory:
+            # The content is changed, the move does not save the upload
+            src = self.statePath(*self.getFolderAndFile(pending.src))
+            ops = self.journal.add(OP_DELETE, src)
+            ops += self.journal.add(OP_UPLOAD, path, overwrite=True)
+        else:
+            src = self.statePath(*self.getFolderAndFile(pending.src))
+            ops = self.journal.add(OP_MOVE, path, src=src, is_dir=pending.is_directory)
+        if self.offline.is_set():
+            # Try only the oldest change until Dropbox is reachable
+            self.replay()
+        else:
+            self.submit(ops)
+
+    def replay(self):
+        """ Apply the changes stored in the journal and not running, oldest first.
+            While Dropbox is not reachable only the oldest change is tried.
+        """
+        probe = self.offline.is_set()
+        self.submit(self.journal.pending(limit=1 if probe else None), probe=probe)
+
+    def submit(self, ops, probe=False):
+        """ Schedule the journaled changes, the small files and the deletes are committed in batch.
+        """
+        for op in ops:
+            key = Journal.key(op.path)
+            with self.applying_lock:
+                if self.applying.get(key) == op.seq:
+                    continue
+                self.applying[key] = op.seq
+            subfolder, name = (op.src if op.action == OP_MOVE else op.path).rsplit("/", 1)
+            size = self.localSize(self.folder + op.path) if op.action == OP_UPLOAD else 0
+            try:
+                future = self.schedule(subfolder, name, self.apply, op, probe=probe, interactive=True, size=size)
+            except RuntimeError as err:
+                # Stopped, the changes are applied on the next start
+                logger.debug(f"{len(ops)} changes kept in the journal: {err}")
+                with self.applying_lock:
+                    self.applying.pop(key, None)
+                return
+            future.add_done_callback(lambda done, op=op: self.applied(op, done))
+
+    def apply(self, op, probe=False):
+        """ Apply a journaled change in Dropbox.
+            Return the result of the operation or a Future if committed in batch.
+        """
+        if self.offline.is_set() and not probe:
+            return DEFERRED
+        subfolder, name = op.path.rsplit("/", 1)
+        if op.action == OP_UPLOAD:
+            return self.upload(self.folder + op.path, subfolder, name, overwrite=op.overwrite, wait=False)
+        if op.action == OP_DELETE:
+            return self.delete(subfolder, name, wait=False)
+        return self.move(op.src, op.path, wait=False)
+
+    def applied(self, op, future):
+        """ Remove a change applied from the journal.
+            A change failed because Dropbox is not reachable is kept and tried again later.
+        """
+        err = future.exception()
+        if err is None and isinstance(future.result(), Future):
+            # Wait the commit of the batch
+            future.result().add_done_callback(lambda done: self.applied(op, done))
+            return
+        deferred = err is None and future.result() is DEFERRED
+        transient = err is not None and isTransient(err)
+        if transient:
+            self.journal.retry(op)
+        elif not deferred:
+            # Applied, or failed for a reason that does not change trying again
+            self.journal.done(op)
+        # Released after the journal is updated, a replay does not apply the change twice
+        with self.applying_lock:
+            if self.applying.get(Journal.key(op.path)) == op.seq:
+                del self.applying[Journal.key(op.path)]
+        if deferred:
             return
-        src_subfolder = os.path.relpath(event.src_path, self.folder)
-        dest_subfolder = os.path.relpath(event.dest_path, self.folder)
-        logger.debug(f"Move from {src_subfolder} to {dest_subfolder}")
-        self.move(src_subfolder, dest_subfolder)
-
-    def syncFromHost(self, overwrite=False, remove=False):
-        logger.info("Start sync from host")
-        for dn, dirs, files in os.walk(self.folder):
-            # Get local folder
-            subfolder = dn[len(self.folder):].strip(os.path.sep)
-            # Get list from dropbox folder
-            listing = self.list_folder(subfolder)
-            list_files = {}
-            list_folders = {}
-            for k, v in listing.items():
-                if isinstance(v, dropbox.files.FileMetadata):
-                    list_files[k] = v
-                else:
-                    list_folders[k] = v
-            logger.debug(f"In folder \"{subfolder}\" ...")
-            # exclude dirs
-            dirs[:] = [d for d in dirs if not re.match(self.excludes, d)]
-            # exclude files
-            files = [f for f in files if not re.match(self.excludes, f)]
-            # Upload only PC files
-            for name in list(set(files) - set(list_files)):
-                fullname = os.path.join(dn, name)
-                # TODO: Check if is required
-                # if not isinstance(name, six.text_type):
-                #    name = name.decode('utf-8')
-                # nname = unicodedata.normalize('NFC', name)
-                if re.search(CONFLICT, fullname):
+        if transient:
+            if not self.offline.is_set():
+                self.offline.set()
+                logger.warning(f"Dropbox not reachable, {len(self.journal)} local changes kept in the journal")
+            return
+        if self.offline.is_set():
+            self.offline.clear()
+            logger.info(f"Dropbox reachable, replay {len(self.journal)} local changes")
+            self.replay()
+
+    def syncTrees(self, overwrite_db=False, overwrite_host=False, remove=False):
+        """ Apply the differences between the remote tree and the local folder.
+            The transfers are scheduled while the trees are read, with about
+            PENDING_TRANSFERS waiting to complete. The renames are matched in
+            windows of MOVE_CANDIDATES files disappeared or appeared.
+        """
+        logger.info("Start sync between dropbox and host")
+        skipped = self.skipped_bytes
+        actions = {}
+        futures = []
+        # Files disappeared from the host and new files, matched to find the renames
+        gone, appeared = {}, {}
+        renames = not remove and self.state is not None
+        for action, subfolder, name, local, remote in self.diff(remove=remove):
+            if len(gone) >= MOVE_CANDIDATES or len(appeared) >= MOVE_CANDIDATES:
+                futures.extend(self.syncRenames(gone, appeared, actions, overwrite_db, overwrite_host))
+                gone, appeared = {}, {}
+            if renames and action == 'download' and local is None:
+                entry = self.state.get(self.statePath(subfolder, name))
+                if entry is not None:
+                    # Synchronized before, removed or renamed on the host
+                    gone[entry.path] = (subfolder, name, remote, entry)
+                    continue
+            if renames and action == 'upload':
+                path = self.statePath(subfolder, name)
+                if self.state.get(path) is None:
+                    appeared[path] = (subfolder, name, local)
+                    continue
+            actions[action] = actions.get(action, 0) + 1
+            if action == 'synced':
+                self.skipped_bytes += remote.size
+                self.record(subfolder, name, remote)
+            elif action == 'download':
+                futures.append(self.schedule(subfolder, name, self.transferFile, subfolder, name, remote,
+                                             overwrite=overwrite_db, size=remote.size))
+            elif action == 'upload':
+                futures.append(self.schedule(subfolder, name, self.upload, local.path, subfolder, name,
+                                             overwrite=overwrite_host, wait=False, size=local.size, stat=local.stat))
+            elif action == 'mkdir':
+                logger.debug(f"Create folder {subfolder}/{name}")
+                os.makedirs(self.folder + subfolder + "/" + name, exist_ok=True)
+            elif action == 'remove':
+                logger.info(f"Remove {'folder' if local.is_dir else 'file'} {local.path}")
+                try:
+                    if local.is_dir:
+                        shutil.rmtree(local.path)
+                    else:
+                        os.remove(local.path)
+                except FileNotFoundError:
+                    logger.debug(f"{local.path} already removed")
+                self.forget(subfolder, name)
+            if len(futures) >= PENDING_TRANSFERS:
+                futures = self.pendingTransfers(futures)
+        futures.extend(self.syncRenames(gone, appeared, actions, overwrite_db, overwrite_host))
+        logger.info(f"Sync actions {actions}, {self.skipped_bytes - skipped} bytes already synced")
+        # Commit all small files uploaded
+        self.waitTransfers(futures)
+        self.flush()
+
+    def syncRenames(self, gone, appeared, actions, overwrite_db=False, overwrite_host=False):
+        """ Move the files disappeared and appeared in the same file, download the
+            other files disappeared and upload the other files appeared.
+            Return the futures of the transfers scheduled.
+        """
+        futures = []
+        if gone and appeared:
+            for src, dest in self.renames.match([(path, entry.size, entry.mtime_ns, entry.inode, entry.content_hash)
+                                                 for path, (_, _, _, entry) in gone.items()],
+                                                [(path, local.path, local.stat) for path, (_, _, local) in appeared.items()]):
+                gone.pop(src)
+                subfolder, name, _ = appeared.pop(dest)
+                actions['move'] = actions.get('move', 0) + 1
+                logger.info(f"Renamed {src} -> {dest}")
+                futures.append(self.schedule(subfolder, name, self.move, src, dest, wait=False))
+        for subfolder, name, remote, _ in gone.values():
+            actions['download'] = actions.get('download', 0) + 1
+            futures.append(self.schedule(subfolder, name, self.transferFile, subfolder, name, remote,
+                                         overwrite=overwrite_db, size=remote.size))
+        for subfolder, name, local in appeared.values():
+            actions['upload'] = actions.get('upload', 0) + 1
+            futures.append(self.schedule(subfolder, name, self.upload, local.path, subfolder, name,
+                                         overwrite=overwrite_host, wait=False, size=local.size, stat=local.stat))
+        return futures
+
+    def diff(self, remove=False):
+        """ Compare the remote tree with the local folder in a single merge-join
+            of the two listings sorted by path.
+
+            Generate lazily (action, subfolder, name, local, remote) with action:
+            'synced', 'download', 'upload', 'mkdir', 'remove' or 'mismatch'.
+            Local files not in Dropbox are uploaded, or removed if remove is True.
+            The local names are used when the file exists in both sides.
+            The paths with a local change in the journal are skipped.
+        """
+        held, trees = self.journal.held()
+        local = ((sortKey(os.path.join(subfolder, entry.name)), (subfolder, entry))
+                 for subfolder, entry in self.scanner.stream())
+        # Local path of the folders on the current path of the walk
+        parents = [("", "")]
+        excluded = None
+        for key, local, remote in mergeJoin(local, self.tree.stream()):
+            # Skip the content of an ignored remote folder
+            if excluded is not None and key.startswith(excluded):
+                continue
+            parent = key.rpartition(SEPARATOR)[0]
+            while len(parents) > 1 and parents[-1][0] != parent:
+                parents.pop()
+            subfolder = parents[-1][1]
+            name = local[1].name if local is not None else remote.name
+            is_dir = local[1].is_dir if local is not None else remote.is_dir
+            if local is not None:
+                local = local[1]
+            if is_dir:
+                parents.append((key, f"{subfolder}/{name}"))
+            if held:
+                path = self.statePath(subfolder, name).lower()
+                if path in trees:
+                    # Deleted or moved on the host, not applied in Dropbox yet
+                    excluded = key + SEPARATOR
+                    continue
+                if path in held and (not is_dir or local is None or remote is None):
+                    # A local change not yet applied wins
+                    continue
+            if remote is None:
+                if re.search(CONFLICT, name):
                     continue
-                # Remove file not in list
                 if remove:
-                    logger.info(f"Remove file {fullname}")
-                    os.remove(fullname)
-                else:
-                    # Upload file
-                    self.upload(fullname, subfolder, name, overwrite=overwrite)
-            # Remove folders
-            if remove:
-                for name in list(set(dirs) - set(list_folders)):
-                    fullname = os.path.join(dn, name)
-                    logger.info(f"Remove folder {fullname}")
-                    shutil.rmtree(fullname)
-
-    def syncFromDropbox(self, subfolder="", overwrite=False):
-        logger.info("Start sync from dropbox")
-        for nname, md in self.list_folder(subfolder).items():
-            path = self.folder + subfolder + "/" + nname
-            # Check if is a file
+                    if is_dir:
+                        # Removed with all its content
+                        excluded = key + SEPARATOR
+                    yield 'remove', subfolder, name, local, None
+                elif not is_dir:
+                    yield 'upload', subfolder, name, local, None
+                continue
+            if self.isExcluded(subfolder, name, is_dir=remote.is_dir):
+                if remote.is_dir:
+                    excluded = key + SEPARATOR
+                continue
+            if not remote.selected:
+                # Too big or too old, the local copy is not changed
+                continue
+            if local is None:
+                yield 'mkdir' if remote.is_dir else 'download', subfolder, name, None, remote
+            elif local.is_dir != remote.is_dir:
+                logger.warning(f"{subfolder}/{name} is a {'folder' if local.is_dir else 'file'} only on the host")
+                yield 'mismatch', subfolder, name, local, remote
+            elif not remote.is_dir:
+                synced = self.isFileSynced(subfolder, name, remote, stat=local.stat)
+                yield 'synced' if synced else 'download', subfolder, name, local, remote
+
+    def pendingTransfers(self, futures):
+        """ Wait the oldest transfers until half of PENDING_TRANSFERS are not completed.
+            Return the futures not completed.
+        """
+        futures = [future for future in futures if future is not None and not future.done()]
+        if len(futures) > PENDING_TRANSFERS // 2:
+            wait(futures[:len(futures) - PENDING_TRANSFERS // 2])
+            futures = [future for future in futures if not future.done()]
+        return futures
+
+    def syncLocalChanges(self, overwrite=False):
+        """ Upload only the local files changed from the last stored state.
+            The local folder and the sync state are read in a single merge-join
+            sorted by path, the renames are matched in windows of MOVE_CANDIDATES
+            files disappeared or appeared.
+        """
+        logger.info("Start sync local changes")
+        with self.stopwatch('local', 'local', self.cycles):
+            futures = []
+            # Stored files disappeared from the host and new files, matched to find the renames
+            gone, appeared = [], {}
+            # Ignored folders and files are not scanned
+            local = ((sortKey(os.path.join(subfolder, entry.name)), (subfolder, entry))
+                     for subfolder, entry in self.scanner.stream())
+            for key, local, stored in mergeJoin(local, self.state.stream()):
+                if len(gone) >= MOVE_CANDIDATES or len(appeared) >= MOVE_CANDIDATES:
+                    futures.extend(self.syncLocalRenames(gone, appeared, overwrite))
+                    gone, appeared = [], {}
+                if local is None:
+                    # Removed or renamed while not running, or no more scanned
+                    if not os.path.exists(self.folder + stored.path):
+                        gone.append(stored)
+                    continue
+                subfolder, entry = local
+                if entry.is_dir or re.search(CONFLICT, entry.name):
+                    continue
+                name = entry.name
+                if stored is None:
+                    # New file or renamed while not running
+                    appeared[self.statePath(subfolder, name)] = (subfolder, name, entry)
+                elif (stored.size, stored.mtime_ns, stored.inode) != tuple(entry.stat):
+                    # Modified while not running, the remote changes are already applied
+                    futures.append(self.schedule(subfolder, name, self.upload, entry.path, subfolder, name,
+                                                 overwrite=True, wait=False, size=entry.size, stat=entry.stat))
+                if len(futures) >= PENDING_TRANSFERS:
+                    futures = self.pendingTransfers(futures)
+            futures.extend(self.syncLocalRenames(gone, appeared, overwrite))
+            self.waitTransfers(futures)
+            self.flush()
+
+    def syncLocalRenames(self, gone, appeared, overwrite=False):
+        """ Move in Dropbox the files renamed while not running and upload the new files.
+            The files removed while not running are restored from Dropbox.
+            Return the futures of the transfers scheduled.
+        """
+        futures = []
+        renamed = self.renames.match([(entry.path, entry.size, entry.mtime_ns, entry.inode, entry.content_hash)
+                                      for entry in gone],
+                                     [(path, entry.path, entry.stat) for path, (_, _, entry) in appeared.items()])
+        for src, dest in renamed:
+            subfolder, name, entry = appeared.pop(dest)
+            logger.info(f"Renamed {src} -> {dest}")
+            futures.append(self.schedule(subfolder, name, self.move, src, dest, wait=False))
+        for path, (subfolder, name, entry) in appeared.items():
+            futures.append(self.schedule(subfolder, name, self.upload, entry.path, subfolder, name,
+                                         overwrite=overwrite, wait=False, size=entry.size, stat=entry.stat))
+        moved = set(src for src, _ in renamed)
+        gone = [entry for entry in gone if entry.path not in moved]
+        if gone:
+            # The uploads are committed before the removed files are restored
+            self.waitTransfers(futures)
+            self.flush()
+        for entry in gone:
+            subfolder, name = entry.path.rsplit("/", 1)
+            md = self.getMetadata(subfolder, name)
+            if isinstance(md, dropbox.files.FileMetadata) and self.selective.accepts(md):
+                self.syncFile(subfolder, name, md)
+            else:
+                self.state.remove(entry.path)
+        return futures
+
+    def syncFile(self, subfolder, nname, md, overwrite=False):
+        """ Synchronize a single remote file with the local copy.
+        """
+        if self.isFileSynced(subfolder, nname, md):
+            self.skipped_bytes += md.size
+            self.record(subfolder, nname, md)
+            return
+        self.transferFile(subfolder, nname, md, overwrite=overwrite)
+
+    def isFileSynced(self, subfolder, nname, md, stat=None):
+        """ Compare the remote metadata with the local copy, without download the file.
+            The local stat is read if not given.
+        """
+        path = self.folder + subfolder + "/" + nname
+        stat = stat if stat is not None else localStat(path)
+        if stat is None:
+            return False
+        if self.state is not None:
+            entry = self.state.get(self.statePath(subfolder, nname))
+            if entry is not None and (entry.size, entry.mtime_ns, entry.inode) == stat:
+                if entry.rev == md.rev or (entry.content_hash and entry.content_hash == md.content_hash):
+                    logger.debug(f"{nname} is already synced [state match]")
+                    return True
+                if entry.content_hash and md.content_hash:
+                    # The local file is unchanged from a different remote content
+                    return False
+        size, mtime_ns, _ = stat
+        mtime_dt = datetime(*time.gmtime(mtime_ns // 1000000000)[:6])
+        if (mtime_dt == md.client_modified and size == md.size):
+            logger.debug(f"{nname} is already synced [stats match]")
+            return True
+        # Same size but different time, check the content
+        if size == md.size and md.content_hash and self.localHash(path, stat) == md.content_hash:
+            logger.debug(f"{nname} is already synced [hash match]")
+            return True
+        return False
+
+    def localHash(self, path, stat):
+        """ Content hash of a local file, hashed only if changed from the last sync.
+        """
+        if self.state is not None:
+            entry = self.state.get(path[len(self.folder):])
+            if entry is not None and entry.content_hash and (entry.size, entry.mtime_ns, entry.inode) == stat:
+                return entry.content_hash
+        return self.hasher.hash(path, stat)
+
+    def isUploaded(self, fullname, subfolder, name, stat):
+        """ Check if the remote file has the same content of the local file.
+        """
+        remote_hash = None
+        if self.state is not None:
+            entry = self.state.get(self.statePath(subfolder, name))
+            if entry is not None:
+                remote_hash = entry.content_hash
+        else:
+            remote_hash = self.hasher.synced(stat)
+        if remote_hash is None and stat[0] > self.tuner.threshold:
+            # For big files a metadata request is cheaper than the upload
+            md = self.getMetadata(subfolder, name)
             if isinstance(md, dropbox.files.FileMetadata):
-                res = self.download(subfolder, nname)
-                # Store file in folder
-                if os.path.exists(path):
-                    mtime = os.path.getmtime(path)
-                    mtime_dt = datetime(*time.gmtime(mtime)[:6])
-                    size = os.path.getsize(path)
-                    if (mtime_dt == md.client_modified and size == md.size):
-                        logger.debug(f"{nname} is already synced [stats match]")
-                    else:
-                        if not overwrite:
-                            # Upload new version
-                            self.upload(path, subfolder, os.path.basename(path))
-                            # Store conflict data
-                            basename = os.path.basename(path)
-                            name_file = basename.split(".")[0]
-                            date = f"{mtime_dt}".replace(" ", "_").replace(":", "")
-                            path = os.path.join(os.path.dirname(path),
-                                                basename.replace(name_file, f"{name_file}_CONFLICT_{date}_"))
-                            logger.warn(f"Rename in {path}")
-                        # Store file
-                        self.storefile(res, path, md.client_modified)
-                else:
-                    self.storefile(res, path, md.client_modified)
-            # Check if data is a folder
-            if isinstance(md, dropbox.files.FolderMetadata):
-                logger.debug(f"Descending into {nname} ...")
-                if not os.path.exists(path):
-                    os.makedirs(path)
-                self.syncFromDropbox(subfolder=subfolder + "/" + nname)
+                remote_hash = md.content_hash
+        if remote_hash is None:
+            return False
+        return self.localHash(fullname, stat) == remote_hash
+
+    def transferFile(self, subfolder, nname, md, overwrite=False):
+        """ Download a remote file that differs from the local copy.
+            If overwrite is False a local copy modified from the last sync
+            is uploaded and the remote file is stored as a conflict file.
+        """
+        path = self.folder + subfolder + "/" + nname
+        # Store file in folder
+        stat = localStat(path) if not overwrite else None
+        if stat is not None and self.state is not None and self.state.isSynced(self.statePath(subfolder, nname), stat):
+            # Not changed on the host from the last sync, only the remote copy is new
+            stat = None
+        if stat is not None:
+            mtime_dt = datetime(*time.gmtime(stat[1] // 1000000000)[:6])
+            # Store conflict data
+            basename = os.path.basename(path)
+            name_file = basename.split(".")[0]
+            date = f"{mtime_dt}".replace(" ", "_").replace(":", "")
+            conflict = os.path.join(os.path.dirname(path),
+                                    basename.replace(name_file, f"{name_file}_CONFLICT_{date}_"))
+            if not self.fetch(subfolder, nname, conflict):
+                return
+            logger.warn(f"Rename in {conflict}")
+            # Upload new version
+            self.upload(path, subfolder, os.path.basename(path), stat=stat)
+        else:
+            md = self.fetch(subfolder, nname, path)
+            if md is not None:
+                self.record(subfolder, nname, md)
+
+    def syncChanges(self, overwrite=True):
+        """ Apply all remote changes from the stored cursor.
+            Return False if the cursor is not valid anymore.
+        """
+        logger.info("Start sync changes from dropbox")
+        with self.stopwatch('changes', 'changes', self.cycles):
+            futures = []
+            held = self.journal.held()
+            while self.cursor is not None:
+                try:
+                    with self.stopwatch('list_folder_continue', 'list_folder'):
+                        res = self.dbx.files_list_folder_continue(self.cursor)
+                except dropbox.exceptions.ApiError as err:
+                    if err.error.is_reset():
+                        logger.warning("Dropbox cursor reset, full rescan required")
+                        self.cursor = None
+                        return False
+                    logger.error(f"API error {err}")
+                    return True
+                except (dropbox.exceptions.HttpError, requests.exceptions.RequestException) as err:
+                    logger.error(f"HTTP error {err}")
+                    return True
+                for entry in res.entries:
+                    futures.append(self.applyChange(entry, overwrite=overwrite, held=held))
+                # Store the cursor only when all changes are applied
+                self.waitTransfers(futures)
+                futures = []
+                self.cursor = res.cursor
+                self.saveCursor()
+                if not res.has_more:
+                    break
+            return True
+
+    def applyChange(self, entry, overwrite=True, held=None):
+        """ Apply a single remote entry returned from a cursor.
+            held are the paths with a local change in the journal, not changed from Dropbox.
+            Return the Future of the scheduled transfer or None.
+        """
+        subfolder, nname = self.getRemoteFolderAndFile(entry.path_display)
+        if nname is None or self.isExcluded(subfolder, nname, is_dir=isinstance(entry, dropbox.files.FolderMetadata)):
+            return None
+        if held is not None and self.isHeld(subfolder, nname, *held):
+            logger.debug(f"Skip remote change of {subfolder}/{nname}, local change pending")
+            return None
+        path = self.folder + subfolder + "/" + nname
+        if isinstance(entry, dropbox.files.FileMetadata) and not self.selective.accepts(entry):
+            logger.debug(f"Skip {subfolder}/{nname}, not selected")
+            return None
+        if isinstance(entry, dropbox.files.FileMetadata):
+            return self.schedule(subfolder, nname, self.syncFile, subfolder, nname, entry, overwrite=overwrite, size=entry.size)
+        elif isinstance(entry, dropbox.files.FolderMetadata):
+            if not os.path.exists(path):
+                logger.debug(f"Create folder {path}")
+                os.makedirs(path, exist_ok=True)
+        elif isinstance(entry, dropbox.files.DeletedMetadata):
+            return self.schedule(subfolder, nname, self.removeLocal, subfolder, nname)
+        return None
+
+    def isHeld(self, subfolder, name, held, trees):
+        """ Check if a path, or a folder containing it, has a local change in the journal.
+        """
+        key = Journal.key(self.statePath(subfolder, name))
+        if key in held:
+            return True
+        while key:
+            key = key.rpartition("/")[0]
+            if key in trees:
+                return True
+        return False
+
+    def removeLocal(self, subfolder, nname):
+        """ Remove a local file or folder deleted in Dropbox.
+        """
+        path = self.folder + subfolder + "/" + nname
+        if re.search(CONFLICT, nname) or not os.path.exists(path):
+            return
+        if os.path.isdir(path):
+            logger.info(f"Remove folder {path}")
+            shutil.rmtree(path)
+        else:
+            logger.info(f"Remove file {path}")
+            os.remove(path)
+        self.forget(subfolder, nname)
+
+    def schedule(self, subfolder, name, func, *args, interactive=False, size=0, **kwargs):
+        """ Submit a transfer on a path to the scheduler.
+            Return a Future with the result.
+        """
+        key = self.transferKey(subfolder, name)
+        priority = PRIORITY_INTERACTIVE if interactive else PRIORITY_BULK
+        return self.scheduler.submit(key, func, *args, priority=priority, size=size, **kwargs)
+
+    def transferKey(self, subfolder, name):
+        """ Key of a path in the scheduler, shared with the other folders of the session.
+        """
+        return self.folder, SyncState.key(self.statePath(subfolder, name))
+
+    def waitTransfers(self, futures):
+        """ Wait the end of all scheduled transfers.
+        """
+        futures = [future for future in futures if future is not None]
+        if futures:
+            with self.stopwatch(f"{len(futures)} transfers"):
+                wait(futures)
+            logger.debug(f"Transfers: {self.scheduler.stats()}")
+            logger.debug(f"Requests: {self.dbx.stats()}")
+            logger.debug(f"Bandwidth: {self.bandwidth.stats()}")
+
+    def localSize(self, path):
+        stat = localStat(path)
+        return stat[0] if stat is not None else 0
+
+    def statePath(self, subfolder, name):
+        """ Path used as key in the sync state, e.g. "/sub/name.txt"
+        """
+        path = f"/{subfolder.replace(os.path.sep, '/')}/{name}"
+        while '//' in path:
+            path = path.replace('//', '/')
+        return path.rstrip('/')
+
+    def record(self, subfolder, name, md=None):
+        """ Store in the sync state the local stat and the remote metadata.
+            Without a state the content hash is kept only in the hasher.
+        """
+        path = self.statePath(subfolder, name)
+        stat = localStat(self.folder + path)
+        if stat is None:
+            return
+        is_file = isinstance(md, dropbox.files.FileMetadata) or (isinstance(md, RemoteEntry) and not md.is_dir)
+        if self.state is None:
+            if is_file and md.content_hash:
+                # The local event of a download is not uploaded back
+                self.hasher.markSynced(stat, md.content_hash)
+            return
+        if is_file:
+            rev, content_hash = md.rev, md.content_hash
+        else:
+            # Keep the last known remote status
+            entry = self.state.get(path)
+            rev, content_hash = (entry.rev, entry.content_hash) if entry is not None else (None, None)
+        self.state.update(path, stat, rev=rev, content_hash=content_hash)
+
+    def forget(self, subfolder, name):
+        """ Remove a file or folder from the sync state.
+        """
+        if self.state is not None:
+            self.state.remove(self.statePath(subfolder, name))
+
+    def saveCursor(self):
+        if self.state is not None:
+            self.state.setCursor(self.cursor)
 
     def getFolderAndFile(self, src_path):
         abs_path = os.path.dirname(src_path)
@@ -271,74 +952,273 @@ class UpDown(Thread, PatternMatchingEventHandler):
     def loadDropboxIgnore(self):
         """ Load Dropbox Ignore file and exlude this files from the list
         """
-        excludes = r'$.'
         path = f"{self.folder}/{self.dropboxignore}"
-        ignore_files = []
-        if os.path.exists(path):
-            with open(path, 'r') as f:
-                ignore_files = f.read().splitlines()
-        if ignore_files:
-            # Update exclude list
-            excludes = r'|'.join([fnmatch.translate(x) for x in ignore_files]) or r'$.'
-            logger.warning(f"Ignore dropbox files: {ignore_files}")
+        excludes = IgnoreMatcher.load(path)
+        if excludes:
+            logger.warning(f"Ignore dropbox files: {excludes.patterns}")
         return excludes
 
-    def list_folder(self, subfolder, recursive=False, onlyFiles=False):
-        """ List a folder.
+    def isExcluded(self, subfolder, name, is_dir=False, accepted=False):
+        """ Check if a file or folder is ignored from .dropboxignore, is outside the
+            selective sync or is a partial download.
+            With accepted the subfolder is known not ignored, only the name is matched.
+        """
+        if not is_dir and name.endswith(TMP_SUFFIX):
+            return True
+        if accepted:
+            if self.excludes.matchName(subfolder, name, is_dir=is_dir):
+                return True
+            return bool(self.selective) and self.selective.isExcluded(self.statePath(subfolder, name), is_dir=is_dir)
+        path = self.statePath(subfolder, name)
+        return self.excludes.match(path, is_dir=is_dir) or self.selective.isExcluded(path, is_dir=is_dir)
 
-            Return a dict mapping unicode filenames to
-            FileMetadata | FolderMetadata entries.
+    def isSelected(self, subfolder, name):
+        """ Check if the remote copy of a local file is synchronized from the size and age rules.
+            The remote metadata is read only with these rules and if the file is not in the sync state.
         """
-        rv = {}
-        path = f"/{self.db_folder}/{subfolder.replace(os.path.sep, '/')}".rstrip('/')
+        if not (self.selective.max_size or self.selective.max_age):
+            return True
+        if self.state is not None and self.state.get(self.statePath(subfolder, name)) is not None:
+            return True
         try:
-            with self.stopwatch('list_folder'):
-                res = self.dbx.files_list_folder(path, recursive=recursive)
+            md = self.getMetadata(subfolder, name)
+        except (dropbox.exceptions.HttpError, requests.exceptions.RequestException) as err:
+            logger.debug(f"Metadata failed for {subfolder}/{name}: {err}")
+            return True
+        return not isinstance(md, dropbox.files.FileMetadata) or self.selective.accepts(md)
+
+    def loadTree(self):
+        """ Load the whole remote folder with a single recursive listing.
+            Return the cursor of the listing or None in case of error.
+        """
+        root = self.rootPath()
+        try:
+            with self.stopwatch('list_folder recursive', 'list_folder'):
+                self.tree = RemoteTree.load(self.dbx, root, self.selective)
         except dropbox.exceptions.ApiError as err:
-            logger.debug(f"Folder listing failed for {path} -- assumed empty: {err}")
-            return rv
-        # Load list
-        for entry in res.entries:
-            # List only Files otherwise list all
-            if recursive:
-                name = entry.path_display.lstrip("/")
-            else:
-                name = entry.name
-            if onlyFiles:
-                if isinstance(entry, dropbox.files.FileMetadata):
-                    rv[name] = entry
-            else:
-                rv[name] = entry
-        return rv
+            logger.debug(f"Folder listing failed for {root} -- assumed empty: {err}")
+            self.tree = RemoteTree(root, self.selective)
+            return self.latestCursor()
+        except (dropbox.exceptions.HttpError, requests.exceptions.RequestException) as err:
+            logger.error(f"HTTP error {err}")
+            self.tree = None
+            return None
+        return self.tree.cursor
+
+    def rootPath(self):
+        """ Path of the synchronized folder in Dropbox.
+        """
+        return f"/{self.db_folder}".replace('//', '/').rstrip('/')
+
+    def getRemoteFolderAndFile(self, remote_path):
+        """ Convert a Dropbox path in the subfolder and name used to sync.
+            Return (None, None) if the path is outside the synchronized folder.
+        """
+        root = self.rootPath()
+        if remote_path.lower() == root.lower() or not remote_path.lower().startswith(root.lower() + "/"):
+            return None, None
+        relative = remote_path[len(root):]
+        subfolder, name = relative.rsplit("/", 1)
+        return subfolder, name
+
+    def getMetadata(self, subfolder, name):
+        """ Metadata of a file or folder.
+            Return None if it doesn't exist.
+        """
+        path = self.normalizePath(subfolder, name)
+        try:
+            with self.stopwatch('get_metadata', 'get_metadata'):
+                return self.dbx.files_get_metadata(path)
+        except dropbox.exceptions.ApiError as err:
+            logger.debug(f"Metadata failed for {path}: {err}")
+            return None
+
+    def latestCursor(self):
+        """ Get a cursor for all changes from now.
+            Return None in case of error.
+        """
+        try:
+            with self.stopwatch('list_folder_get_latest_cursor'):
+                res = self.dbx.files_list_folder_get_latest_cursor(self.rootPath(), recursive=True)
+        except dropbox.exceptions.ApiError as err:
+            logger.error(f"API error {err}")
+            return None
+        except (dropbox.exceptions.HttpError, requests.exceptions.RequestException) as err:
+            logger.error(f"HTTP error {err}")
+            return None
+        return res.cursor
+
+    def longpoll(self):
+        """ Wait until something change in Dropbox.
+            Return the tuple (changes, backoff)
+        """
+        try:
+            res = self.dbx.files_list_folder_longpoll(self.cursor, timeout=LONGPOLL_TIMEOUT)
+        except dropbox.exceptions.ApiError as err:
+            # The cursor is not valid anymore
+            logger.warning(f"Longpoll failed, full rescan required: {err}")
+            self.cursor = None
+            return False, None
+        except (dropbox.exceptions.HttpError, requests.exceptions.RequestException) as err:
+            logger.error(f"HTTP error {err}")
+            return False, self.interval
+        return res.changes, res.backoff
 
-    def storefile(self, res, filename, timedb):
+    def tmpPath(self, filename):
+        """ Temporary file of a download, e.g. "sub/.name.txt.dbsync-tmp"
+        """
+        folder, name = os.path.split(filename)
+        return os.path.join(folder, f".{name}{TMP_SUFFIX}")
+
+    def storefile(self, res, filename, timedb, offset=0, checkpoint=None, expected_hash=None):
         """ Store and fix datetime with dropbox datetime.
+
+            The response is streamed in a temporary file next to the target
+            and renamed only when complete. The response of a ranged request
+            is written from offset. If checkpoint is given it is called with the
+            bytes stored on disk every CHECKPOINT_SIZE bytes and when the connection
+            drops, and the partial file is kept to resume the download.
+            If expected_hash is given the content of the file is checked before the rename.
+            Return True if the file is stored.
         """
-        out = open(filename, 'wb')
-        out.write(res)
-        out.close()
-        # Fix time with md time
-        # https://nitratine.net/blog/post/change-file-modification-time-in-python/
-        modTime = time.mktime(timedb.timetuple())
-        os.utime(filename, (modTime, modTime))
+        name = os.path.basename(filename)
+        tmp = self.tmpPath(filename)
+        position = offset
+        # Smaller reads follow the rate limit without bursts
+        read_size = SHAPED_CHUNK_SIZE if self.bandwidth.download.rate else CHUNK_SIZE
+        try:
+            with contextlib.closing(res), open(tmp, 'r+b' if offset else 'wb') as out:
+                # Drop the bytes written after the last checkpoint
+                out.truncate(offset)
+                out.seek(offset)
+                saved = offset
+                try:
+                    with self.stopwatch(f"store {name}"):
+                        for chunk in res.iter_content(chunk_size=read_size):
+                            out.write(chunk)
+                            position += len(chunk)
+                            self.transferred.inc(len(chunk), "download")
+                            self.bandwidth.download.consume(len(chunk))
+                            if checkpoint is not None and position - saved >= CHECKPOINT_SIZE:
+                                out.flush()
+                                os.fsync(out.fileno())
+                                checkpoint(position)
+                                saved = position
+                finally:
+                    out.flush()
+                    os.fsync(out.fileno())
+            if expected_hash is not None and content_hash(tmp) != expected_hash:
+                raise OSError(f"content hash mismatch after {position} bytes")
+            # Fix time with md time
+            # https://nitratine.net/blog/post/change-file-modification-time-in-python/
+            modTime = time.mktime(timedb.timetuple())
+            os.utime(tmp, (modTime, modTime))
+            os.replace(tmp, filename)
+        except requests.exceptions.RequestException as err:
+            if checkpoint is not None:
+                logger.warning(f"Download of {filename} interrupted at {position} bytes: {err}")
+                checkpoint(position)
+                return False
+            logger.error(f"Store {filename} failed: {err}")
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            return False
+        except OSError as err:
+            logger.error(f"Store {filename} failed: {err}")
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            if checkpoint is not None:
+                checkpoint(0)
+            return False
+        return True
+
+    def fetch(self, subfolder, name, filename):
+        """ Download a file and store it in filename.
+
+            The offset of the partial file is stored in the sync state,
+            a dropped connection or a restart resume the download with a ranged
+            request of the same revision.
+            Return the metadata of the stored file, or None if failed.
+        """
+        key = filename[len(self.folder):]
+        transfer = self.resumeDownload(key, self.tmpPath(filename))
+
+        def checkpoint(offset):
+            nonlocal transfer
+            transfer = transfer._replace(offset=offset)
+            self.saveTransfer(transfer)
+
+        for attempt in range(RESUME_RETRIES + 1):
+            resumed = transfer.offset > 0
+            download = self.download(subfolder, name, offset=transfer.offset)
+            if download is None:
+                break
+            md, res = download
+            if resumed and md.rev != transfer.rev:
+                # Changed from the interrupted download, restart from the first byte
+                logger.info(f"{key} changed to rev {md.rev}, download restarted")
+                res.close()
+                transfer = Transfer.download(key, 0, md)
+                continue
+            transfer = transfer._replace(rev=md.rev, size=md.size)
+            if self.storefile(res, filename, md.client_modified, offset=transfer.offset, checkpoint=checkpoint,
+                              expected_hash=md.content_hash if resumed else None):
+                self.dropTransfer(key, DOWNLOAD)
+                return md
+        if self.state is None:
+            # Without a sync state the partial file cannot be resumed
+            with contextlib.suppress(OSError):
+                os.remove(self.tmpPath(filename))
+        return None
 
-    def download(self, subfolder, name):
-        """ Download a file.
-            Return the bytes of the file, or None if it doesn't exist.
+    def resumeDownload(self, key, tmp):
+        """ Return the interrupted download of a file,
+            or a new download from the first byte.
+        """
+        transfer = self.state.getTransfer(key, DOWNLOAD) if self.state is not None else None
+        if transfer is not None:
+            if 0 < transfer.offset < transfer.size and transfer.offset <= self.localSize(tmp):
+                logger.info(f"Resume download of {key} from {transfer.offset} bytes")
+                return transfer
+            self.state.removeTransfer(key, DOWNLOAD)
+        return Transfer(key, DOWNLOAD, None, 0, None, None, None, None, None, time.time())
+
+    def saveTransfer(self, transfer):
+        if self.state is not None:
+            self.state.setTransfer(transfer)
+
+    def dropTransfer(self, path, direction):
+        if self.state is not None:
+            self.state.removeTransfer(path, direction)
+
+    def expireTransfers(self):
+        """ Drop the interrupted transfers too old to be resumed and their partial files.
+        """
+        if self.state is None:
+            return
+        for transfer in self.state.expireTransfers(TRANSFER_EXPIRY):
+            logger.info(f"Expired {transfer.direction} of {transfer.path} at {transfer.offset} bytes")
+            if transfer.direction == DOWNLOAD:
+                with contextlib.suppress(OSError):
+                    os.remove(self.tmpPath(self.folder + transfer.path))
+
+    def download(self, subfolder, name, offset=0):
+        """ Download a file, from offset with a ranged request.
+            Return the metadata and the streamed response, or None if it doesn't exist.
         """
         path = self.normalizePath(subfolder, name)
-        with self.stopwatch('download'):
+        download = self.dbx.withHeaders('files_download', {'Range': f"bytes={offset}-"}) if offset else self.dbx.files_download
+        with self.stopwatch('download', 'download'):
             try:
-                md, res = self.dbx.files_download(path)
+                md, res = download(path)
             except dropbox.exceptions.ApiError as err:
                 logger.error(f"API error {err.user_message_text}")
                 return None
             except dropbox.exceptions.HttpError as err:
                 logger.error(f"HTTP error {err}")
                 return None
-        data = res.content
-        logger.debug(f"{len(data)} bytes; md: {md}")
-        return data
+        logger.debug(f"{md.size} bytes; md: {md}")
+        return md, res
 
     def normalizePath(self, subfolder, name):
         """ Normalize folder for Dropbox syncronization.
@@ -348,89 +1228,298 @@ class UpDown(Thread, PatternMatchingEventHandler):
             path = path.replace('//', '/')
         return path
 
-    def upload(self, fullname, subfolder, name, overwrite=False):
+    def upload(self, fullname, subfolder, name, overwrite=False, wait=True, stat=None):
         """Upload a file.
-            Return the request response, or None in case of error.
+            Return the request response, or None in case of error
+            or if the remote file has already the same content.
+            The errors of a not reachable Dropbox are raised.
+            Small files are committed in batch, if wait is False
+            a Future is returned without wait the commit.
+            The stat of the file is read if not given from the scan.
         """
         path = self.normalizePath(subfolder, name)
         mode = (dropbox.files.WriteMode.overwrite
                 if overwrite
                 else dropbox.files.WriteMode.add)
-        mtime = os.path.getmtime(fullname)
-        if os.path.isdir(fullname):
+        if stat is None and os.path.isdir(fullname):
             try:
                 res = self.dbx.files_create_folder(path)
             except dropbox.exceptions.ApiError as err:
                 logger.error(f"API ERROR {err.user_message_text}")
                 return None
         else:
-            f = open(fullname, 'rb')
-            file_size = os.path.getsize(fullname)
-            if file_size <= CHUNK_SIZE:
-                data = f.read()
-                with self.stopwatch(f"upload {file_size} bytes"):
+            stat = stat if stat is not None else localStat(fullname)
+            if stat is None:
+                logger.error(f"{fullname} does not exist")
+                return None
+            if self.isUploaded(fullname, subfolder, name, stat):
+                logger.debug(f"{name} is already uploaded [hash match]")
+                self.record(subfolder, name)
+                return None
+            file_size, mtime_ns, _ = stat
+            client_modified = datetime(*time.gmtime(mtime_ns // 1000000000)[:6])
+            threshold = self.tuner.threshold
+            if file_size <= threshold and self.batcher is not None:
+                with open(fullname, 'rb') as f:
+                    data = f.read()
+                commit = dropbox.files.CommitInfo(path=path, mode=mode, client_modified=client_modified, mute=True)
+                self.bandwidth.upload.consume(file_size)
+                with self.stopwatch(f"upload {file_size} bytes", 'upload', size=file_size):
+                    try:
+                        future = self.batcher.submit(data, commit)
+                    except (dropbox.exceptions.ApiError, dropbox.exceptions.HttpError) as err:
+                        if isTransient(err):
+                            raise
+                        logger.error(f"API ERROR {err}")
+                        return None
+                self.transferred.inc(file_size, "upload")
+                future.add_done_callback(lambda done: self.uploadDone(done, subfolder, name))
+                if not wait:
+                    return future
+                return None if future.exception() else future.result()
+            elif file_size <= threshold:
+                with open(fullname, 'rb') as f:
+                    data = f.read()
+                self.bandwidth.upload.consume(file_size)
+                with self.stopwatch(f"upload {file_size} bytes", 'upload', size=file_size):
                     try:
                         res = self.dbx.files_upload(data, path, mode,
-                                                    client_modified=datetime(*time.gmtime(mtime)[:6]),
+                                                    client_modified=client_modified,
                                                     mute=True)
                     except dropbox.exceptions.ApiError as err:
                         logger.error(f"API ERROR {err.user_message_text}")
                         return None
+                self.transferred.inc(file_size, "upload")
             else:
-                upload_session_start_result = self.dbx.files_upload_session_start(f.read(CHUNK_SIZE))
-                cursor = dropbox.files.UploadSessionCursor(session_id=upload_session_start_result.session_id,
-                                                           offset=f.tell())
-                commit = dropbox.files.CommitInfo(path=path)
+                commit = dropbox.files.CommitInfo(path=path, mode=mode, client_modified=client_modified, mute=True)
                 # Upload file
-                with self.stopwatch(f"upload {file_size} bytes"):
-                    while f.tell() < file_size:
-                        if ((file_size - f.tell()) <= CHUNK_SIZE):
-                            res = self.dbx.files_upload_session_finish(f.read(CHUNK_SIZE), cursor, commit)
-                        else:
-                            self.dbx.files_upload_session_append(f.read(CHUNK_SIZE), cursor.session_id, cursor.offset)
-                            cursor.offset = f.tell()
+                with self.stopwatch(f"upload {file_size} bytes", 'upload'):
+                    try:
+                        res = self.uploadSession(fullname, commit, self.statePath(subfolder, name), stat)
+                    except (dropbox.exceptions.ApiError, dropbox.exceptions.HttpError) as err:
+                        if isTransient(err):
+                            raise
+                        logger.error(f"API ERROR {err}")
+                        return None
+                    except OSError as err:
+                        # Changed while uploaded, the next event uploads it again
+                        logger.error(f"Upload {fullname} failed: {err}")
+                        return None
             # Info data uploaded
             logger.debug(f"uploaded as {res.name.encode('utf8')}")
+            self.record(subfolder, name, res)
         return res
 
-    def delete(self, subfolder, name):
+    def uploadDone(self, future, subfolder, name):
+        """ Report the result of a batch upload.
+        """
+        err = future.exception()
+        if err is not None:
+            logger.error(f"Upload {name} failed: {err}")
+            return
+        res = future.result()
+        logger.debug(f"uploaded as {res.name.encode('utf8')}")
+        self.record(subfolder, name, res)
+
+    def flush(self):
+        """ Commit now all small files uploaded.
+        """
+        if self.batcher is not None:
+            self.batcher.flush()
+
+    def uploadSession(self, fullname, commit, key, stat):
+        """ Upload a big file with a concurrent upload session.
+
+            The chunks are read from the file and up to
+            upload_workers chunks are appended in parallel.
+            The session and the chunks appended are stored in the sync state,
+            the upload of an unchanged file continues the interrupted session.
+            Return the metadata of the committed file.
+        """
+        transfer = self.resumeUpload(key, stat)
+        if transfer is not None:
+            try:
+                return self.appendSession(fullname, commit, transfer)
+            except dropbox.exceptions.ApiError as err:
+                if not isSessionLost(err):
+                    raise
+                logger.warning(f"Upload session of {key} not valid, upload restarted: {err}")
+                self.dropTransfer(key, UPLOAD)
+        with self.stopwatch("upload session start", size=0):
+            session = self.dbx.files_upload_session_start(b"", session_type=dropbox.files.UploadSessionType.concurrent)
+        transfer = Transfer.upload(key, session.session_id, stat, self.tuner.chunkFor(stat[0]), set())
+        self.saveTransfer(transfer)
+        return self.appendSession(fullname, commit, transfer)
+
+    def appendSession(self, fullname, commit, transfer):
+        """ Append the chunks missing in an upload session and commit it.
+        """
+        file_size, chunk_size = transfer.size, transfer.chunk_size
+        appended = transfer.appended()
+        lock = Lock()
+
+        def append(offset):
+            cursor = dropbox.files.UploadSessionCursor(session_id=transfer.session_id, offset=offset)
+            # Only the last chunk close the session
+            close = offset + chunk_size >= file_size
+            size = min(chunk_size, file_size - offset)
+            self.bandwidth.upload.consume(size)
+            data = readChunk(fullname, offset, size)
+            with self.stopwatch(f"append {len(data)} bytes", 'append', size=len(data)):
+                self.dbx.files_upload_session_append_v2(data, cursor, close=close)
+            self.transferred.inc(len(data), "upload")
+            with lock:
+                appended.add(offset)
+                self.saveTransfer(Transfer.upload(transfer.path, transfer.session_id, (file_size, transfer.mtime_ns),
+                                                  chunk_size, appended, transfer.started))
+
+        missing = [offset for offset in range(0, file_size, chunk_size) if offset not in appended]
+        if len(missing) < (file_size + chunk_size - 1) // chunk_size:
+            logger.info(f"Resume upload of {transfer.path}, {len(missing)} chunks missing")
+        # The chunk that closes the session is appended after all the others
+        last = [offset for offset in missing if offset + chunk_size >= file_size]
+        with ThreadPoolExecutor(max_workers=self.upload_workers) as pool:
+            # Raise the first error
+            for _ in pool.map(append, [offset for offset in missing if offset not in last]):
+                pass
+        for offset in last:
+            append(offset)
+        cursor = dropbox.files.UploadSessionCursor(session_id=transfer.session_id, offset=file_size)
+        with self.stopwatch("upload session finish", size=0):
+            res = self.dbx.files_upload_session_finish(b"", cursor, commit)
+        self.dropTransfer(transfer.path, UPLOAD)
+        return res
+
+    def resumeUpload(self, key, stat):
+        """ Return the interrupted upload session of an unchanged file or None.
+        """
+        if self.state is None:
+            return None
+        transfer = self.state.getTransfer(key, UPLOAD)
+        if transfer is None:
+            return None
+        if (transfer.size, transfer.mtime_ns) != tuple(stat[:2]):
+            logger.debug(f"{key} changed, upload session dropped")
+            self.state.removeTransfer(key, UPLOAD)
+            return None
+        return transfer
+
+    def delete(self, subfolder, name, wait=True):
         """ Delete a file from dropbox.
-            Return True if is fully delete from dropbox
+            Return True if is fully delete from dropbox.
+            Deletes are committed in batch, if wait is False
+            a Future is returned without wait the commit.
         """
         path = self.normalizePath(subfolder, name)
-        with self.stopwatch('delete'):
+        if self.deleter is not None:
+            future = self.deleter.submit(path)
+            future.add_done_callback(lambda done: self.deleteDone(done, subfolder, name))
+            if not wait:
+                return future
+            return future.exception() is None
+        with self.stopwatch('delete', 'delete'):
             try:
                 self.dbx.files_delete(path)
             except dropbox.exceptions.ApiError as err:
                 logger.error(f"API error {err}")
                 return False
+        self.forget(subfolder, name)
         return True
 
-    def move(self, from_path, to_path, overwrite=False):
+    def deleteDone(self, future, subfolder, name):
+        """ Report the result of a batch delete.
+        """
+        err = future.exception()
+        if err is not None:
+            logger.error(f"Delete {name} failed: {err}")
+            return
+        self.forget(subfolder, name)
+
+    def move(self, from_path, to_path, overwrite=False, wait=True):
         """ Move a file or folder from dropbox.
-            Return True if is fully moved from dropbox
+            Return True if is fully moved from dropbox.
+            Moves are committed in batch, if wait is False
+            a Future is returned without wait the commit.
         """
-        while '//' in from_path:
-            from_path = from_path.replace('//', '/')
-        while '//' in to_path:
-            to_path = to_path.replace('//', '/')
-        with self.stopwatch('move'):
+        from_db = self.normalizePath(from_path, "").rstrip('/')
+        to_db = self.normalizePath(to_path, "").rstrip('/')
+        if self.mover is not None and not overwrite:
+            future = self.mover.submit(from_db, to_db)
+            future.add_done_callback(lambda done: self.moveDone(done, from_path, to_path))
+            if not wait:
+                return future
+            return future.exception() is None
+        with self.stopwatch('move', 'move'):
             try:
-                self.dbx.files_move("/" + from_path, "/" + to_path, allow_shared_folder=False, autorename=overwrite,
+                self.dbx.files_move(from_db, to_db, allow_shared_folder=False, autorename=overwrite,
                                     allow_ownership_transfer=False)
             except dropbox.exceptions.ApiError as err:
                 logger.error(f"API error {err}")
                 return False
+        self.moved(from_path, to_path)
         return True
 
+    def moveDone(self, future, from_path, to_path):
+        """ Report the result of a batch move.
+        """
+        err = future.exception()
+        if err is not None:
+            logger.error(f"Move {from_path} failed: {err}")
+            return
+        self.moved(from_path, to_path)
+
+    def moved(self, from_path, to_path):
+        """ Move the sync state of a file or folder moved in Dropbox.
+            The local stat of a file is updated, it can be a copy with a new inode.
+        """
+        if self.state is None:
+            return
+        self.state.rename(self.statePath(from_path, ""), self.statePath(to_path, ""))
+        if os.path.isfile(self.folder + self.statePath(to_path, "")):
+            self.record(to_path, "")
+
+    def matchRenames(self, gone, appeared):
+        """ Match the local files deleted with the files created, paths are absolute.
+            gone is a list of (path, size, mtime_ns, inode, content_hash) from identity
+            and appeared a list of paths.
+            Return the list of (deleted path, created path) renamed.
+        """
+        stats = ((path, localStat(path)) for path in appeared)
+        return self.renames.match(gone, [(path, path, stat) for path, stat in stats if stat is not None])
+
+    def identity(self, path):
+        """ Return the (size, mtime_ns, inode, content_hash) of a file synchronized before, or None.
+            The deleted files are compared with the sync state, or with Dropbox without a state.
+        """
+        subfolder, name = self.getFolderAndFile(path)
+        if self.state is not None:
+            entry = self.state.get(self.statePath(subfolder, name))
+            return (entry.size, entry.mtime_ns, entry.inode, entry.content_hash) if entry is not None else None
+        md = self.getMetadata(subfolder, name)
+        if isinstance(md, dropbox.files.FileMetadata):
+            return md.size, None, None, md.content_hash
+        return None
+
     @contextlib.contextmanager
-    def stopwatch(self, message):
+    def stopwatch(self, message, operation=None, histogram=None, size=None):
         """ Context manager to print how long a block of code took.
+            If operation is set the time is observed in the latency histogram.
+            If size is set the block is a request with size bytes of payload,
+            the time is a sample of the chunk tuner.
         """
         t0 = time.time()
         try:
             yield
+        except Exception as err:
+            if size and isTransient(err):
+                self.tuner.failed(size)
+            raise
+        else:
+            if size is not None:
+                self.tuner.observe(size, time.time() - t0)
         finally:
             t1 = time.time()
             logger.debug(f"Total elapsed time for {message}: {(t1 - t0):.3f}")
+            if operation is not None:
+                (histogram or self.latency).observe(t1 - t0, operation)
 # EOF
@@ -0,0 +1,331 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import contextlib
+import errno
+import heapq
+import logging
+import os
+import sys
+import time
+from threading import Thread, Event
+
+# Watchdog file events
+from watchdog.events import FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, DirCreatedEvent, DirDeletedEvent
+from watchdog.observers.api import ObservedWatch
+# Package imports
+from .scanner import LocalScanner
+
+# Create logger for jplotlib
+logger = logging.getLogger(__name__)
+# Seconds between two polls of the folders not watched with inotify
+POLL_INTERVAL = 10.0
+# Every FULL_POLL polls are checked the files of all polled folders, not only of the folders changed
+FULL_POLL = 30
+# Maximum number of subtrees watched with inotify when the watches are not enough for the whole folder
+HOT_SUBTREES = 16
+# Inotify watches left to the other processes
+WATCH_RESERVE = 1024
+# System limit of the inotify watches for each user
+MAX_USER_WATCHES = "/proc/sys/fs/inotify/max_user_watches"
+
+
+def inotifyFds():
+    """ Set of the inotify file descriptors open in this process.
+    """
+    fds = set()
+    with contextlib.suppress(OSError):
+        for fd in os.listdir("/proc/self/fd"):
+            with contextlib.suppress(OSError):
+                if os.readlink(f"/proc/self/fd/{fd}") == "anon_inode:inotify":
+                    fds.add(int(fd))
+    return fds
+
+
+def watchBudget(max_watches=0):
+    """ Inotify watches still available to this process, None if not limited.
+        If max_watches is 0 the limit is read from the system, with a reserve for the other processes.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    if not max_watches:
+        try:
+            with open(MAX_USER_WATCHES) as f:
+                max_watches = int(f.read()) - WATCH_RESERVE
+        except (OSError, ValueError):
+            return None
+    used = 0
+    for fd in inotifyFds():
+        with contextlib.suppress(OSError):
+            with open(f"/proc/self/fdinfo/{fd}") as f:
+                used += sum(1 for line in f if line.startswith("inotify wd:"))
+    return max(0, max_watches - used)
+
+
+def residentMemory():
+    """ Resident memory of the process in bytes, 0 if not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class FolderWatch(Thread):
+    """ Watch a synchronized folder for changes.
+
+        The whole folder is watched with a recursive inotify watch when the
+        inotify watches available are enough, otherwise the subtrees changed
+        more recently are watched with inotify and the other folders are
+        covered with a poll of a stat index: each poll reads only the mtime of
+        the folders and scans again only the folders changed. The changes of
+        the content of a file, that do not change the mtime of its folder, are
+        found every FULL_POLL polls.
+    """
+
+    def __init__(self, observer, handler, folder, exclude=None, interval=POLL_INTERVAL, max_watches=0):
+        Thread.__init__(self, daemon=True)
+        self.observer = observer
+        self.handler = handler
+        self.folder = folder
+        self.interval = float(interval)
+        self.max_watches = max_watches
+        self.scanner = LocalScanner(folder, exclude=exclude)
+        self.watches = []
+        # Roots of the subtrees watched with inotify, relative to the folder
+        self.hot = set()
+        # Polled folders: relative path -> [mtime_ns, {file name: (size, mtime_ns)}, {folder names}]
+        self.index = {}
+        self._stopped = Event()
+        # Statistics
+        self.watched = 0
+        self.polls = 0
+        self.setup_time = 0.0
+        self.memory = 0
+
+    def stats(self):
+        return {'inotify': self.watched, 'poll': len(self.index), 'setup': self.setup_time, 'memory': self.memory}
+
+    def start(self):
+        t0, rss = time.time(), residentMemory()
+        budget = watchBudget(self.max_watches)
+        tree = self.tree() if budget is not None else None
+        if tree is None or len(tree[0]) <= budget:
+            if self.schedule(""):
+                self.watched = len(tree[0]) if tree is not None else 0
+                tree = None
+            else:
+                tree = tree or self.tree()
+                budget = watchBudget(self.max_watches) or 0
+        if tree is not None:
+            logger.warning(f"Not enough inotify watches for {len(tree[0])} folders in {self.folder}, "
+                           f"{budget} available: the folders changed less recently are polled")
+            self.hybrid(tree, budget)
+        self.setup_time = time.time() - t0
+        self.memory = max(0, residentMemory() - rss)
+        logger.info(f"Watch {self.folder}: {self.watched} folders with inotify, {len(self.index)} polled, "
+                    f"setup in {self.setup_time:.3f}s and {self.memory / 1048576:.1f}MB")
+        if self.index:
+            super().start()
+
+    def tree(self):
+        """ Walk all folders, also the ignored ones that are watched from a recursive watch.
+            Return a dict relative path -> (mtime_ns, [children]) in top-down order
+            and the set of the ignored folders.
+        """
+        tree, excluded = {}, set()
+        stack = [""]
+        while stack:
+            rel = stack.pop()
+            children = []
+            try:
+                mtime = os.stat(os.path.join(self.folder, rel)).st_mtime_ns
+                with os.scandir(os.path.join(self.folder, rel)) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            child = os.path.join(rel, entry.name)
+                            children.append(child)
+                            if self.scanner.exclude is not None and self.scanner.exclude(rel, entry.name, True):
+                                excluded.add(child)
+            except OSError as err:
+                logger.debug(f"Scan {rel} failed: {err}")
+                continue
+            tree[rel] = (mtime, children)
+            stack.extend(children)
+        return tree, excluded
+
+    def hybrid(self, tree, budget):
+        """ Watch with inotify the subtrees changed more recently that fit the budget, poll the others.
+        """
+        tree, excluded = tree
+        sizes, recent = {}, {}
+        # Children before parents
+        for rel in reversed(list(tree)):
+            mtime, children = tree[rel]
+            children = [child for child in children if child in tree]
+            sizes[rel] = 1 + sum(sizes[child] for child in children)
+            recent[rel] = max([mtime] + [recent[child] for child in children])
+        heap = [(-recent[child], child) for child in tree[""][1] if child in tree and child not in excluded]
+        heapq.heapify(heap)
+        polled = [""]
+        while heap:
+            _, rel = heapq.heappop(heap)
+            if len(self.hot) < HOT_SUBTREES and sizes[rel] <= budget:
+                if self.schedule(rel):
+                    budget -= sizes[rel]
+                    self.watched += sizes[rel]
+                    continue
+                # Used from other processes
+                budget = 0
+            polled.append(rel)
+            for child in tree[rel][1]:
+                if child in tree and child not in excluded:
+                    heapq.heappush(heap, (-recent[child], child))
+        del tree, sizes, recent
+        for rel in polled:
+            listing = self.listdir(rel)
+            if listing is not None:
+                self.index[rel] = listing
+
+    def schedule(self, rel):
+        """ Watch a subtree with a recursive inotify watch.
+            Return False if the inotify watches are exhausted.
+        """
+        path = os.path.join(self.folder, rel)
+        before = inotifyFds()
+        try:
+            self.watches.append(self.observer.schedule(self.handler, path, recursive=True))
+        except OSError as err:
+            if err.errno not in (errno.ENOSPC, errno.EMFILE):
+                raise
+            logger.warning(f"Inotify watch of {path} failed: {err}")
+            self.observer.remove_handler_for_watch(self.handler, ObservedWatch(path, recursive=True))
+            # Release the watches added before the failure
+            for fd in inotifyFds() - before:
+                with contextlib.suppress(OSError):
+                    os.close(fd)
+            return False
+        self.hot.add(rel)
+        return True
+
+    def listdir(self, rel, mtime=None):
+        """ Return the index entry of a folder or None if it doesn't exist.
+        """
+        try:
+            mtime = mtime if mtime is not None else os.stat(os.path.join(self.folder, rel)).st_mtime_ns
+        except OSError:
+            return None
+        listing = self.scanner.listdir(rel)
+        if listing is None:
+            return None
+        dirs, files = listing
+        return [mtime, dict((entry.name, (entry.size, entry.mtime_ns)) for entry in files),
+                set(entry.name for entry in dirs if not entry.is_link and os.path.join(rel, entry.name) not in self.hot)]
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.polls += 1
+            t0 = time.time()
+            changed = self.poll(full=self.polls % FULL_POLL == 0)
+            logger.debug(f"Poll of {len(self.index)} folders in {(time.time() - t0):.3f}s, {changed} changed")
+
+    def poll(self, full=False):
+        """ Scan again the polled folders with a new mtime, all of them if full.
+            Return the number of folders changed.
+        """
+        changed = 0
+        for rel in list(self.index):
+            entry = self.index.get(rel)
+            if entry is None:
+                # Removed with its parent
+                continue
+            try:
+                mtime = os.stat(os.path.join(self.folder, rel)).st_mtime_ns
+            except OSError:
+                # The delete is found from the parent
+                continue
+            if mtime != entry[0] or full:
+                changed += self.rescan(rel, entry, mtime)
+        return changed
+
+    def rescan(self, rel, old, mtime):
+        """ Compare a folder with its index entry and dispatch the changes.
+            Return 1 if something is changed.
+        """
+        new = self.listdir(rel, mtime)
+        if new is None:
+            return 0
+        self.index[rel] = new
+        _, old_files, old_dirs = old
+        _, new_files, new_dirs = new
+        events = [FileCreatedEvent(os.path.join(self.folder, rel, name)) for name in new_files.keys() - old_files.keys()]
+        events += [FileModifiedEvent(os.path.join(self.folder, rel, name)) for name in new_files.keys() & old_files.keys()
+                   if new_files[name] != old_files[name]]
+        events += [FileDeletedEvent(os.path.join(self.folder, rel, name)) for name in old_files.keys() - new_files.keys()]
+        for name in new_dirs - old_dirs:
+            events.append(DirCreatedEvent(os.path.join(self.folder, rel, name)))
+            events += self.add(os.path.join(rel, name))
+        for name in old_dirs - new_dirs:
+            events.append(DirDeletedEvent(os.path.join(self.folder, rel, name)))
+            self.drop(os.path.join(rel, name))
+        for event in events:
+            try:
+                self.handler.dispatch(event)
+            except Exception as err:
+                logger.error(f"Dispatch {event} failed: {err}")
+        return 1 if events else 0
+
+    def add(self, rel):
+        """ Index a new folder with its content.
+            Return the created events of the content.
+        """
+        events = []
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            entry = self.listdir(rel)
+            if entry is None:
+                continue
+            self.index[rel] = entry
+            events += [FileCreatedEvent(os.path.join(self.folder, rel, name)) for name in entry[1]]
+            events += [DirCreatedEvent(os.path.join(self.folder, rel, name)) for name in entry[2]]
+            stack.extend(os.path.join(rel, name) for name in entry[2])
+        return events
+
+    def drop(self, rel):
+        """ Remove a deleted folder with its content from the index.
+        """
+        entry = self.index.pop(rel, None)
+        if entry is not None:
+            for name in entry[2]:
+                self.drop(os.path.join(rel, name))
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        for watch in self.watches:
+            with contextlib.suppress(KeyError):
+                self.observer.unschedule(watch)
+        self.watches = []
+# EOF
@@ -73,7 +73,7 @@ setup(
         "Bug Reports": (project_homepage + "/issues"),
         "Source": (project_homepage + "/tree/master")
     },
-    packages=find_packages(exclude=['examples', 'scripts', 'tests']),  # Required
+    packages=find_packages(exclude=['examples', 'scripts', 'tests', 'benchmarks']),  # Required
     # Define research keywords
     keywords=("dropbox syncronization docker"),
     classifiers=["Development Status :: 5 - Production/Stable",
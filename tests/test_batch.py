@@ -0,0 +1,159 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import sys
+from concurrent.futures import Future
+import pytest
+from dropbox import files
+from dbsync.batch import DeleteBatcher, MoveBatcher, BatchError, chain, isAncestor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+from fakedropbox import FakeDropbox  # noqa: E402
+
+
+class ThrottledDropbox(FakeDropbox):
+    """ Fail the first delete batch with too_many_write_operations.
+    """
+
+    throttled = True
+
+    def files_delete_batch(self, entries):
+        if not self.throttled:
+            return super().files_delete_batch(entries)
+        self.request('files_delete_batch')
+        self.throttled = False
+        failure = files.DeleteBatchResultEntry.failure(files.DeleteError.too_many_write_operations)
+        return files.DeleteBatchLaunch.complete(files.DeleteBatchResult(entries=[failure] * len(entries)))
+
+
+@pytest.fixture
+def dbx(tmp_path):
+    fake = FakeDropbox(str(tmp_path / "remote"))
+    for path in ("/dir/a.txt", "/dir/b.txt", "/dir/sub/c.txt", "/d.txt", "/e.txt"):
+        fake.put(path, b"data")
+    yield fake
+    fake.close()
+
+
+def test_is_ancestor():
+    assert isAncestor("/dir", "/dir")
+    assert isAncestor("/Dir", "/dir/a.txt")
+    assert not isAncestor("/dir", "/dir2/a.txt")
+
+
+def test_chain():
+    source, target = Future(), Future()
+    chain(source, target)
+    source.set_result(1)
+    assert target.result() == 1
+    source, target = Future(), Future()
+    chain(source, target)
+    source.set_exception(ValueError("failed"))
+    with pytest.raises(ValueError):
+        target.result()
+
+
+def test_covers():
+    assert MoveBatcher.covers("/a", "/b", "/a/x.txt", "/b/x.txt")
+    assert MoveBatcher.covers("/a", "/b", "/A/X.txt", "/b/x.TXT")
+    assert not MoveBatcher.covers("/a", "/b", "/a/x.txt", "/c/x.txt")
+    assert not MoveBatcher.covers("/a", "/b", "/a/x.txt", "/b/y.txt")
+    assert not MoveBatcher.covers("/a", "/b", "/ab/x.txt", "/bb/x.txt")
+
+
+def test_delete_batch(dbx):
+    deleter = DeleteBatcher(dbx)
+    futures = [deleter.submit(path) for path in ("/d.txt", "/e.txt")]
+    deleter.flush()
+    assert [future.result().metadata.path_display for future in futures] == ["/d.txt", "/e.txt"]
+    assert dbx.stats()['routes']['files_delete_batch'] == 1
+    assert "/d.txt" not in dbx.listing() and "/e.txt" not in dbx.listing()
+
+
+def test_delete_child_after_folder(dbx):
+    deleter = DeleteBatcher(dbx)
+    folder = deleter.submit("/dir")
+    # Already deleted with the folder
+    assert deleter.submit("/dir/a.txt") is folder
+    assert deleter.submit("/DIR/sub/c.txt") is folder
+    other = deleter.submit("/d.txt")
+    deleter.flush()
+    assert folder.result().metadata.path_display == "/dir"
+    assert other.result().metadata.path_display == "/d.txt"
+    assert sorted(dbx.listing()) == ["/e.txt"]
+
+
+def test_delete_folder_after_children(dbx):
+    deleter = DeleteBatcher(dbx)
+    children = [deleter.submit(path) for path in ("/dir/a.txt", "/dir/sub/c.txt")]
+    folder = deleter.submit("/dir")
+    # The children are merged in the folder delete
+    assert len(deleter._pending) == 1
+    deleter.flush()
+    for future in children:
+        assert future.result() == folder.result()
+
+
+def test_delete_not_found(dbx):
+    deleter = DeleteBatcher(dbx)
+    future = deleter.submit("/missing.txt")
+    deleter.flush()
+    with pytest.raises(BatchError):
+        future.result()
+
+
+def test_delete_throttled(tmp_path):
+    dbx = ThrottledDropbox(str(tmp_path / "remote"))
+    dbx.put("/d.txt", b"data")
+    deleter = DeleteBatcher(dbx)
+    future = deleter.submit("/d.txt")
+    deleter.flush()
+    # Queued again and committed in the next batch
+    assert future.result().metadata.path_display == "/d.txt"
+    assert dbx.stats()['routes']['files_delete_batch'] == 2
+    assert "/d.txt" not in dbx.listing()
+    dbx.close()
+
+
+def test_move_batch(dbx):
+    mover = MoveBatcher(dbx)
+    folder = mover.submit("/dir", "/moved")
+    # Already moved with the folder
+    assert mover.submit("/dir/a.txt", "/moved/a.txt") is folder
+    renamed = mover.submit("/dir/b.txt", "/other/b.txt")
+    assert renamed is not folder
+    mover.flush()
+    assert folder.result().path_display == "/moved"
+    assert "/moved/sub/c.txt" in dbx.listing()
+
+
+def test_move_folder_after_children(dbx):
+    mover = MoveBatcher(dbx)
+    child = mover.submit("/dir/a.txt", "/moved/a.txt")
+    folder = mover.submit("/dir", "/moved")
+    assert len(mover._pending) == 1
+    mover.flush()
+    assert child.result() == folder.result()
+    assert "/moved/a.txt" in dbx.listing()
+# EOF
@@ -0,0 +1,107 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import sys
+import pytest
+import requests
+from dropbox import files
+import dbsync.client
+from dbsync.client import RateLimitedClient, isNotSent
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+from fakedropbox import FakeDropbox  # noqa: E402
+
+
+class TimedOutDropbox(FakeDropbox):
+    """ Fail the first write with a timeout. A request sent is applied
+        and the response is lost.
+    """
+
+    timeout = requests.exceptions.ReadTimeout("Read timed out")
+
+    def lost(self, route, *args, **kwargs):
+        err, self.timeout = self.timeout, None
+        if err is not None and isNotSent(err):
+            raise err
+        res = getattr(super(), route)(*args, **kwargs)
+        if err is not None:
+            raise err
+        return res
+
+    def files_create_folder(self, path, autorename=False):
+        return self.lost('files_create_folder', path, autorename)
+
+    def files_delete(self, path, parent_rev=None):
+        return self.lost('files_delete', path, parent_rev)
+
+    def files_upload(self, f, path, mode=files.WriteMode.add, **kwargs):
+        return self.lost('files_upload', f, path, mode, **kwargs)
+
+
+@pytest.fixture
+def fake(tmp_path, monkeypatch):
+    monkeypatch.setattr(dbsync.client, 'BACKOFF', 0.0)
+    fake = TimedOutDropbox(str(tmp_path / "remote"))
+    fake.put("/a.txt", b"data")
+    yield fake
+    fake.close()
+
+
+def test_is_not_sent():
+    assert isNotSent(requests.exceptions.ConnectTimeout("Connect timed out"))
+    assert not isNotSent(requests.exceptions.ReadTimeout("Read timed out"))
+    assert not isNotSent(requests.exceptions.ConnectionError("Connection aborted"))
+
+
+def test_create_folder_applied(fake):
+    # The retry fails with a conflict on the folder created
+    assert RateLimitedClient(fake).files_create_folder("/dir") is None
+    assert fake.stats()['routes']['files_create_folder'] == 2
+    assert fake.files_get_metadata("/dir").name == "dir"
+
+
+def test_delete_applied(fake):
+    # The retry fails with not_found on the file deleted
+    assert RateLimitedClient(fake).files_delete("/a.txt") is None
+    assert fake.stats()['routes']['files_delete'] == 2
+
+
+def test_upload_add_not_retried(fake):
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        RateLimitedClient(fake).files_upload(b"new", "/b.txt", files.WriteMode.add)
+    assert fake.stats()['routes']['files_upload'] == 1
+
+
+def test_upload_overwrite_retried(fake):
+    assert RateLimitedClient(fake).files_upload(b"new", "/a.txt", files.WriteMode.overwrite).name == "a.txt"
+    assert fake.stats()['routes']['files_upload'] == 2
+    assert fake.read("/a.txt") == b"new"
+
+
+def test_upload_not_sent_retried(fake):
+    fake.timeout = requests.exceptions.ConnectTimeout("Connect timed out")
+    RateLimitedClient(fake).files_upload(b"new", "/b.txt", files.WriteMode.add)
+    assert fake.stats()['routes']['files_upload'] == 1
+    assert fake.read("/b.txt") == b"new"
+# EOF
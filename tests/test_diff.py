@@ -0,0 +1,85 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import dbsync.state
+from dbsync.diff import sortKey, mergeJoin
+from dbsync.state import SyncState
+
+
+def test_sort_key():
+    assert sortKey("/Sub/Name.txt") == "sub\0name.txt"
+    assert sortKey("sub/name.txt/") == "sub\0name.txt"
+    assert sortKey("") == ""
+
+
+def test_sort_key_depth_first():
+    paths = ["/a-b", "/a/c", "/a", "/a/b/c", "/A b", "/ab"]
+    # The content of a folder follows the folder, before the names with a longer prefix
+    assert sorted(paths, key=sortKey) == ["/a", "/a/b/c", "/a/c", "/A b", "/a-b", "/ab"]
+
+
+def test_merge_join():
+    local = [("a", 1), ("c", 3), ("d", 4)]
+    remote = [("b", "B"), ("c", "C"), ("e", "E")]
+    assert list(mergeJoin(local, remote)) == [("a", 1, None), ("b", None, "B"), ("c", 3, "C"),
+                                              ("d", 4, None), ("e", None, "E")]
+
+
+def test_merge_join_empty():
+    assert list(mergeJoin([], [])) == []
+    assert list(mergeJoin([("a", 1)], [])) == [("a", 1, None)]
+    assert list(mergeJoin([], [("a", 1)])) == [("a", None, 1)]
+
+
+def test_merge_join_none_items():
+    # An item None is not the end of a stream
+    assert list(mergeJoin([("a", None), ("b", 2)], [("b", None)])) == [("a", None, None), ("b", 2, None)]
+
+
+def test_merge_join_keys():
+    local = ((sortKey(path), path) for path in sorted(["/a", "/a/b", "/a-b"], key=sortKey))
+    remote = ((sortKey(path), path) for path in sorted(["/A/B", "/a b"], key=sortKey))
+    assert [(key, loc, rem) for key, loc, rem in mergeJoin(local, remote)] == [
+        ("a", "/a", None), ("a\0b", "/a/b", "/A/B"), ("a b", None, "/a b"), ("a-b", "/a-b", None)]
+
+
+def test_merge_join_lazy():
+    def stream():
+        yield "a", 1
+        yield "b", 2
+        raise AssertionError("Read after the head")
+    join = mergeJoin(stream(), [("a", 1)])
+    assert next(join) == ("a", 1, 1)
+
+
+def test_state_stream(tmp_path, monkeypatch):
+    # Read in more than one page
+    monkeypatch.setattr(dbsync.state, 'STREAM_PAGE', 2)
+    state = SyncState(str(tmp_path / "state.db"))
+    paths = ["/a-b", "/a/c", "/A", "/a/b/c", "/A b", "/ab"]
+    for path in paths:
+        state.update(path, (1, 2, 3))
+    assert [(key, entry.path) for key, entry in state.stream()] == [(sortKey(path), path)
+                                                                    for path in sorted(paths, key=sortKey)]
+    state.close()
+# EOF
@@ -0,0 +1,200 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import time
+from dbsync.events import EventCoalescer, CREATED, MODIFIED, DELETED, MOVED
+
+
+def coalescer(matcher=None, window=0.0):
+    return EventCoalescer(lambda pending: None, quiet=1.0, matcher=matcher, identify=lambda path: None, window=window)
+
+
+def actions(ready):
+    return sorted((pending.action, pending.path, pending.src) for pending in ready)
+
+
+def test_created_and_modified_is_created(tmp_path):
+    path = str(tmp_path / "a.txt")
+    events = coalescer()
+    events.push(CREATED, path)
+    events.push(MODIFIED, path)
+    events.push(MODIFIED, path)
+    assert events.pending == 1
+    assert actions(events.ready(time.time() + 10)) == [(CREATED, path, None)]
+
+
+def test_created_and_deleted_is_dropped(tmp_path):
+    path = str(tmp_path / "a.txt")
+    events = coalescer()
+    events.push(CREATED, path)
+    events.push(DELETED, path)
+    assert events.pending == 0
+
+
+def test_deleted_and_created_is_modified(tmp_path):
+    path = str(tmp_path / "a.txt")
+    events = coalescer()
+    events.push(DELETED, path)
+    events.push(CREATED, path)
+    assert actions(events.ready(time.time() + 10)) == [(MODIFIED, path, None)]
+
+
+def test_created_and_moved_is_created(tmp_path):
+    src, dest = str(tmp_path / "a.txt"), str(tmp_path / "b.txt")
+    events = coalescer()
+    events.push(CREATED, src)
+    events.push(MOVED, dest, src=src)
+    assert actions(events.ready(time.time() + 10)) == [(CREATED, dest, None)]
+
+
+def test_chain_of_moves_is_one_move(tmp_path):
+    a, b, c = (str(tmp_path / name) for name in ("a.txt", "b.txt", "c.txt"))
+    events = coalescer()
+    events.push(MOVED, b, src=a)
+    events.push(MOVED, c, src=b)
+    ready = events.ready(time.time() + 10)
+    assert actions(ready) == [(MOVED, c, a)]
+    assert not ready[0].modified
+
+
+def test_moved_and_deleted_deletes_source(tmp_path):
+    src, dest = str(tmp_path / "a.txt"), str(tmp_path / "b.txt")
+    events = coalescer()
+    events.push(MOVED, dest, src=src)
+    events.push(DELETED, dest)
+    assert actions(events.ready(time.time() + 10)) == [(DELETED, src, None)]
+
+
+def test_moved_and_modified_is_modified_move(tmp_path):
+    src, dest = str(tmp_path / "a.txt"), str(tmp_path / "b.txt")
+    events = coalescer()
+    events.push(MOVED, dest, src=src)
+    events.push(MODIFIED, dest)
+    ready = events.ready(time.time() + 10)
+    assert actions(ready) == [(MOVED, dest, src)]
+    assert ready[0].modified
+
+
+def test_wait_quiet(tmp_path):
+    path = str(tmp_path / "a.txt")
+    events = coalescer()
+    events.push(CREATED, path)
+    assert events.ready(time.time()) == []
+    assert events.pending == 1
+
+
+def test_wait_file_written(tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_text("a")
+    events = coalescer()
+    events.push(CREATED, str(path))
+    path.write_text("longer")
+    # The size is changed, wait again the quiet window
+    assert events.ready(time.time() + 10) == []
+    assert actions(events.ready(time.time() + 20)) == [(CREATED, str(path), None)]
+
+
+def test_deleted_wait_window(tmp_path):
+    path = str(tmp_path / "a.txt")
+    events = coalescer(matcher=lambda deleted, created: [], window=5.0)
+    events.push(DELETED, path)
+    assert events.ready(time.time() + 2) == []
+    assert actions(events.ready(time.time() + 10)) == [(DELETED, path, None)]
+
+
+def test_folder_deleted_drops_children(tmp_path):
+    folder = str(tmp_path / "dir")
+    events = coalescer(matcher=lambda deleted, created: [], window=5.0)
+    for idx in range(20):
+        events.push(DELETED, os.path.join(folder, f"f{idx}.txt"))
+    events.push(DELETED, folder, is_directory=True)
+    other = str(tmp_path / "dir2" / "a.txt")
+    events.push(DELETED, other)
+    # The folder is ready before the files waiting the window
+    assert actions(events.ready(time.time() + 2)) == [(DELETED, folder, None)]
+    assert actions(events.ready(time.time() + 10)) == [(DELETED, other, None)]
+    assert events.pending == 0
+
+
+def test_rename_paired(tmp_path):
+    src, dest = str(tmp_path / "a.txt"), tmp_path / "b.txt"
+    dest.write_text("hello")
+    dest = str(dest)
+    events = EventCoalescer(lambda pending: None, quiet=1.0, window=5.0,
+                            matcher=lambda deleted, created: [(deleted[0][0], created[0])],
+                            identify=lambda path: (5, None, None, "hash"))
+    events.push(DELETED, src)
+    events.push(CREATED, dest)
+    ready = events.pair(events.ready(time.time() + 2))
+    assert actions(ready) == [(MOVED, dest, src)]
+    assert events.pending == 0
+    assert events.renamed == 1
+
+
+def test_identify_once(tmp_path):
+    identified = []
+
+    def identify(path):
+        identified.append(path)
+        return 3, None, None, "hash"
+
+    events = EventCoalescer(lambda pending: None, quiet=1.0, window=60.0,
+                            matcher=lambda deleted, created: [], identify=identify)
+    for idx in range(10):
+        events.push(DELETED, str(tmp_path / f"gone{idx}.txt"))
+    for idx in range(5):
+        path = tmp_path / f"new{idx}.txt"
+        path.write_text("hello")
+        events.push(CREATED, str(path))
+        events.pair(events.ready(time.time() + 2))
+    # Each deleted file is resolved once for all the created files
+    assert len(identified) == 10
+
+
+def test_identify_size(tmp_path):
+    identified = []
+    modified = tmp_path / "big.txt"
+    modified.write_text("a longer content")
+    events = EventCoalescer(lambda pending: None, quiet=1.0, window=60.0,
+                            matcher=lambda deleted, created: [],
+                            identify=lambda path: identified.append(path))
+    events.push(MODIFIED, str(modified))
+    events.push(DELETED, str(modified))
+    created = tmp_path / "new.txt"
+    created.write_text("short")
+    events.push(CREATED, str(created))
+    events.pair(events.ready(time.time() + 2))
+    # The size of the deleted file is known and differs
+    assert identified == []
+
+
+def test_flush_dispatch(tmp_path):
+    dispatched = []
+    events = EventCoalescer(dispatched.append, quiet=10.0)
+    events.push(CREATED, str(tmp_path / "a.txt"))
+    events.push(CREATED, str(tmp_path / "b.txt"))
+    events.flush()
+    assert len(dispatched) == 2
+    assert events.pending == 0
+# EOF
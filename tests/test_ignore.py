@@ -0,0 +1,81 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from dbsync.ignore import IgnoreMatcher
+
+
+def test_empty():
+    matcher = IgnoreMatcher([])
+    assert not matcher
+    assert not matcher.match("a/b.txt")
+    assert not matcher.matchName("a", "b.txt")
+
+
+def test_names():
+    matcher = IgnoreMatcher(["*.swp", "node_modules", "*~", "a?c", "# comment", ""])
+    assert matcher.patterns == ["*.swp", "node_modules", "*~", "a?c"]
+    assert matcher.match("sub/file.swp")
+    assert matcher.match("file~")
+    assert matcher.match("x/abc")
+    assert not matcher.match("x/abcd")
+    assert not matcher.match("file.swp.txt")
+    # The content of an ignored folder
+    assert matcher.match("node_modules", is_dir=True)
+    assert matcher.match("src/node_modules/lib/index.js")
+
+
+def test_anchored_and_dirs():
+    matcher = IgnoreMatcher(["/root.txt", "docs/*.md", "build/", "**/deep/*.o"])
+    assert matcher.match("root.txt")
+    assert not matcher.match("sub/root.txt")
+    assert matcher.match("docs/readme.md")
+    assert not matcher.match("docs/sub/readme.md")
+    assert matcher.match("a/deep/x.o")
+    # Only the folders named build
+    assert matcher.match("build", is_dir=True)
+    assert matcher.match("build/out.bin")
+    assert not matcher.match("build")
+
+
+def test_negate():
+    matcher = IgnoreMatcher(["*.swp", "!keep.swp"])
+    assert matcher.match("a.swp")
+    assert not matcher.match("sub/keep.swp")
+    assert not matcher.matchName("sub", "keep.swp")
+
+
+def test_match_name():
+    matcher = IgnoreMatcher(["*.log", "cache", "/top/*.tmp", "[ab]x"])
+    for parent, name, is_dir in [("", "a.log", False), ("sub", "cache", True), ("top", "x.tmp", False), ("sub", "x.tmp", False),
+                                 ("sub", "ax", False), ("sub", "cx", False), ("", "top", True)]:
+        path = f"{parent}/{name}" if parent else name
+        assert matcher.matchName(parent, name, is_dir=is_dir) == matcher.match(path, is_dir=is_dir)
+
+
+def test_excludes_tree():
+    matcher = IgnoreMatcher(["cache"])
+    assert matcher.excludesTree("/a/cache")
+    assert matcher.excludesTree("a/cache/b")
+    assert not matcher.excludesTree("a/b")
+    assert not matcher.excludesTree("/")
+# EOF
@@ -0,0 +1,143 @@
+# -*- coding: UTF-8 -*-
+# This file is part of the jetson_stats package (https://github.com/rbonghi/docker-dropbox-app or http://rnext.it).
+# Copyright (c) 2020 Raffaello Bonghi.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from dbsync import journal
+from dbsync.journal import Journal, OP_UPLOAD, OP_DELETE, OP_MOVE
+
+
+def operations(store):
+    return [(op.action, op.path, op.src) for op in store.pending()]
+
+
+def test_upload_merged():
+    store = Journal()
+    store.add(OP_UPLOAD, "/a.txt")
+    store.add(OP_UPLOAD, "/a.txt", overwrite=True)
+    assert operations(store) == [(OP_UPLOAD, "/a.txt", None)]
+    assert store.pending()[0].overwrite
+    store.close()
+
+
+def test_case_insensitive():
+    store = Journal()
+    store.add(OP_UPLOAD, "/A.txt")
+    store.add(OP_DELETE, "/a.txt")
+    assert operations(store) == [(OP_DELETE, "/a.txt", None)]
+    store.close()
+
+
+def test_chain_of_moves():
+    store = Journal()
+    store.add(OP_MOVE, "/b.txt", src="/a.txt")
+    store.add(OP_MOVE, "/c.txt", src="/b.txt")
+    assert operations(store) == [(OP_MOVE, "/c.txt", "/a.txt")]
+    store.close()
+
+
+def test_move_not_uploaded():
+    store = Journal()
+    store.add(OP_UPLOAD, "/a.txt")
+    store.add(OP_MOVE, "/b.txt", src="/a.txt")
+    assert operations(store) == [(OP_DELETE, "/a.txt", None), (OP_UPLOAD, "/b.txt", None)]
+    store.close()
+
+
+def test_move_and_delete():
+    store = Journal()
+    store.add(OP_MOVE, "/b.txt", src="/a.txt")
+    store.add(OP_DELETE, "/b.txt")
+    # The source is still in Dropbox
+    assert sorted(operations(store)) == [(OP_DELETE, "/a.txt", None), (OP_DELETE, "/b.txt", None)]
+    store.close()
+
+
+def test_folder_delete_drops_children():
+    store = Journal()
+    store.add(OP_UPLOAD, "/dir/a.txt")
+    store.add(OP_DELETE, "/dir/b.txt")
+    store.add(OP_MOVE, "/c.txt", src="/dir/c.txt")
+    store.add(OP_DELETE, "/dir", is_dir=True)
+    # The moves from the folder are kept
+    assert operations(store) == [(OP_MOVE, "/c.txt", "/dir/c.txt"), (OP_DELETE, "/dir", None)]
+    store.close()
+
+
+def test_child_deleted_after_parent_pending():
+    store = Journal()
+    assert len(store.add(OP_DELETE, "/dir", is_dir=True)) == 1
+    assert store.add(OP_DELETE, "/dir/a.txt") == []
+    assert store.add(OP_DELETE, "/dir/sub/b.txt") == []
+    assert operations(store) == [(OP_DELETE, "/dir", None)]
+    store.close()
+
+
+def test_child_deleted_after_parent_applied():
+    store = Journal()
+    store.add(OP_DELETE, "/dir", is_dir=True)
+    store.done(store.pending()[0])
+    assert len(store) == 0
+    assert store.add(OP_DELETE, "/Dir/a.txt") == []
+    assert len(store) == 0
+    store.close()
+
+
+def test_child_deleted_after_parent_expired(monkeypatch):
+    store = Journal()
+    store.add(OP_DELETE, "/dir", is_dir=True)
+    store.done(store.pending()[0])
+    monkeypatch.setattr(journal, "RECENT_DELETES", 0.0)
+    assert len(store.add(OP_DELETE, "/dir/a.txt")) == 1
+    store.close()
+
+
+def test_child_deleted_after_folder_created_again():
+    store = Journal()
+    store.add(OP_DELETE, "/dir", is_dir=True)
+    store.done(store.pending()[0])
+    store.add(OP_UPLOAD, "/dir/a.txt")
+    store.done(store.pending()[0])
+    assert operations(store) == []
+    assert len(store.add(OP_DELETE, "/dir/a.txt")) == 1
+    store.close()
+
+
+def test_done_replaced():
+    store = Journal()
+    store.add(OP_UPLOAD, "/a.txt")
+    op = store.pending()[0]
+    store.add(OP_UPLOAD, "/a.txt", overwrite=True)
+    # A new change on the same path is kept
+    store.done(op)
+    assert operations(store) == [(OP_UPLOAD, "/a.txt", None)]
+    store.close()
+
+
+def test_persistent(tmp_path):
+    path = str(tmp_path / "journal.db")
+    store = Journal(path)
+    store.add(OP_UPLOAD, "/a.txt")
+    store.close()
+    store = Journal(path)
+    assert operations(store) == [(OP_UPLOAD, "/a.txt", None)]
+    store.close()
+# EOF